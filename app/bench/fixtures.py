@@ -0,0 +1,141 @@
+# fixtures.py
+from __future__ import annotations
+import random
+import re
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+from zoneinfo import ZoneInfo
+
+JST = ZoneInfo("Asia/Tokyo")
+_A1_RE = re.compile(r"([A-Z]+)(\d+)")
+
+def make_rankings(n: int, seed: int = 0) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    score = 50_000_000
+    out = []
+    for i in range(n):
+        score -= rng.randint(1, 5_000)
+        out.append({
+            "rank": i + 1,
+            "userId": 7_400_000_000_000_000 + i * 7919,
+            "userName": f"player{i:05d}",
+            "score": score,
+        })
+    return out
+
+def make_targets(rankings: List[Dict[str, Any]], n: int, seed: int = 0) -> tuple:
+    rng = random.Random(seed)
+    picks = rng.sample(rankings, n)
+    out = []
+    for i, e in enumerate(picks):
+        kind = i % 3
+        out.append(e["rank"] if kind == 0 else e["userId"] if kind == 1 else e["userName"])
+    out.append("nobody-here")
+    return tuple(out)
+
+def make_times(start: datetime, days: int, step_minutes: int = 1) -> List[str]:
+    n = days * 24 * 60 // step_minutes
+    return [(start + timedelta(minutes=k * step_minutes)).astimezone(ZoneInfo("UTC"))
+            .strftime("%Y-%m-%dT%H:%M:%S.000Z") for k in range(n)]
+
+def make_shift_table(start: datetime, weeks: int, gap_cols: int = 4, seed: int = 0) -> List[List[str]]:
+    rng = random.Random(seed)
+    days = weeks * 7
+    ncols = days * (1 + gap_cols)
+    table = [[""] * ncols for _ in range(25)]
+    for i in range(days):
+        base = i * (1 + gap_cols)
+        table[0][base] = (start.date() + timedelta(days=i)).strftime("%Y-%m-%d")
+        for h in range(24):
+            table[h + 1][base] = f"{h:02d}:00"
+            for j in range(gap_cols):
+                if rng.random() < 0.6:
+                    table[h + 1][base + 1 + j] = f"runner{rng.randint(1, 30)}"
+        for j in range(gap_cols):
+            table[0][base + 1 + j] = "アンコ" if j == gap_cols - 1 else f"支援者{j + 1}"
+    return table
+
+def make_pt_grid(start: datetime, days: int, interval_minutes: int, trackings: List[Any]) -> List[List[str]]:
+    header = ["日付", "時間"] + [str(t) for t in trackings]
+    grid = [header]
+    prev = None
+    t = start
+    end = start + timedelta(days=days)
+    first = True
+    while t <= end:
+        grid.append([f"{t.month}/{t.day}" if t.date() != prev else "", t.strftime("%H:%M")]
+                    + (["0"] * len(trackings) if first else [""] * len(trackings)))
+        prev = t.date()
+        first = False
+        t += timedelta(minutes=interval_minutes)
+    return grid
+
+def make_config_cells(n: int, seed: int = 0) -> List[List[str]]:
+    rng = random.Random(seed)
+    samples = [
+        "123", "-4.5", "TRUE", "false", "2025-08-25T15:00:00+09:00", "alice, bob, carol",
+        '{"a": 1, "b": [2, 3]}', "[1, 2, 3]", "plain text", "1,000", "7400000000000000123",
+    ]
+    return [[rng.choice(samples) for _ in range(rng.randint(1, 4))] for _ in range(n)]
+
+class FakeWorksheet:
+    # gspread.Worksheet のうち ptlogger が使う読み取り系だけを再現する。
+    # 書き込みは記録のみで表は変えないので、同じ操作を何度でも計測できる。
+    def __init__(self, grid: List[List[str]], title: str = "PtLogs") -> None:
+        self.grid = grid
+        self.title = title
+        self.writes = 0
+
+    @staticmethod
+    def _cell(a1: str):
+        m = _A1_RE.fullmatch(a1)
+        col = 0
+        for ch in m.group(1):
+            col = col * 26 + ord(ch) - 64
+        return int(m.group(2)) - 1, col - 1
+
+    def _range(self, rng: str) -> List[List[str]]:
+        a, _, b = rng.partition(":")
+        r0, c0 = self._cell(a)
+        r1, c1 = self._cell(b or a)
+        out = []
+        for r in range(r0, r1 + 1):
+            row = [self.grid[r][c] if r < len(self.grid) and c < len(self.grid[r]) else ""
+                   for c in range(c0, c1 + 1)]
+            while row and row[-1] == "":
+                row.pop()
+            out.append(row)
+        while out and not out[-1]:
+            out.pop()
+        return out
+
+    def batch_get(self, ranges: List[str]) -> List[List[List[str]]]:
+        return [self._range(r) for r in ranges]
+
+    def batch_update(self, data: List[Dict[str, Any]]) -> None:
+        self.writes += len(data)
+
+    def row_values(self, row: int) -> List[str]:
+        return list(self.grid[row - 1])
+
+    def col_values(self, col: int) -> List[str]:
+        values = [r[col - 1] if col - 1 < len(r) else "" for r in self.grid]
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def get_all_values(self) -> List[List[str]]:
+        return [list(r) for r in self.grid]
+
+class FakeSekaiBest:
+    # sekai_api._aget_data の代わりに、生成済みのランキングと時刻一覧を返す
+    def __init__(self, rankings: List[Dict[str, Any]], times: List[str]) -> None:
+        self.rankings = rankings
+        self.times = times
+        self.requests = 0
+
+    async def __call__(self, path: str, params: Optional[Dict[str, Any]] = None) -> Any:
+        self.requests += 1
+        if path.endswith("/time"):
+            return self.times
+        return {"eventRankings": self.rankings}
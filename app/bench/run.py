@@ -0,0 +1,225 @@
+# run.py
+# ホットパスのベンチマーク。Sheets と sekai.best はプロセス内のスタンドインで置き換える。
+#
+#   python bench/run.py                          # 結果 JSON を標準出力へ
+#   python bench/run.py -o bench/baseline.json   # ベースラインとして保存
+#   python bench/run.py --compare bench/baseline.json --threshold 0.25
+#
+# --compare では中央値がベースラインより threshold 以上遅いケースがあると終了コード 1 を返す。
+from __future__ import annotations
+import argparse
+import asyncio
+import atexit
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from statistics import median
+from typing import Any, Callable, Dict, List, Optional
+
+_HERE = Path(__file__).resolve().parent
+_TMP = Path(tempfile.mkdtemp(prefix="prsk-bench-"))
+atexit.register(shutil.rmtree, _TMP, ignore_errors=True)
+# モジュールの import 時に読まれるパスは、実データを汚さないよう先に一時ディレクトリへ向ける。
+# 本番の環境変数が設定されたシェルから実行しても上書きされるよう setdefault は使わない
+os.environ["STORAGE_DB"] = str(_TMP / "store.sqlite3")
+os.environ["STORAGE_JSON"] = str(_TMP / "config_store.json")
+os.environ["RANKING_HISTORY_DIR"] = str(_TMP / "history")
+os.environ["SEKAI_CACHE_DIR"] = str(_TMP / "cache")
+os.environ["SHEET_WRITE_JOURNAL"] = str(_TMP / "journal.json")
+os.environ["CHECKPOINT_PATH"] = str(_TMP / "warm_state.json.gz")
+sys.path.insert(0, str(_HERE.parent / "src"))
+sys.path.insert(0, str(_HERE))
+
+import fixtures  # noqa: E402
+import gspread_manager  # noqa: E402
+import ptlogger  # noqa: E402
+import ranking_fetcher  # noqa: E402
+import sekai_api  # noqa: E402
+import shift_manager  # noqa: E402
+import storage  # noqa: E402
+
+START = datetime(2025, 8, 25, 15, 0, tzinfo=fixtures.JST)
+
+def _measure(fn: Callable[[], Any], repeat: int, min_time: float) -> Dict[str, Any]:
+    # timeit.autorange と同じ要領で 1 回の計測が min_time 以上になる回数を決める
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - t0
+        if elapsed >= min_time or number >= 1_000_000:
+            break
+        number *= 2 if elapsed == 0 else max(2, min(10, int(min_time / elapsed) + 1))
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - t0) / number * 1e6)
+    return {
+        "median_us": round(median(samples), 3),
+        "min_us": round(min(samples), 3),
+        "max_us": round(max(samples), 3),
+        "number": number,
+        "repeat": repeat,
+    }
+
+def bench_extract_scores() -> Dict[str, Callable[[], Any]]:
+    rankings = fixtures.make_rankings(10_000)
+    targets = fixtures.make_targets(rankings, 30)
+    target_set = sekai_api.classify_targets(targets)
+    index = sekai_api.RankingIndex(rankings)
+    return {
+        "extract_scores.list_10k": lambda: sekai_api.extract_scores(rankings, target_set),
+        "extract_scores.index_10k": lambda: sekai_api.extract_scores(index, target_set),
+    }
+
+def bench_pick_hourly() -> Dict[str, Callable[[], Any]]:
+    times = fixtures.make_times(START, days=10)
+    return {"pick_hourly.10d_1min": lambda: sekai_api.pick_hourly(times)}
+
+def bench_ptlogger() -> Dict[str, Callable[[], Any]]:
+    trackings = [1, 10, 100, "alice", "bob", 7_400_000_000_000_000_000]
+    grid = fixtures.make_pt_grid(START, days=14, interval_minutes=5, trackings=trackings)
+    ws = fixtures.FakeWorksheet(grid)
+    sid = "bench-pt"
+    layout = ptlogger.PtLayout.build(START, 5, len(grid) - 1, grid[0])
+    storage.save_sheet_layout(sid, "PtLogs", layout.to_dict())
+    gspread_manager.load_worksheet = lambda spreadsheet_id, title: ws
+    col_a = ws.col_values(1)
+    col_b = ws.col_values(2)
+    rng = random.Random(0)
+    # 2 行目は初期値 0 が入っているので、3 行目以降の時刻だけを使う
+    stamps = [(START + timedelta(minutes=rng.randint(5, 14 * 24 * 60 - 1))) for _ in range(256)]
+    iso = [s.astimezone(fixtures.ZoneInfo("UTC")).strftime("%Y-%m-%dT%H:%M:%S.000Z") for s in stamps]
+    it_dt = itertools.cycle(stamps)
+    it_iso = itertools.cycle(iso)
+    values = {t: 123_456 for t in trackings}
+    return {
+        "ptlogger.row_for.14d_5min": lambda: layout.row_for(next(it_dt)),
+        "ptlogger.scan_best_row.14d_5min": lambda: ptlogger._scan_best_row(col_a, col_b, next(it_dt)),
+        "ptlogger.write_values.14d_5min": lambda: ptlogger.write_values(sid, next(it_iso), values),
+    }
+
+def bench_shift() -> Dict[str, Callable[[], Any]]:
+    table = fixtures.make_shift_table(START, weeks=4)
+    gspread_manager.load_table_snapshot = lambda spreadsheet_id, sheet_title="Shift": table
+    date_cols = shift_manager.find_date_columns(table[0])
+    tz = fixtures.JST
+    rng = random.Random(0)
+    stamps = itertools.cycle([START + timedelta(hours=rng.randint(0, 28 * 24 - 1)) for _ in range(256)])
+    return {
+        "shift.collect_candidates.4w": lambda: shift_manager.collect_candidates(table, date_cols, tz, 4),
+        "shift.is_auto_period.4w": lambda: shift_manager.is_auto_period("bench-shift", next(stamps)),
+    }
+
+def bench_coerce_values() -> Dict[str, Callable[[], Any]]:
+    cells = fixtures.make_config_cells(1_000)
+
+    def run():
+        for row in cells:
+            gspread_manager._coerce_values(row)
+    return {"gspread_manager.coerce_values.1000_rows": run}
+
+def bench_storage() -> Dict[str, Callable[[], Any]]:
+    ticks = itertools.cycle([f"2025-08-25T{h:02d}:01:00+09:00" for h in range(24)])
+    json_backend = storage._JsonBackend(_TMP / "store.json")
+    return {
+        "storage.mark_tick_if_new.default": lambda: storage.mark_tick_if_new(1, next(ticks)),
+        "storage.mark_tick_if_new.json": lambda: json_backend.mark_tick_if_new(1, next(ticks)),
+    }
+
+def bench_fetch() -> Dict[str, Callable[[], Any]]:
+    rankings = fixtures.make_rankings(120)
+    times = fixtures.make_times(START, days=30)
+    sekai_api._aget_data = fixtures.FakeSekaiBest(rankings, times)
+    targets = sekai_api.classify_targets(fixtures.make_targets(rankings, 12))
+    loop = asyncio.new_event_loop()
+    counter = itertools.count()
+
+    async def one() -> None:
+        # 毎回別のタイムスタンプを使い、キャッシュに当たらない取得→履歴保存→抽出を計測する
+        ts = times[next(counter) % len(times)]
+        ranking_fetcher._cache._values.clear()
+        raw = await ranking_fetcher.fetch_rankings(1, None, ts, fallback=False)
+        sekai_api.extract_scores(raw, targets)
+
+    return {"ranking_fetcher.fetch_extract.top120": lambda: loop.run_until_complete(one())}
+
+SUITES = [bench_extract_scores, bench_pick_hourly, bench_ptlogger, bench_shift,
+          bench_coerce_values, bench_storage, bench_fetch]
+
+def _git_revision() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=_HERE,
+                             capture_output=True, text=True, timeout=5)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+def _compare(results: Dict[str, Any], baseline_path: Path, threshold: float) -> List[str]:
+    baseline = json.loads(baseline_path.read_text(encoding="utf-8")).get("results", {})
+    regressions = []
+    for name, cur in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        ratio = cur["median_us"] / base["median_us"] if base["median_us"] else 1.0
+        cur["baseline_median_us"] = base["median_us"]
+        cur["ratio"] = round(ratio, 3)
+        if ratio > 1 + threshold:
+            regressions.append(f"{name}: {base['median_us']:.1f}us -> {cur['median_us']:.1f}us (x{ratio:.2f})")
+    return regressions
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="prsk_supporter hot-path benchmarks")
+    parser.add_argument("-o", "--output", type=Path, help="結果 JSON の出力先（省略時は標準出力）")
+    parser.add_argument("-k", "--filter", default="", help="名前にこの文字列を含むケースだけ実行する")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="1 回の計測の最短秒数")
+    parser.add_argument("--compare", type=Path, help="比較するベースライン JSON")
+    parser.add_argument("--threshold", type=float, default=0.25, help="許容する遅延の割合")
+    args = parser.parse_args(argv)
+
+    results: Dict[str, Any] = {}
+    for suite in SUITES:
+        for name, fn in suite().items():
+            if args.filter and args.filter not in name:
+                continue
+            results[name] = _measure(fn, args.repeat, args.min_time)
+            print(f"{name:45s} {results[name]['median_us']:>12.2f} us", file=sys.stderr)
+
+    regressions = _compare(results, args.compare, args.threshold) if args.compare else []
+    report = {
+        "meta": {
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "created_at": datetime.now(fixtures.JST).isoformat(timespec="seconds"),
+            "repeat": args.repeat,
+            "min_time": args.min_time,
+        },
+        "results": results,
+        "regressions": regressions,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        args.output.write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+    for line in regressions:
+        print(f"[REGRESSION] {line}", file=sys.stderr)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+# analytics.py
+from __future__ import annotations
+import os
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List, Optional, Tuple, Union
+import numpy as np
+import ranking_history
+import sekai_api
+from timeutils import ensure_aware_jst
+
+WINDOW_HOURS = float(os.environ.get("ANALYTICS_WINDOW_HOURS", "3"))
+_HOUR_US = 3600 * 10**6
+
+Target = Union[int, str]
+
+@dataclass(frozen=True)
+class PaceReport:
+    targets: Tuple[Target, ...]
+    score: np.ndarray
+    velocity: np.ndarray       # 直近 1 時間の pt/h
+    acceleration: np.ndarray   # 1 時間前との速度差（pt/h²）
+    projected: np.ndarray      # 窓全体の平均速度で EventEnd まで伸ばした最終予測
+    runners: Tuple[Target, ...]
+    focus: Tuple[Target, ...]
+    eta_hours: np.ndarray      # [runner, focus]。追いつけない場合は NaN
+    gap: np.ndarray            # [runner, focus]。focus - runner
+    remaining_hours: float
+
+def _score_matrix(rows: np.ndarray, snaps: np.ndarray, targets: Tuple[Target, ...],
+                  names: dict) -> np.ndarray:
+    mat = np.full((len(targets), len(snaps)), np.nan)
+    if not len(rows):
+        return mat
+    col = np.searchsorted(snaps, rows["ts"])
+    score = rows["score"].astype(np.float64)
+    target_set = sekai_api.classify_targets(targets)
+    pos = {t: i for i, t in enumerate(targets)}
+    by_name = {name: uid for uid, name in names.items()}
+    user_keys = [(int(key), pos[t]) for t, key in target_set.user_ids]
+    user_keys += [(by_name[key], pos[t]) for t, key in target_set.names if key in by_name]
+    rank_keys = [(key, pos[t]) for t, key in target_set.ranks]
+    for field, keys in (("user", user_keys), ("rank", rank_keys)):
+        if not keys:
+            continue
+        keys.sort()
+        k = np.array([key for key, _ in keys], dtype=np.int64)
+        idx = np.array([i for _, i in keys], dtype=np.intp)
+        values = rows[field].astype(np.int64)
+        at = np.minimum(np.searchsorted(k, values), len(k) - 1)
+        hit = k[at] == values
+        mat[idx[at[hit]], col[hit]] = score[hit]
+    return mat
+
+def _forward_fill(mat: np.ndarray) -> np.ndarray:
+    valid = ~np.isnan(mat)
+    idx = np.where(valid, np.arange(mat.shape[1]), 0)
+    np.maximum.accumulate(idx, axis=1, out=idx)
+    filled = mat[np.arange(mat.shape[0])[:, None], idx]
+    # 先頭側の欠損は前に値が無いので NaN のまま
+    filled[np.cumsum(valid, axis=1) == 0] = np.nan
+    return filled
+
+def _column_at(snaps: np.ndarray, t: int) -> int:
+    return int(np.searchsorted(snaps, t, side="right")) - 1
+
+def compute(event_id: int, chara_id: Optional[int], runners: List[Target], focus: List[Target],
+            at: str, event_end: Union[str, datetime]) -> Optional[PaceReport]:
+    runners_t = tuple(runners)
+    focus_t = tuple(f for f in focus if f not in runners_t)
+    targets = runners_t + focus_t
+    if not targets:
+        return None
+    now_us = sekai_api._iso_to_micros(at)
+    window_us = int(WINDOW_HOURS * _HOUR_US)
+    # 読むのは直近の窓だけなので、イベントの経過時間に関係なく計算量は一定
+    rows = ranking_history.store.between_micros(event_id, chara_id, now_us - window_us, now_us)
+    if not len(rows):
+        return None
+    snaps = np.unique(rows["ts"])
+    names = ranking_history.store.user_names(event_id, chara_id)
+    mat = _forward_fill(_score_matrix(rows, snaps, targets, names))
+
+    j0 = len(snaps) - 1
+    t0 = snaps[j0]
+    j1 = _column_at(snaps, t0 - _HOUR_US)
+    j2 = _column_at(snaps, t0 - 2 * _HOUR_US)
+    score = mat[:, j0]
+    nan = np.full(len(targets), np.nan)
+    if j1 >= 0:
+        h01 = (t0 - snaps[j1]) / _HOUR_US
+        velocity = (score - mat[:, j1]) / h01
+    else:
+        velocity = nan
+    if j1 >= 0 and j2 >= 0 and j2 < j1:
+        h12 = (snaps[j1] - snaps[j2]) / _HOUR_US
+        prev_velocity = (mat[:, j1] - mat[:, j2]) / h12
+        mid_gap = ((t0 + snaps[j1]) - (snaps[j1] + snaps[j2])) / 2 / _HOUR_US
+        acceleration = (velocity - prev_velocity) / mid_gap
+    else:
+        acceleration = nan
+
+    # 最終予測は 1 時間速度より揺れの少ない窓全体の平均速度を使う
+    valid = ~np.isnan(mat)
+    first = np.argmax(valid, axis=1)
+    first_score = mat[np.arange(len(targets)), first]
+    span_h = (t0 - snaps[first]) / _HOUR_US
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_velocity = np.where(span_h > 0, (score - first_score) / span_h, np.nan)
+    mean_velocity = np.where(np.isnan(mean_velocity), velocity, mean_velocity)
+    end = ensure_aware_jst(event_end)
+    remaining_h = max(0.0, (end.timestamp() * 10**6 - t0) / _HOUR_US)
+    projected = score + np.clip(mean_velocity, 0, None) * remaining_h
+
+    r = np.arange(len(runners_t))
+    f = np.arange(len(runners_t), len(targets))
+    gap = score[f][None, :] - score[r][:, None]
+    closing = mean_velocity[r][:, None] - mean_velocity[f][None, :]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        eta = np.where((gap > 0) & (closing > 0), gap / closing, np.nan)
+
+    return PaceReport(targets, score, velocity, acceleration, projected,
+                      runners_t, focus_t, eta, gap, remaining_h)
+
+def _fmt(v: float, signed: bool = False) -> str:
+    return f"{v:+,.0f}" if signed else f"{v:,.0f}"
+
+def format_lines(report: Optional[PaceReport]) -> List[str]:
+    if report is None:
+        return []
+    lines = []
+    for i, t in enumerate(report.targets):
+        v, a, p = report.velocity[i], report.acceleration[i], report.projected[i]
+        if np.isnan(v):
+            continue
+        accel = f"、加速 {_fmt(a, True)}/h²" if not np.isnan(a) else ""
+        proj = f" → 最終予測 {_fmt(p)}" if not np.isnan(p) and report.remaining_hours > 0 else ""
+        lines.append(f"{t}: 時速 {_fmt(v, True)}{accel}{proj}")
+    for ri, rt in enumerate(report.runners):
+        for fi, ft in enumerate(report.focus):
+            gap = report.gap[ri, fi]
+            if np.isnan(gap) or gap <= 0:
+                continue
+            eta = report.eta_hours[ri, fi]
+            if np.isnan(eta):
+                lines.append(f"{rt} → {ft}: 現在のペースでは追いつけません")
+            elif eta > report.remaining_hours:
+                lines.append(f"{rt} → {ft}: 終了までに追いつけません")
+            else:
+                h, m = divmod(int(round(eta * 60)), 60)
+                lines.append(f"{rt} → {ft}: 約{h}時間{m:02d}分で追いつきます")
+    return ["📈 ペース"] + lines if lines else []
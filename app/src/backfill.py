@@ -0,0 +1,144 @@
+# backfill.py
+from __future__ import annotations
+import asyncio
+import os
+from datetime import timedelta
+from typing import Any, Dict, Optional
+import ptlogger
+import ranking_fetcher
+import sekai_api
+import sheets_quota
+import storage
+from timeutils import ensure_aware_jst, now_jst, JST
+
+BACKFILL_CONCURRENCY = int(os.environ.get("BACKFILL_CONCURRENCY", "4"))
+BACKFILL_CHUNK_ROWS = int(os.environ.get("BACKFILL_CHUNK_ROWS", "48"))
+
+def _state_key(guild_id: int) -> str:
+    return f"backfill:{guild_id}"
+
+def _to_jst(ts: str):
+    return ensure_aware_jst(ts).astimezone(JST)
+
+async def backfill_guild(guild_id: int, cfg: dict) -> Dict[str, Any]:
+    spreadsheet_id = cfg.get("SpreadsheetID")
+    trackings = cfg.get("Trackings") or []
+    if not spreadsheet_id or not trackings or not cfg.get("EventID"):
+        return {"status": "skip"}
+
+    layout = await asyncio.to_thread(ptlogger.load_layout, spreadsheet_id)
+    if layout is None:
+        return {"status": "no-layout"}
+
+    # 進捗はシートのレイアウトごとに保存し、途中で止まっても次回は続きの行から再開する
+    state = await asyncio.to_thread(storage.load_state, _state_key(guild_id)) or {}
+    if state.get("checksum") != layout.checksum:
+        state = {"checksum": layout.checksum, "next_row": 3}
+    first_row = max(3, int(state.get("next_row", 3)))
+    # 直近の tick は通常のスケジューラが書き込むので対象外にする
+    until = min(now_jst() - timedelta(minutes=2), ensure_aware_jst(cfg["EventEnd"]))
+    last_row = layout.last_row_until(until)
+    if last_row < first_row:
+        return {"status": "up-to-date"}
+
+    with sheets_quota.priority("logging"):
+        missing = await asyncio.to_thread(
+            ptlogger.find_missing_cells, spreadsheet_id, trackings, first_row, until
+        )
+
+    async def save_progress(next_row: int) -> None:
+        state["next_row"] = next_row
+        await asyncio.to_thread(storage.save_state, _state_key(guild_id), state)
+
+    if not missing:
+        await save_progress(last_row + 1)
+        return {"status": "complete", "rows": 0}
+
+    chara_id = cfg.get("CharaID") if cfg.get("isWorldBloom") else None
+    series = await ranking_fetcher.fetch_time_series(cfg["EventID"], chara_id)
+    tolerance = timedelta(minutes=min(layout.interval_minutes / 2, 30))
+    plan: Dict[int, str] = {}
+    for row in sorted(missing):
+        ts = series.nearest_raw(layout.time_at_row(row), tolerance)
+        # スナップショットが隣の行に吸われる場合は書き込まない
+        if ts and layout.row_for(_to_jst(ts)) == row:
+            plan[row] = ts
+
+    target_set = sekai_api.classify_targets(tuple(trackings))
+    sem = asyncio.Semaphore(BACKFILL_CONCURRENCY)
+
+    async def fetch_row(row: int, ts: str) -> Optional[tuple]:
+        # 例外で取得できなかった行は None（再試行対象）。過去の時刻で中身が空なら
+        # 次回も取れないので values を None にして、未取得として数えるだけにする
+        try:
+            async with sem:
+                raw = await ranking_fetcher.fetch_rankings(cfg["EventID"], chara_id, ts, fallback=False)
+        except Exception as e:
+            print(f"[WARN] backfill: {ts} のランキングを取得できませんでした: {type(e).__name__}: {e}")
+            return None
+        if not raw:
+            return ts, None
+        scores = sekai_api.extract_scores(raw, target_set)
+        return ts, {k: scores[k] for k in missing[row] if k in scores}
+
+    # スナップショットが無い行は何度やっても埋まらないので進捗の妨げにしない。
+    # 進捗を止めるのは一時的な失敗（取得時の例外・書き込み失敗）があった行だけ
+    unavailable = sum(1 for row in missing if row not in plan)
+    first_failed: Optional[int] = None
+
+    def fail(row: int) -> None:
+        nonlocal first_failed
+        if first_failed is None or row < first_failed:
+            first_failed = row
+
+    def progress(upto: int) -> int:
+        return upto if first_failed is None else min(upto, first_failed)
+
+    written = 0
+    rows = sorted(plan)
+    for i in range(0, len(rows), BACKFILL_CHUNK_ROWS):
+        chunk = rows[i:i + BACKFILL_CHUNK_ROWS]
+        fetched = await asyncio.gather(*(fetch_row(r, plan[r]) for r in chunk))
+        entry_rows, entries = [], []
+        for row, entry in zip(chunk, fetched):
+            if entry is None:
+                fail(row)
+            elif entry[1] is None:
+                unavailable += 1
+            elif entry[1]:
+                entry_rows.append(row)
+                entries.append(entry)
+        if entries:
+            with sheets_quota.priority("logging"):
+                results = await asyncio.to_thread(ptlogger.write_values_many, spreadsheet_id, entries)
+            for row, res in zip(entry_rows, results):
+                if any(isinstance(status, Exception) for status in res.values()):
+                    fail(row)
+            written += sum(1 for res in results if "written" in res.values())
+        await save_progress(progress(chunk[-1] + 1))
+    await save_progress(progress(last_row + 1))
+    return {"status": "complete" if first_failed is None else "partial", "rows": written,
+            "missing": len(missing), "unavailable": unavailable, "resume_row": progress(last_row + 1)}
+
+async def run_all(configs: Dict[int, dict], concurrency: int = 2) -> Dict[int, Dict[str, Any]]:
+    sem = asyncio.Semaphore(concurrency)
+    now = now_jst()
+
+    async def one(guild_id: int, cfg: dict):
+        try:
+            if ensure_aware_jst(cfg["EventStart"]) > now:
+                return guild_id, {"status": "not-started"}
+        except Exception:
+            return guild_id, {"status": "skip"}
+        async with sem:
+            try:
+                return guild_id, await backfill_guild(guild_id, cfg)
+            except Exception as e:
+                print(f"[WARN] backfill failed for guild {guild_id}: {type(e).__name__}: {e}")
+                return guild_id, {"status": "error", "error": str(e)}
+
+    results = dict(await asyncio.gather(*(one(g, c) for g, c in configs.items())))
+    for guild_id, res in results.items():
+        if res.get("rows"):
+            print(f"[INFO] backfill guild {guild_id}: {res}")
+    return results
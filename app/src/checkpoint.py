@@ -0,0 +1,154 @@
+# checkpoint.py
+from __future__ import annotations
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+from pathlib import Path
+from time import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# 再起動（watchfiles による自動再起動など）をまたいでメモリ上の状態を引き継ぐためのファイル。
+# 複数レプリカを同じディレクトリで動かす場合はレプリカごとに CHECKPOINT_PATH を分ける。
+CHECKPOINT_PATH = Path(os.environ.get("CHECKPOINT_PATH", "warm_state.json.gz"))
+CHECKPOINT_INTERVAL_SEC = float(os.environ.get("CHECKPOINT_INTERVAL_SEC", "60"))
+CHECKPOINT_MAX_AGE_SEC = float(os.environ.get("CHECKPOINT_MAX_AGE_SEC", str(6 * 3600)))
+FORMAT_VERSION = 1
+
+def fingerprint(cfg: Any) -> str:
+    data = cfg.to_dict() if hasattr(cfg, "to_dict") else dict(cfg)
+    raw = json.dumps(data, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def _digest(body: Dict[str, Any]) -> str:
+    raw = json.dumps(body, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class Checkpointer:
+    # 各モジュールが register(name, dump, load) で自分の状態を登録する。
+    # dump はイベントループ上で呼ばれ JSON にできる値を返す。load は復元時に 1 回だけ呼ばれる。
+    def __init__(self, path: Path = CHECKPOINT_PATH, interval_sec: float = CHECKPOINT_INTERVAL_SEC,
+                 max_age_sec: float = CHECKPOINT_MAX_AGE_SEC) -> None:
+        self.path = path
+        self.interval_sec = interval_sec
+        self.max_age_sec = max_age_sec
+        self._sections: Dict[str, Tuple[Callable[[], Any], Callable[[Any], None]]] = {}
+        self._configs: Callable[[], Dict[int, Any]] = dict
+        self._fresh_guilds: Optional[set] = None
+        self._task: Optional[asyncio.Task] = None
+        self._started = False
+        self.restored_at: Optional[float] = None
+
+    def register(self, name: str, dump: Callable[[], Any], load: Callable[[Any], None]) -> None:
+        self._sections[name] = (dump, load)
+
+    def track_configs(self, loader: Callable[[], Dict[int, Any]]) -> None:
+        # ギルド単位の状態は、保存時と設定が変わっていないギルドの分だけ復元する
+        self._configs = loader
+
+    def guild_unchanged(self, guild_id: int) -> bool:
+        return self._fresh_guilds is None or guild_id in self._fresh_guilds
+
+    def collect(self) -> Dict[str, Any]:
+        # dump はループ上の状態を読むのでここだけループ上で呼ぶ。整形とチェックサムは seal() で別スレッドに回す
+        sections: Dict[str, Any] = {}
+        for name, (dump, _) in self._sections.items():
+            try:
+                sections[name] = dump()
+            except Exception as e:
+                print(f"[WARN] checkpoint: {name} の保存をスキップしました: {type(e).__name__}: {e}")
+        return sections
+
+    def seal(self, sections: Dict[str, Any]) -> Dict[str, Any]:
+        body = {
+            "version": FORMAT_VERSION,
+            "created_at": time(),
+            "guilds": {str(gid): fingerprint(cfg) for gid, cfg in self._configs().items()},
+            "sections": sections,
+        }
+        # int キーなどは読み戻すと文字列になるので、チェックサムは JSON を往復させた形で取る
+        body = json.loads(json.dumps(body, ensure_ascii=False))
+        body["sha256"] = _digest(body)
+        return body
+
+    def write(self, body: Dict[str, Any]) -> int:
+        raw = gzip.compress(json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_bytes(raw)
+        os.replace(tmp, self.path)
+        return len(raw)
+
+    def read(self) -> Optional[Dict[str, Any]]:
+        if not self.path.exists():
+            return None
+        try:
+            body = json.loads(gzip.decompress(self.path.read_bytes()).decode("utf-8"))
+        except Exception as e:
+            print(f"[WARN] checkpoint: {self.path} を読み込めませんでした: {type(e).__name__}: {e}")
+            return None
+        if not isinstance(body, dict) or body.get("version") != FORMAT_VERSION:
+            print(f"[WARN] checkpoint: 形式が異なるため無視します（version={body.get('version') if isinstance(body, dict) else None}）")
+            return None
+        digest = body.pop("sha256", None)
+        if digest != _digest(body):
+            print("[WARN] checkpoint: チェックサムが一致しないため無視します")
+            return None
+        age = time() - float(body.get("created_at") or 0)
+        if not 0 <= age <= self.max_age_sec:
+            print(f"[INFO] checkpoint: {age:.0f} 秒前のものなので使いません")
+            return None
+        return body
+
+    def _persist(self, sections: Dict[str, Any]) -> int:
+        return self.write(self.seal(sections))
+
+    async def save(self) -> Optional[int]:
+        sections = self.collect()
+        try:
+            return await asyncio.to_thread(self._persist, sections)
+        except Exception as e:
+            print(f"[WARN] checkpoint の書き込みに失敗しました: {type(e).__name__}: {e}")
+            return None
+
+    async def restore(self) -> bool:
+        body = await asyncio.to_thread(self.read)
+        if body is None:
+            return False
+        saved = body.get("guilds") or {}
+        current = await asyncio.to_thread(self._configs)
+        self._fresh_guilds = {gid for gid, cfg in current.items() if saved.get(str(gid)) == fingerprint(cfg)}
+        sections = body.get("sections") or {}
+        for name, (_, load) in self._sections.items():
+            if name not in sections:
+                continue
+            try:
+                load(sections[name])
+            except Exception as e:
+                print(f"[WARN] checkpoint: {name} を復元できませんでした: {type(e).__name__}: {e}")
+        self.restored_at = float(body["created_at"])
+        print(f"[INFO] checkpoint: {time() - self.restored_at:.0f} 秒前の状態を復元しました"
+              f"（{len(self._fresh_guilds)}/{len(current)} guilds）")
+        return True
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval_sec)
+            await self.save()
+
+    def start(self) -> None:
+        self._started = True
+        if self.interval_sec > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._loop(), name="checkpoint")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        # 復元前（on_ready 前）に止まった場合は、前回のチェックポイントを空の状態で上書きしない
+        if self._started:
+            await self.save()
+
+checkpointer = Checkpointer()
+register = checkpointer.register
+guild_unchanged = checkpointer.guild_unchanged
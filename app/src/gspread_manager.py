@@ -1,10 +1,35 @@
 import gspread
+from google.auth.transport.requests import Request
 from google.oauth2.service_account import Credentials
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterator, List, Optional
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import re
 import json
 import os
+import threading
+import time
+import checkpoint
+import metrics
+import sheets_quota
+
+try:
+    from gspread.http_client import HTTPClient
+except ImportError:  # gspread < 6
+    HTTPClient = None
+
+if HTTPClient is not None:
+    class _QuotaHTTPClient(HTTPClient):
+        def request(self, method, *args, **kwargs):
+            op = "read" if str(method).upper() == "GET" else "write"
+            send = super().request
+
+            def timed(*a, **kw):
+                with metrics.track("sheets", op):
+                    return send(*a, **kw)
+            return sheets_quota.call(timed, method, *args, **kwargs)
 
 SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets",
@@ -13,20 +38,238 @@ SCOPES = [
 SERVICE_ACCOUNT_KEY = "./keys/rock-perception-419201-eb5dbe72985b.json"
 load_dotenv(override=False)
 
+class _ClientManager:
+    def __init__(self, max_handles: int = 128, refresh_margin: timedelta = timedelta(minutes=5)) -> None:
+        self.max_handles = max_handles
+        self.refresh_margin = refresh_margin
+        self._lock = threading.RLock()
+        self._creds: Optional[Credentials] = None
+        self._client: Optional[gspread.Client] = None
+        self._handles: "OrderedDict[tuple, Any]" = OrderedDict()
+
+    def client(self) -> gspread.Client:
+        with self._lock:
+            if self._client is None:
+                service_account_key = os.environ["SERVICE_ACCOUNT_KEY"]
+                self._creds = Credentials.from_service_account_file(service_account_key, scopes=SCOPES)
+                if HTTPClient is not None:
+                    self._client = gspread.authorize(self._creds, http_client=_QuotaHTTPClient)
+                else:
+                    gc = gspread.authorize(self._creds)
+                    raw_request = gc.request
+                    gc.request = lambda *a, **kw: sheets_quota.call(raw_request, *a, **kw)
+                    self._client = gc
+            creds = self._creds
+            # 期限切れ直前のトークンで API を叩いて 401 → 再送にならないよう先に更新する
+            if not creds.valid or (creds.expiry and creds.expiry - datetime.utcnow() < self.refresh_margin):
+                creds.refresh(Request())
+            return self._client
+
+    def _get(self, key: tuple):
+        handle = self._handles.get(key)
+        if handle is not None:
+            self._handles.move_to_end(key)
+        return handle
+
+    def _put(self, key: tuple, handle: Any) -> None:
+        self._handles[key] = handle
+        self._handles.move_to_end(key)
+        while len(self._handles) > self.max_handles:
+            self._handles.popitem(last=False)
+
+    def spreadsheet(self, spreadsheet_id: str) -> gspread.Spreadsheet:
+        gc = self.client()
+        with self._lock:
+            sh = self._get((spreadsheet_id, None))
+            if sh is None:
+                sh = gc.open_by_key(spreadsheet_id)
+                self._put((spreadsheet_id, None), sh)
+            return sh
+
+    def worksheet(self, spreadsheet_id: str, title: str) -> gspread.Worksheet:
+        with self._lock:
+            ws = self._get((spreadsheet_id, title))
+            if ws is not None:
+                return ws
+        sh = self.spreadsheet(spreadsheet_id)
+        try:
+            ws = sh.worksheet(title)
+        except gspread.exceptions.WorksheetNotFound:
+            self.invalidate(spreadsheet_id, title)
+            raise
+        with self._lock:
+            self._put((spreadsheet_id, title), ws)
+        return ws
+
+    def remember_worksheet(self, spreadsheet_id: str, ws: gspread.Worksheet) -> None:
+        with self._lock:
+            self._put((spreadsheet_id, ws.title), ws)
+
+    def invalidate(self, spreadsheet_id: str, title: Optional[str] = None) -> None:
+        with self._lock:
+            if title is not None:
+                self._handles.pop((spreadsheet_id, title), None)
+                return
+            for key in [k for k in self._handles if k[0] == spreadsheet_id]:
+                self._handles.pop(key, None)
+
+_manager = _ClientManager()
+
 def load_sheet(spreadsheet_id: str):
-    service_account_key = os.environ["SERVICE_ACCOUNT_KEY"]
-    creds = Credentials.from_service_account_file(service_account_key, scopes=SCOPES)
-    gc = gspread.authorize(creds)
-    sh = gc.open_by_key(spreadsheet_id)
-    return sh
+    return _manager.spreadsheet(spreadsheet_id)
+
+def load_worksheet(spreadsheet_id: str, sheet_title: str):
+    return _manager.worksheet(spreadsheet_id, sheet_title)
+
+def invalidate_sheet(spreadsheet_id: str, sheet_title: Optional[str] = None) -> None:
+    _manager.invalidate(spreadsheet_id, sheet_title)
 
 def load_table(spreadsheet_id, 
                sheet_title = "Shift"):
-    sh = load_sheet(spreadsheet_id)
-    ws = sh.worksheet(sheet_title)
-    data = ws.get_all_values()
+    ws = load_worksheet(spreadsheet_id, sheet_title)
+    try:
+        data = ws.get_all_values()
+    except gspread.exceptions.APIError:
+        # シートが削除・再作成された場合に古いハンドルを使い続けないようにする
+        invalidate_sheet(spreadsheet_id, sheet_title)
+        raise
     return normalize_table(data)
 
+SNAPSHOT_REVALIDATE_SEC = float(os.environ.get("SHEET_SNAPSHOT_REVALIDATE_SEC", "60"))
+SNAPSHOT_TTL_SEC = float(os.environ.get("SHEET_SNAPSHOT_TTL_SEC", "1800"))
+
+def _modified_time(sh) -> Optional[str]:
+    getter = getattr(sh, "get_lastUpdateTime", None)
+    if getter is not None:
+        return getter()
+    return getattr(sh, "lastUpdateTime", None)
+
+class _SnapshotCache:
+    def __init__(self, revalidate_sec: float = SNAPSHOT_REVALIDATE_SEC, ttl_sec: float = SNAPSHOT_TTL_SEC) -> None:
+        self.revalidate_sec = revalidate_sec
+        self.ttl_sec = ttl_sec
+        self._lock = threading.Lock()
+        self._entries: Dict[tuple, Dict[str, Any]] = {}
+        self.stats = {"hits": 0, "revalidated": 0, "misses": 0, "bytes_saved": 0, "bytes_fetched": 0}
+
+    def get(self, spreadsheet_id: str, sheet_title: str) -> List[List[str]]:
+        key = (spreadsheet_id, sheet_title)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+        modified = None
+        if entry is not None and now - entry["fetched_at"] < self.ttl_sec:
+            if now - entry["checked_at"] < self.revalidate_sec:
+                self._count("hits", entry["nbytes"])
+                return entry["data"]
+            try:
+                modified = _modified_time(load_sheet(spreadsheet_id))
+            except Exception:
+                modified = None
+            if modified is not None and modified == entry["modified"]:
+                with self._lock:
+                    entry["checked_at"] = now
+                self._count("revalidated", entry["nbytes"])
+                return entry["data"]
+        else:
+            # 再検証で更新日時を取得済みの場合は、メタデータを二度取りに行かない
+            try:
+                modified = _modified_time(load_sheet(spreadsheet_id))
+            except Exception:
+                modified = None
+        data = load_table(spreadsheet_id, sheet_title)
+        nbytes = len(json.dumps(data, ensure_ascii=False).encode("utf-8"))
+        with self._lock:
+            self._entries[key] = {"data": data, "modified": modified, "fetched_at": now,
+                                  "checked_at": now, "nbytes": nbytes}
+            self.stats["misses"] += 1
+            self.stats["bytes_fetched"] += nbytes
+        return data
+
+    def _count(self, kind: str, nbytes: int) -> None:
+        with self._lock:
+            self.stats[kind] += 1
+            self.stats["bytes_saved"] += nbytes
+
+    def invalidate(self, spreadsheet_id: str, sheet_title: Optional[str] = None) -> None:
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == spreadsheet_id and sheet_title in (None, k[1])]:
+                self._entries.pop(key, None)
+
+    @contextmanager
+    def own_write(self, spreadsheet_id: str, sheet_title: str) -> Iterator[None]:
+        # 更新日時はスプレッドシート全体で 1 つなので、PtLogs への記録のたびに Shift の再取得が起きてしまう。
+        # 書き込みの前後で更新日時を取り、前の値がスナップショットと一致していれば
+        # 間の更新はこの書き込みによるものとみなして、他シートのスナップショットを後の値に付け替える
+        with self._lock:
+            watched = [k for k in self._entries if k[0] == spreadsheet_id and k[1] != sheet_title]
+        if not watched:
+            yield
+            return
+        try:
+            before = _modified_time(load_sheet(spreadsheet_id))
+        except Exception:
+            before = None
+        yield
+        if before is None:
+            return
+        try:
+            after = _modified_time(load_sheet(spreadsheet_id))
+        except Exception:
+            return
+        if after is None or after == before:
+            return
+        with self._lock:
+            for key in watched:
+                entry = self._entries.get(key)
+                if entry is not None and entry["modified"] == before:
+                    entry["modified"] = after
+
+    def dump_state(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            entries = [[sid, title, e["data"], e["modified"], now - e["fetched_at"], e["nbytes"]]
+                       for (sid, title), e in self._entries.items() if now - e["fetched_at"] < self.ttl_sec]
+        return {"saved_at": time.time(), "entries": entries}
+
+    def load_state(self, data: Dict[str, Any]) -> None:
+        # 再起動中の経過時間も年齢に含め、最初の参照では必ず更新日時で再検証させる
+        now = time.monotonic()
+        elapsed = max(0.0, time.time() - float(data.get("saved_at") or 0))
+        with self._lock:
+            for sid, title, table, modified, age, nbytes in data.get("entries") or []:
+                fetched_at = now - age - elapsed
+                if now - fetched_at >= self.ttl_sec or modified is None:
+                    continue
+                self._entries.setdefault((sid, title), {
+                    "data": table, "modified": modified, "fetched_at": fetched_at,
+                    "checked_at": now - self.revalidate_sec, "nbytes": nbytes,
+                })
+
+    def snapshot_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out = dict(self.stats)
+            out["entries"] = len(self._entries)
+        served = out["hits"] + out["revalidated"]
+        total = served + out["misses"]
+        out["hit_rate"] = served / total if total else 0.0
+        return out
+
+_snapshots = _SnapshotCache()
+checkpoint.register("sheet_snapshots", _snapshots.dump_state, _snapshots.load_state)
+
+def load_table_snapshot(spreadsheet_id, sheet_title="Shift"):
+    return _snapshots.get(spreadsheet_id, sheet_title)
+
+def invalidate_snapshot(spreadsheet_id: str, sheet_title: Optional[str] = None) -> None:
+    _snapshots.invalidate(spreadsheet_id, sheet_title)
+
+def own_write(spreadsheet_id: str, sheet_title: str):
+    return _snapshots.own_write(spreadsheet_id, sheet_title)
+
+def snapshot_stats() -> Dict[str, Any]:
+    return _snapshots.snapshot_stats()
+
 def normalize_table(data):
     if not data:
         return []
@@ -36,6 +279,11 @@ def normalize_table(data):
     return data
 
 def create_sheet(sh, sheet_title, total_rows, total_cols, *, resize_if_smaller=False):
+    ws = _create_sheet(sh, sheet_title, total_rows, total_cols, resize_if_smaller=resize_if_smaller)
+    _manager.remember_worksheet(sh.id, ws)
+    return ws
+
+def _create_sheet(sh, sheet_title, total_rows, total_cols, *, resize_if_smaller=False):
     try:
         ws = sh.worksheet(sheet_title)
         if resize_if_smaller and (ws.row_count < total_rows or ws.col_count < total_cols):
@@ -115,8 +363,7 @@ def _coerce_values(cells: List[str]) -> Any:
     return [_coerce_scalar(v) for v in vals]
 
 def read_config_values(spreadsheet_id: str, sheet_name: str = "Config") -> Dict[str, Any]:
-    ws = load_sheet(spreadsheet_id).worksheet(sheet_name)
-    rows = ws.get_all_values()
+    rows = load_table(spreadsheet_id, sheet_name)
     config: Dict[str, Any] = {}
     for row in rows:
         if not row:
@@ -0,0 +1,156 @@
+# guild_config.py
+from __future__ import annotations
+import re
+from dataclasses import dataclass
+from datetime import datetime
+from types import MappingProxyType
+from typing import Any, FrozenSet, Mapping, Optional, Tuple, Union
+import sekai_api
+from timeutils import ensure_aware_jst
+
+Target = Union[int, str]
+
+# MultiMinuteRegistry.every_hour_at_config で使うキー。コンパイル時にビット集合へ変換しておく
+MINUTE_KEYS = ("LogMinutes", "AutoMinutes", "ChangeNotice", "NextServer")
+
+def coerce_minutes(val) -> list[int]:
+    out: list[int] = []
+    def add_one(x):
+        try:
+            m = int(x)
+            if 0 <= m <= 59:
+                out.append(m)
+        except Exception:
+            pass
+    if val is None:
+        pass
+    elif isinstance(val, (int, float)):
+        add_one(val)
+    elif isinstance(val, str):
+        for tok in re.findall(r"\d+", val):
+            add_one(tok)
+    elif isinstance(val, (list, tuple, set)):
+        for item in val:
+            if isinstance(item, (int, float)):
+                add_one(item)
+            elif isinstance(item, str):
+                for tok in re.findall(r"\d+", item):
+                    add_one(tok)
+    return sorted(set(out))
+
+def log_interval(val) -> int:
+    try:
+        interval = int(val)
+    except (TypeError, ValueError):
+        return 60
+    return interval if 0 < interval <= 60 else 60
+
+def log_minutes(interval: int) -> list[int]:
+    return sorted(set((m + 1) % 60 for m in range(0, 60, interval)))
+
+def minute_mask(minutes) -> int:
+    mask = 0
+    for m in minutes:
+        mask |= 1 << m
+    return mask
+
+def mask_minutes(mask: int) -> Tuple[int, ...]:
+    return tuple(m for m in range(60) if mask >> m & 1)
+
+def is_player(t) -> bool:
+    if isinstance(t, str):
+        return True
+    return isinstance(t, int) and len(str(abs(t))) >= 15
+
+def _targets(val) -> Tuple[Target, ...]:
+    if val is None or val == "":
+        return ()
+    if isinstance(val, (list, tuple)):
+        return tuple(val)
+    return (val,)
+
+@dataclass(frozen=True, slots=True, eq=False)
+class GuildConfig:
+    # Config シートの値を /setup 時に一度だけ解釈したもの。tick ごとの処理はここを参照するだけにする。
+    # 元の dict は raw に読み取り専用で保持し、get / [] で従来どおり参照できる。
+    raw: Mapping[str, Any]
+    event_id: int
+    chara_id: Optional[int]
+    event_name: Optional[str]
+    spreadsheet_id: Optional[str]
+    channel_id: Optional[int]
+    start: datetime
+    end: datetime
+    log_interval: int
+    log_minutes: Tuple[int, ...]
+    trackings: Tuple[Target, ...]
+    focus: Tuple[Target, ...]
+    all_targets: Tuple[Target, ...]
+    target_set: sekai_api.TargetSet
+    tracking_set: FrozenSet[Target]
+    focus_set: FrozenSet[Target]
+    players: Tuple[Target, ...]
+    player_set: FrozenSet[Target]
+    runner_count: int
+    minute_masks: Mapping[str, int]
+
+    @classmethod
+    def compile(cls, cfg: Union[Mapping[str, Any], "GuildConfig"]) -> "GuildConfig":
+        if isinstance(cfg, GuildConfig):
+            return cfg
+        raw = dict(cfg)
+        chara_id = raw.get("CharaID") if raw.get("isWorldBloom") else None
+        interval = log_interval(raw.get("LogInterval", 60))
+        trackings = _targets(raw.get("Trackings"))
+        focus = _targets(raw.get("Focus"))
+        all_targets = trackings + tuple(f for f in focus if f not in trackings)
+        runners = raw.get("Runners")
+        masks = {key: minute_mask(coerce_minutes(raw.get(key))) for key in MINUTE_KEYS}
+        channel_id = raw.get("ChannelID")
+        return cls(
+            raw=MappingProxyType(raw),
+            event_id=int(raw["EventID"]),
+            chara_id=int(chara_id) if chara_id else None,
+            event_name=raw.get("EventName"),
+            spreadsheet_id=raw.get("SpreadsheetID"),
+            channel_id=int(channel_id) if channel_id else None,
+            start=ensure_aware_jst(raw["EventStart"]),
+            end=ensure_aware_jst(raw["EventEnd"]),
+            log_interval=interval,
+            log_minutes=tuple(log_minutes(interval)),
+            trackings=trackings,
+            focus=focus,
+            all_targets=all_targets,
+            target_set=sekai_api.classify_targets(all_targets),
+            tracking_set=frozenset(trackings),
+            focus_set=frozenset(focus),
+            players=tuple(t for t in all_targets if is_player(t)),
+            player_set=frozenset(t for t in all_targets if is_player(t)),
+            runner_count=len(runners) if isinstance(runners, list) else (1 if runners else 0),
+            minute_masks=MappingProxyType(masks),
+        )
+
+    @property
+    def event_key(self) -> Tuple[int, int]:
+        return self.event_id, self.chara_id or 0
+
+    def minutes(self, key: str) -> Tuple[int, ...]:
+        mask = self.minute_masks.get(key)
+        if mask is None:
+            return tuple(coerce_minutes(self.raw.get(key)))
+        return mask_minutes(mask)
+
+    def fires_at(self, key: str, minute: int) -> bool:
+        return bool(self.minute_masks.get(key, 0) >> minute & 1)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.raw.get(key, default)
+
+    def __getitem__(self, key: str) -> Any:
+        return self.raw[key]
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.raw
+
+    def to_dict(self) -> dict:
+        return dict(self.raw)
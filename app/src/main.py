@@ -1,7 +1,8 @@
 import os
 import logging
 import asyncio, random
-from typing import Iterable, Tuple
+import signal
+from typing import Iterable, Optional, Tuple
 import discord
 from discord.ext import commands
 from discord import app_commands
@@ -9,10 +10,21 @@ from dotenv import load_dotenv
 import gspread_manager
 import sekai_api
 import shift_manager
-import ptlogger
 import storage
+import ranking_fetcher
+import analytics
+import backfill
+import publication
+import sheet_writer
+import sheets_quota
+import metrics
+import sheet_provisioner
+import checkpoint
+import sharding
+import snapshot_diff
 from timeutils import ensure_aware_jst, now_jst, JST
 from scheduler import EventScheduler, MultiMinuteRegistry
+from guild_config import GuildConfig
 
 load_dotenv(override=False)
 TOKEN = os.environ["DISCORD_TOKEN"]
@@ -24,7 +36,21 @@ intents = discord.Intents.default()
 if os.environ.get("ENABLE_MESSAGE_CONTENT", "0") == "1":
     intents.message_content = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+class Bot(commands.Bot):
+    async def close(self) -> None:
+        # ジョブを止める前に、次回起動で引き継ぐ状態を書き出す
+        await checkpoint.checkpointer.stop()
+        await shards.stop()
+        await sheet_writer.queue.close()
+        await sekai_api.close_async_session()
+        sekai_api.close_sekai_run_pool()
+        await super().close()
+
+bot = Bot(command_prefix="!", intents=intents)
+
+async def _send(channel, *args, **kwargs):
+    with metrics.track("discord", "send"):
+        return await channel.send(*args, **kwargs)
 
 registry = MultiMinuteRegistry()
 
@@ -34,16 +60,13 @@ async def shift_change(ctx: dict) -> str:
     channel = ctx.get("channel")
     if channel is None:
         return "ChangeNotice(no-channel)"
-    def runner_count(val) -> int:
-        if isinstance(val, list):
-            return len(val)
-        return 1 if val else 0
-
-    max_cols = max(1, 5 - runner_count(cfg.get("Runners")))
-    rows = shift_manager.extract_nearest_shift(
-        cfg.get("SpreadsheetID"),
-        max_shifters_per_block=max_cols,
-    )
+    max_cols = max(1, 5 - cfg.runner_count)
+    with sheets_quota.priority("notices"):
+        rows = await asyncio.to_thread(
+            shift_manager.extract_nearest_shift,
+            cfg.spreadsheet_id,
+            max_shifters_per_block=max_cols,
+        )
 
     lines = []
     for i, item in enumerate(rows, 1):
@@ -56,8 +79,8 @@ async def shift_change(ctx: dict) -> str:
         names = ", ".join(item.get("shifters", [])) or "（割当なし）"
         lines.append(f"{i}. {ts} — {names}")
 
-    msg = f"**ChangeNotice** — {cfg.get('EventName')}\n" + "\n".join(lines)
-    await channel.send(msg)
+    msg = f"**ChangeNotice** — {cfg.event_name}\n" + "\n".join(lines)
+    await _send(channel, msg)
     return "ChangeNotice"
 
 @registry.every_hour_at_config("NextServer")
@@ -66,16 +89,13 @@ async def check_next_server(ctx: dict) -> str:
     channel = ctx.get("channel")
     if channel is None:
         return "NextServer(no-channel)"
-    def runner_count(val) -> int:
-        if isinstance(val, list):
-            return len(val)
-        return 1 if val else 0
-
-    max_cols = max(1, 5 - runner_count(cfg.get("Runners")))
-    rows = shift_manager.extract_nearest_shift(
-        cfg.get("SpreadsheetID"),
-        max_shifters_per_block=max_cols,
-    )
+    max_cols = max(1, 5 - cfg.runner_count)
+    with sheets_quota.priority("notices"):
+        rows = await asyncio.to_thread(
+            shift_manager.extract_nearest_shift,
+            cfg.spreadsheet_id,
+            max_shifters_per_block=max_cols,
+        )
 
     lines = []
     for i, item in enumerate(rows, 1):
@@ -88,8 +108,8 @@ async def check_next_server(ctx: dict) -> str:
         names = ", ".join(item.get("shifters", [])) or "（割当なし）"
         lines.append(f"{i}. {ts} — {names}")
 
-    msg = f"**NextServer** — {cfg.get('EventName')}\n" + "\n".join(lines)
-    await channel.send(msg)
+    msg = f"**NextServer** — {cfg.event_name}\n" + "\n".join(lines)
+    await _send(channel, msg)
     return "NextServer"
 
 def _exp_backoff(attempt: int, base: float = 2.0, cap: float = 15.0, jitter: float = 0.25) -> float:
@@ -105,44 +125,57 @@ async def retry_async(call, *, attempts: int = 3, catch: Tuple[type, ...] = (Exc
             last = e
             if n == attempts:
                 break
+            metrics.inc("retries_total", component="tick")
             await asyncio.sleep(_exp_backoff(n))
     raise last
 from requests.exceptions import Timeout, ReadTimeout, ConnectionError as ReqConnError, RequestException
 
-def _is_player(t) -> bool:
-    if isinstance(t, str):
-        return True
-    return isinstance(t, int) and len(str(abs(t))) >= 15
-
-async def _fetch_all_scores(cfg: dict) -> tuple[dict, str, bool]:
-    if cfg.get("isWorldBloom"):
-        times = sekai_api.get_chapter_time(cfg["EventID"], cfg["CharaID"])
-    else:
-        times = sekai_api.get_event_time(cfg["EventID"])
+async def _fetch_all_scores(cfg: GuildConfig, consumer=None) -> tuple[dict, str, bool, Optional[snapshot_diff.RankingDelta]]:
+    # consumer を渡すと、その利用者が前回処理を終えたスナップショットからの差分も返す。
+    # 既読位置は進めないので、処理が終わったら _commit_delta を呼ぶ。
+    # 最新時刻が前回と同じなら取得もデコードもせず手元のスナップショットを使う。
+    chara_id = cfg.chara_id
+    key = cfg.event_key
+    times = await ranking_fetcher.fetch_times(cfg.event_id, chara_id)
 
+    snap = None
     if times:
         last_time = times[-1]
-        if cfg.get("isWorldBloom"):
-            raw = sekai_api.get_chapter_rankings(cfg["EventID"], cfg["CharaID"], last_time)
+        snap = snapshot_diff.differ.get(key, last_time)
+        if snap is None:
+            raw = await ranking_fetcher.fetch_rankings(cfg.event_id, chara_id, last_time, fallback=False)
+            if raw:
+                snap = snapshot_diff.differ.put(key, last_time, raw)
         else:
-            raw = sekai_api.get_event_rankings(cfg["EventID"], last_time)
+            metrics.inc("snapshot_fetch_skipped_total")
+    if snap is not None:
+        source = snap.index
         used_fallback = False
     else:
-        chara_id = cfg.get("CharaID") if cfg.get("isWorldBloom") else None
-        raw = await asyncio.to_thread(sekai_api._get_leaderboard_sekai_run, chara_id)
-        if not raw:
+        source = await ranking_fetcher.fetch_fallback(chara_id)
+        if not source:
             raise RuntimeError("API unavailable and fallback also failed")
         last_time = now_jst().strftime("%Y-%m-%dT%H:%M:%S%z")
         used_fallback = True
 
-    trackings = cfg.get("Trackings") or []
-    focus_raw = cfg.get("Focus") or []
-    focus_targets = [focus_raw] if isinstance(focus_raw, int) else list(focus_raw)
-    all_targets = trackings + [f for f in focus_targets if f not in trackings]
-    return sekai_api.extract_scores(raw, all_targets), last_time, used_fallback
+    delta = snapshot_diff.differ.delta(consumer, key, last_time) if consumer is not None and snap is not None else None
+    return sekai_api.extract_scores(source, cfg.target_set), last_time, used_fallback, delta
+
+def _commit_delta(cfg: GuildConfig, consumer, delta: Optional[snapshot_diff.RankingDelta]) -> None:
+    if delta is not None:
+        snapshot_diff.differ.commit(consumer, cfg.event_key, delta.ts)
 
 _auto_prev_scores: dict[int, dict] = {}
 
+def _dump_auto_prev() -> dict:
+    # Trackings のキーは順位・userId（int）と名前（str）が混在するので組で保存する
+    return {str(gid): [[k, v] for k, v in scores.items()] for gid, scores in _auto_prev_scores.items()}
+
+def _load_auto_prev(data: dict) -> None:
+    for gid, pairs in data.items():
+        if checkpoint.guild_unchanged(int(gid)):
+            _auto_prev_scores.setdefault(int(gid), {k: v for k, v in pairs})
+
 class PointInputModal(discord.ui.Modal):
     point = discord.ui.TextInput(
         label="現在のポイント",
@@ -162,18 +195,25 @@ class PointInputModal(discord.ui.Modal):
         except ValueError:
             await interaction.response.send_message("数値を入力してください。", ephemeral=True)
             return
-        try:
-            await asyncio.to_thread(
-                ptlogger.write_values,
-                self.spreadsheet_id,
-                self.timestamp,
-                {self.tracking_key: score},
-            )
-            await interaction.response.send_message(
-                f"✅ {self.tracking_key} のポイント {score:,} を記録しました。", ephemeral=True
-            )
-        except Exception as e:
-            await interaction.response.send_message(f"記録に失敗しました: {e}", ephemeral=True)
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        result = await sheet_writer.enqueue(
+            self.spreadsheet_id,
+            self.timestamp,
+            {self.tracking_key: score},
+            priority="interactive",
+        )
+        status = result.get(self.tracking_key)
+        if status == "written":
+            msg = f"✅ {self.tracking_key} のポイント {score:,} を記録しました。"
+        elif status == "filled":
+            msg = f"{self.tracking_key} のセルは既に埋まっているため記録しませんでした。"
+        elif isinstance(status, ValueError):
+            msg = f"記録できませんでした: {status}"
+        elif isinstance(status, Exception):
+            msg = f"記録に失敗しました（自動で再試行します）: {status}"
+        else:
+            msg = f"記録に失敗しました: {status}"
+        await interaction.followup.send(msg, ephemeral=True)
 
 class PointInputButton(discord.ui.Button):
     def __init__(self, tracking_key, spreadsheet_id: str, timestamp: str):
@@ -197,28 +237,29 @@ class MissingUsersView(discord.ui.View):
 async def ranking_logger(ctx: dict) -> str:
     cfg = ctx["config"]
     channel = ctx.get("channel")
+    consumer = ("log", ctx["guild_id"])
     async def _run_once():
-        all_scores, last_time, used_fallback = await _fetch_all_scores(cfg)
-
-        trackings = cfg.get("Trackings") or []
-        focus_raw = cfg.get("Focus") or []
-        focus_targets = [focus_raw] if isinstance(focus_raw, int) else list(focus_raw)
+        all_scores, last_time, used_fallback, delta = await _fetch_all_scores(cfg, consumer)
+        if delta is not None and delta.unchanged:
+            # 前回記録したスナップショットのままなので、書き込みも通知もやり直さない
+            return f"更新なし（{last_time}）"
 
-        rankings = {k: v for k, v in all_scores.items() if k in trackings}
-        focus_scores = {k: v for k, v in all_scores.items() if k in focus_targets}
+        rankings = {k: v for k, v in all_scores.items() if k in cfg.tracking_set}
+        focus_scores = {k: v for k, v in all_scores.items() if k in cfg.focus_set}
 
-        ptlogger.write_values(cfg["SpreadsheetID"], last_time, rankings)
+        sheet_writer.enqueue(cfg.spreadsheet_id, last_time, rankings)
 
-        missing = [t for t in trackings if t not in rankings]
+        missing = [t for t in cfg.trackings if t not in rankings]
         if missing and channel:
-            view = MissingUsersView(missing, cfg["SpreadsheetID"], last_time)
-            await channel.send(
+            view = MissingUsersView(missing, cfg.spreadsheet_id, last_time)
+            await _send(
+                channel,
                 "⚠️ 以下のユーザーのポイントが取得できませんでした。該当する方はボタンを押してポイントを入力してください。",
                 view=view,
             )
 
         lines = []
-        player_scores = {k: v for k, v in rankings.items() if _is_player(k)}
+        player_scores = {k: v for k, v in rankings.items() if k in cfg.player_set}
         for k, v in player_scores.items():
             lines.append(f"{k}: {v:,}")
         for fk, fv in focus_scores.items():
@@ -230,6 +271,20 @@ async def ranking_logger(ctx: dict) -> str:
             diff_str = ", ".join(diffs) if diffs else "—"
             lines.append(f"{fk}: {fv:,}（{diff_str}）")
 
+        if not used_fallback and channel:
+            # 定期処理完了メッセージは1件ごとに短縮されるので、ペースは別メッセージで送る
+            try:
+                report = await asyncio.to_thread(
+                    analytics.compute, cfg.event_id, cfg.chara_id,
+                    list(player_scores), list(cfg.focus), last_time, cfg.end,
+                )
+                pace_lines = analytics.format_lines(report)
+                if pace_lines:
+                    await _send(channel, "\n".join(pace_lines))
+            except Exception as e:
+                print(f"[WARN] ペース計算に失敗しました: {type(e).__name__}: {e}")
+
+        _commit_delta(cfg, consumer, delta)
         suffix = " (fallback)" if used_fallback else ""
         return "\n" + "\n".join(lines) + suffix if lines else f"api checked{suffix}"
 
@@ -245,51 +300,96 @@ async def auto_ranking_check(ctx: dict) -> str:
     guild_id = ctx["guild_id"]
     channel = ctx.get("channel")
 
-    in_auto = await asyncio.to_thread(
-        shift_manager.is_auto_period, cfg.get("SpreadsheetID"), now_jst()
-    )
+    with sheets_quota.priority("polling"):
+        in_auto = await asyncio.to_thread(
+            shift_manager.is_auto_period, cfg.spreadsheet_id, now_jst()
+        )
     if not in_auto:
         return "AutoCheck(skip)"
 
+    consumer = ("auto", guild_id)
     async def _run_once():
-        scores, _, _ = await _fetch_all_scores(cfg)
-        return scores
+        scores, _, _, delta = await _fetch_all_scores(cfg, consumer)
+        return scores, delta
 
-    scores = await retry_async(
+    scores, delta = await retry_async(
         _run_once,
         attempts=3,
         catch=(ReadTimeout, Timeout, ReqConnError, RequestException, RuntimeError, IndexError),
     )
 
+    if delta is not None and delta.unchanged:
+        # 新しいスナップショットが出ていないだけなので停滞とは判定しない
+        return "AutoCheck(no-update)"
+
     prev = _auto_prev_scores.get(guild_id)
     _auto_prev_scores[guild_id] = scores
 
     if prev is None:
+        _commit_delta(cfg, consumer, delta)
         return "AutoCheck(first)"
 
+    # 差分でポイントが動いたプレイヤーは増加しているので、変化のなかった分だけ比較する
+    changed = delta.changed_targets(cfg.target_set, scores_only=True) if delta is not None else set()
     stalled = [
         f"{k}: {scores[k]:,}（前回 {prev[k]:,}）"
         for k in scores
-        if _is_player(k) and k in prev and scores[k] <= prev[k]
+        if k in cfg.player_set and k not in changed and k in prev and scores[k] <= prev[k]
     ]
     if stalled and channel:
-        await channel.send(
+        await _send(
+            channel,
             "⚠️ Auto期間中にポイント増加が確認できなかったプレイヤーがいます:\n" + "\n".join(stalled)
         )
+    _commit_delta(cfg, consumer, delta)
     return "AutoCheck"
 
-scheduler = EventScheduler(bot, registry)
+scheduler = EventScheduler(bot, registry, publication=publication.tracker)
+shards = sharding.ShardCoordinator(scheduler)
+checkpoint.checkpointer.track_configs(storage.load_all_configs)
+checkpoint.register("auto_prev_scores", _dump_auto_prev, _load_auto_prev)
+
+def _forget_guild(guild_id: int) -> None:
+    _auto_prev_scores.pop(guild_id, None)
+    for use in ("log", "auto"):
+        snapshot_diff.differ.forget((use, guild_id))
+
+shards.on_forget(_forget_guild)
+checkpoint.register(
+    "scheduler",
+    lambda: {str(gid): ts for gid, ts in scheduler.positions().items()},
+    lambda data: scheduler.resume({int(gid): ts for gid, ts in data.items() if checkpoint.guild_unchanged(int(gid))}),
+)
+_startup_done = False
+_background_tasks: set[asyncio.Task] = set()
 
 @bot.event
 async def on_ready():
+    global _startup_done
     print(f"Logged in as {bot.user} (id={bot.user.id})")
-    saved = storage.load_all_configs()
-    for guild_id, cfg in saved.items():
+    first_ready = not _startup_done
+    _startup_done = True
+    if first_ready:
+        await metrics.start_server()
+        restored = sheet_writer.queue.restore()
+        if restored:
+            print(f"[INFO] 未送信の Sheets 書き込み {restored} 件を再送します")
+        # ジョブを起動する前に、前回の実行位置やキャッシュを読み戻す
+        await checkpoint.checkpointer.restore()
+        checkpoint.checkpointer.start()
         try:
-            scheduler_running = scheduler.is_running(guild_id)
-            await scheduler.start_or_restart(guild_id, cfg)
-        except Exception as e:
-            print(f"[WARN] restore failed for guild {guild_id}: {e}")
+            # watchfiles の再起動（SIGINT）と同様に、docker stop の SIGTERM でも close() を通す
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(bot.close()))
+        except (NotImplementedError, RuntimeError):
+            pass
+    # 保存済みギルドのうち、このレプリカが担当するものだけを起動する
+    owned = await shards.start()
+    print(f"[INFO] instance {shards.instance_id}: {len(owned)} guilds / {len(shards.live) or 1} replicas")
+    if first_ready and os.environ.get("BACKFILL_ON_START", "1") == "1":
+        saved = storage.load_all_configs()
+        task = asyncio.create_task(backfill.run_all({gid: saved[gid] for gid in owned if gid in saved}))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
 
 @bot.tree.command(name="ping", description="Ping-Pong!")
 async def ping(interaction: discord.Interaction):
@@ -304,7 +404,8 @@ async def echo(interaction: discord.Interaction, text: str):
 @app_commands.describe(text="スプレッドシートID")
 async def setup(interaction: discord.Interaction, text: str):
     await interaction.response.defer(ephemeral=True, thinking=True)
-    config = gspread_manager.read_config_values(text)
+    with sheets_quota.priority("interactive"):
+        config = await asyncio.to_thread(gspread_manager.read_config_values, text)
     event_name = (config.get("EventName") or "").strip()
     chapter_no = int(config.get("ChapterNo") or 0)
 
@@ -380,10 +481,27 @@ async def setup(interaction: discord.Interaction, text: str):
 
     guild_id = interaction.guild_id or 0
     storage.save_guild_config(guild_id, config)
-    await scheduler.start_or_restart(guild_id, config)
+    await shards.apply(guild_id, GuildConfig.compile(config))
     runners = config.get("Runners")
-    ptlogger.format_pt_table(text, start, end, config.get("Trackings"), interval_minutes=log_interval)
-    shift_manager.format_shift_table(text, ensure_aware_jst(start), ensure_aware_jst(end))
+    loop = asyncio.get_running_loop()
+    progress_edits = []
+
+    def report(msg: str) -> None:
+        # ワーカースレッドから呼ばれるので、ループ側で deferred 応答を書き換える
+        progress_edits.append(asyncio.run_coroutine_threadsafe(
+            interaction.edit_original_response(content=msg), loop
+        ))
+
+    try:
+        with sheets_quota.priority("interactive"):
+            await asyncio.to_thread(
+                sheet_provisioner.provision, text, start, end, config.get("Trackings") or [],
+                interval_minutes=log_interval, progress=report,
+            )
+    except Exception as e:
+        await asyncio.gather(*map(asyncio.wrap_future, progress_edits), return_exceptions=True)
+        await interaction.edit_original_response(content=f"シートの作成に失敗しました: {e}")
+        return
     runners_str = ", ".join(runners) if isinstance(runners, list) else (str(runners) if runners is not None else "未設定")
     is_wb = config.get("isWorldBloom")
     event_name_for_msg = config.get("EventName") or f"(ID: {event_id})"
@@ -400,14 +518,17 @@ async def setup(interaction: discord.Interaction, text: str):
         f"- ログ記録: {log_interval}分間隔（毎時 {log_minutes_str} 分）\n"
         f"- 投稿チャンネル: <#{config['ChannelID']}>"
     )
-    await interaction.followup.send(message, ephemeral=True)
+    # 進捗表示が最終メッセージを上書きしないよう、先に送り終える
+    await asyncio.gather(*map(asyncio.wrap_future, progress_edits), return_exceptions=True)
+    await interaction.edit_original_response(content=message)
 
 @bot.tree.command(name="clear_setup", description="保存済み設定を削除します（実行も停止）")
 async def clear_setup(interaction: discord.Interaction):
     guild_id = interaction.guild_id or 0
-    scheduler.stop(guild_id)
-    storage.delete_guild_config(guild_id)
-    await interaction.response.send_message("設定を削除しました。", ephemeral=True)
+    # heartbeat 中はロック待ちになるので、先に応答を保留しておく
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    await shards.clear(guild_id)
+    await interaction.followup.send("設定を削除しました。", ephemeral=True)
 
 @bot.tree.error
 async def on_app_command_error(
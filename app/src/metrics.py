@@ -0,0 +1,196 @@
+# metrics.py
+from __future__ import annotations
+import asyncio
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9108"))
+
+# 秒単位。Sheets のクォータ待ちや sekai.run の遷移まで入るよう上は長めに取る
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+DRIFT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Registry:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._gauges: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, _Histogram]] = {}
+        self._buckets: Dict[str, Tuple[float, ...]] = {}
+        self._gauge_fns: Dict[str, Callable[[], float]] = {}
+        self._help: Dict[str, str] = {}
+
+    def describe(self, name: str, help_text: str, buckets: Optional[Tuple[float, ...]] = None) -> None:
+        self._help[name] = help_text
+        if buckets is not None:
+            self._buckets[name] = tuple(sorted(buckets))
+
+    def inc(self, name: str, amount: float = 1.0, **labels: str) -> None:
+        key = _labels(labels)
+        with self._lock:
+            family = self._counters.setdefault(name, {})
+            family[key] = family.get(key, 0.0) + amount
+
+    def set_gauge(self, name: str, value: float, **labels: str) -> None:
+        with self._lock:
+            self._gauges.setdefault(name, {})[_labels(labels)] = float(value)
+
+    def gauge_fn(self, name: str, fn: Callable[[], float]) -> None:
+        # スクレイプ時に評価するゲージ（キュー長やジョブ数など）
+        with self._lock:
+            self._gauge_fns[name] = fn
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = _labels(labels)
+        with self._lock:
+            family = self._histograms.setdefault(name, {})
+            hist = family.get(key)
+            if hist is None:
+                hist = family[key] = _Histogram(self._buckets.get(name, DEFAULT_BUCKETS))
+            hist.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0, **labels)
+
+    @contextmanager
+    def track(self, backend: str, op: str) -> Iterator[None]:
+        # バックエンド呼び出しの所要時間とエラー数をまとめて記録する
+        t0 = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            if not isinstance(e, (asyncio.CancelledError, GeneratorExit)):
+                self.inc("backend_errors_total", backend=backend, op=op, error=type(e).__name__)
+            raise
+        finally:
+            self.observe("backend_latency_seconds", time.perf_counter() - t0, backend=backend, op=op)
+
+    def render(self) -> str:
+        with self._lock:
+            counters = {n: dict(f) for n, f in self._counters.items()}
+            gauges = {n: dict(f) for n, f in self._gauges.items()}
+            hists = {n: {k: (h.buckets, list(h.counts), h.sum, h.count) for k, h in f.items()}
+                     for n, f in self._histograms.items()}
+            gauge_fns = dict(self._gauge_fns)
+        for name, fn in gauge_fns.items():
+            try:
+                gauges.setdefault(name, {})[()] = float(fn())
+            except Exception:
+                continue
+
+        lines: List[str] = []
+        for kind, families in (("counter", counters), ("gauge", gauges)):
+            for name in sorted(families):
+                self._header(lines, name, kind)
+                for key, value in sorted(families[name].items()):
+                    lines.append(f"{name}{_fmt_labels(key)} {_fmt_value(value)}")
+        for name in sorted(hists):
+            self._header(lines, name, "histogram")
+            for key, (buckets, counts, total, count) in sorted(hists[name].items()):
+                cumulative = 0
+                for bound, c in zip(buckets, counts):
+                    cumulative += c
+                    lines.append(f"{name}_bucket{_fmt_labels(key + (('le', _fmt_value(bound)),))} {cumulative}")
+                lines.append(f"{name}_bucket{_fmt_labels(key + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{_fmt_labels(key)} {_fmt_value(total)}")
+                lines.append(f"{name}_count{_fmt_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def _header(self, lines: List[str], name: str, kind: str) -> None:
+        if name in self._help:
+            lines.append(f"# HELP {name} {self._help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _fmt_labels(key: Labels) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in key) + "}"
+
+def _fmt_value(v: float) -> str:
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+registry = Registry()
+inc = registry.inc
+set_gauge = registry.set_gauge
+gauge_fn = registry.gauge_fn
+observe = registry.observe
+timer = registry.timer
+track = registry.track
+
+registry.describe("backend_latency_seconds", "Latency of calls to external backends")
+registry.describe("backend_errors_total", "Failed calls to external backends")
+registry.describe("tick_callback_seconds", "Duration of each scheduled callback")
+registry.describe("tick_callback_failures_total", "Scheduled callbacks that raised or timed out")
+registry.describe("scheduler_drift_seconds", "Tick start time minus its target time", DRIFT_BUCKETS)
+registry.describe("fallback_total", "Ranking fetches served by the sekai.run fallback")
+registry.describe("retries_total", "Retried operations by component")
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # 残りのヘッダーは読み捨てる
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout=5)
+            if not line or line in (b"\r\n", b"\n"):
+                break
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            body = registry.render().encode()
+            status, ctype = "200 OK", "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body, status, ctype = b"not found\n", "404 Not Found", "text/plain; charset=utf-8"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {ctype}\r\nContent-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+_server: Optional[asyncio.AbstractServer] = None
+
+async def start_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> Optional[asyncio.AbstractServer]:
+    global _server
+    if port <= 0 or _server is not None:
+        return _server
+    try:
+        _server = await asyncio.start_server(_handle, host, port)
+    except OSError as e:
+        print(f"[WARN] メトリクスサーバーを起動できませんでした（{host}:{port}）: {e}")
+        return None
+    print(f"[INFO] metrics: http://{host}:{port}/metrics")
+    return _server
@@ -1,45 +1,42 @@
 from zoneinfo import ZoneInfo
-from gspread.utils import rowcol_to_a1
 import gspread_manager
+import storage
+from dataclasses import dataclass
 from datetime import datetime, timedelta
+import hashlib
+import math
 import re
 from typing import List, Dict, Any, Union, Optional, Tuple
 
-def format_pt_table(spreadsheet_id: str,
-                    start: datetime,
-                    end: datetime,
-                    trackings: List[int],
-                    interval_minutes: int = 60,
-                    sheet_title: str = "PtLogs") -> None:
+def build_pt_table(start: datetime,
+                   end: datetime,
+                   trackings: List[int],
+                   interval_minutes: int = 60) -> Tuple[List[str], List[List[Any]], List[datetime]]:
+    # ヘッダー行・ゼロ行・日付/時刻列をまとめた行データ（3行目以降は A:B のみ）を返す
     if start > end:
         raise ValueError("start must be <= end")
-    sh = gspread_manager.load_sheet(spreadsheet_id)
     times = []
     t = start
     while t <= end:
         times.append(t)
         t += timedelta(minutes=interval_minutes)
 
-    n_rows = 1 + len(times)
-    n_cols = 2 + max(len(trackings), 0)
-    ws = gspread_manager.create_sheet(sh, sheet_title, n_rows, max(n_cols, 2))
-
-    header = ["日付", "時間"] + [str(x) for x in trackings]
-    ws.update(values=[header], range_name=f"A1:{_col_letter(len(header))}1")
-
-    zero_row = [0] * len(header)
-    ws.update(values=[zero_row], range_name=f"A2:{_col_letter(len(header))}2")
-
-    day_hour_rows = []
+    header = ["日付", "時間"] + [str(x) for x in (trackings or [])]
+    rows: List[List[Any]] = [header]
     prev_date = None
-    for dt in times:
+    for i, dt in enumerate(times):
         d = dt.date()
         day_cell = f"{dt.month}/{dt.day}" if d != prev_date else ""
         time_cell = dt.strftime("%H:%M")
-        day_hour_rows.append([day_cell, time_cell])
+        rows.append([day_cell, time_cell] + ([0] * (len(header) - 2) if i == 0 else []))
         prev_date = d
+    return header, rows, times
 
-    ws.update(values=day_hour_rows, range_name=f"A2:B{1 + len(times)}")
+def save_pt_layout(spreadsheet_id: str, start: datetime, interval_minutes: int, n_times: int,
+                   header: List[str], sheet_title: str = "PtLogs") -> None:
+    local_start = start.astimezone(ZoneInfo("Asia/Tokyo")) if start.tzinfo else start.replace(tzinfo=ZoneInfo("Asia/Tokyo"))
+    layout = PtLayout.build(local_start, interval_minutes, n_times, header)
+    storage.save_sheet_layout(spreadsheet_id, sheet_title, layout.to_dict())
 
 def _col_letter(n: int) -> str:
     if n < 1:
@@ -50,38 +47,126 @@ def _col_letter(n: int) -> str:
         result.append(chr(ord('A') + r))
     return ''.join(reversed(result))
 
-import math
-def write_values(spreadsheet_id: str,
-                 iso_timestamp: str,
-                 values_by_header: Dict[Union[int, str], Any],
-                 tz_name: str = "Asia/Tokyo",
-                 sheet_title: str = "PtLogs") -> None:
-    ts = iso_timestamp.strip()
-    if ts.endswith("Z"):
-        ts = ts[:-1] + "+00:00"
-    dt_utc = datetime.fromisoformat(ts)
-    dt_local = dt_utc.astimezone(ZoneInfo(tz_name))
-    target_day_str = f"{dt_local.month}/{dt_local.day}"
-    tgt_seconds = dt_local.hour * 3600 + dt_local.minute * 60 + dt_local.second
+@dataclass(frozen=True)
+class PtLayout:
+    start: datetime
+    interval_minutes: int
+    n_rows: int
+    header: Tuple[str, ...]
+    checksum: str
 
-    sh = gspread_manager.load_sheet(spreadsheet_id)
-    ws = sh.worksheet(sheet_title)
+    @classmethod
+    def build(cls, start: datetime, interval_minutes: int, n_rows: int, header) -> "PtLayout":
+        start = start.replace(second=0, microsecond=0)
+        header = tuple(str(h) for h in header)
+        raw = f"{start.isoformat()}|{interval_minutes}|{n_rows}|" + "\t".join(header)
+        checksum = hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+        return cls(start, int(interval_minutes), int(n_rows), header, checksum)
 
-    header = ws.row_values(1)
-    header_map = {h: idx + 1 for idx, h in enumerate(header) if h}
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "PtLayout":
+        return cls.build(datetime.fromisoformat(d["start"]), d["interval_minutes"], d["n_rows"], d["header"])
 
-    col_a = ws.col_values(1)
-    col_b = ws.col_values(2)
-    n_rows = max(len(col_a), len(col_b))
-    data_start_row = 2
+    def to_dict(self) -> Dict[str, Any]:
+        return {"start": self.start.isoformat(), "interval_minutes": self.interval_minutes,
+                "n_rows": self.n_rows, "header": list(self.header), "checksum": self.checksum}
 
-    def parse_day_cell(s: str) -> Optional[Tuple[int, int]]:
-        if not s:
-            return None
-        m = re.fullmatch(r"(\d{1,2})/(\d{1,2})", s.strip())
-        if not m:
+    def time_at_row(self, row: int) -> datetime:
+        return self.start + timedelta(minutes=self.interval_minutes * (row - 2))
+
+    def time_cell(self, row: int) -> str:
+        return self.time_at_row(row).strftime("%H:%M")
+
+    def last_row_until(self, dt: datetime) -> int:
+        # dt 以前の時刻を持つ最後の行（なければ 1 = ヘッダー行）
+        if self.n_rows <= 0 or dt < self.start:
+            return 1
+        k = int((dt - self.start) // timedelta(minutes=self.interval_minutes))
+        return 2 + min(k, self.n_rows - 1)
+
+    def row_for(self, dt_local: datetime) -> Optional[int]:
+        # 旧実装の線形探索と同じく「同じ日付の中で時刻が最も近い行（同差なら早い方）」を返す
+        if self.n_rows <= 0:
             return None
-        return int(m.group(1)), int(m.group(2))
+        tgt_seconds = dt_local.hour * 3600 + dt_local.minute * 60 + dt_local.second
+        k0 = int((dt_local - self.start) // timedelta(minutes=self.interval_minutes))
+        candidates = {0, self.n_rows - 1} | {k0 + d for d in (-1, 0, 1, 2)}
+        best = None
+        for k in sorted(c for c in candidates if 0 <= c < self.n_rows):
+            t = self.time_at_row(2 + k).astimezone(dt_local.tzinfo)
+            if (t.month, t.day) != (dt_local.month, dt_local.day):
+                continue
+            cur_minutes = t.hour * 60 + t.minute
+            key = (abs(cur_minutes * 60 - tgt_seconds), cur_minutes)
+            if best is None or key < best[0]:
+                best = (key, 2 + k)
+        return best[1] if best else None
+
+def _load_layout(spreadsheet_id: str, sheet_title: str) -> Optional[PtLayout]:
+    try:
+        d = storage.load_sheet_layout(spreadsheet_id, sheet_title)
+        return PtLayout.from_dict(d) if d else None
+    except Exception:
+        return None
+
+def load_layout(spreadsheet_id: str, sheet_title: str = "PtLogs") -> Optional[PtLayout]:
+    return _load_layout(spreadsheet_id, sheet_title)
+
+def find_missing_cells(spreadsheet_id: str,
+                       keys: List[Union[int, str]],
+                       first_row: int,
+                       until: datetime,
+                       sheet_title: str = "PtLogs") -> Dict[int, List[Union[int, str]]]:
+    # first_row から until 以前の行までを1回の読み取りで調べ、空セルのある行 -> キーを返す
+    layout = _load_layout(spreadsheet_id, sheet_title)
+    if layout is None:
+        raise ValueError(f"{sheet_title} のレイアウトが未登録です。/setup をやり直してください。")
+    last_row = layout.last_row_until(until)
+    if last_row < first_row:
+        return {}
+
+    ws = gspread_manager.load_worksheet(spreadsheet_id, sheet_title)
+    last_col = _col_letter(max(len(layout.header), 2))
+    got = ws.batch_get([f"A1:{last_col}1", f"B{first_row}:{last_col}{last_row}"])
+    if not got or not got[0] or _trimmed(got[0][0]) != layout.header:
+        raise ValueError(f"{sheet_title} のヘッダーが登録済みレイアウトと一致しません。")
+    block = got[1] if len(got) > 1 else []
+    header_map = {h: idx + 1 for idx, h in enumerate(layout.header) if h}
+    cols = [(k, header_map[str(k)]) for k in keys if str(k) in header_map]
+
+    missing: Dict[int, List[Union[int, str]]] = {}
+    for i, r in enumerate(range(first_row, last_row + 1)):
+        row = block[i] if i < len(block) else []
+        if (str(row[0]).strip() if row else "") != layout.time_cell(r):
+            raise ValueError(f"{sheet_title} の {r} 行目の時刻が登録済みレイアウトと一致しません。")
+        # block は B 列始まりなので列番号 c は row[c - 2]
+        empty = [k for k, c in cols if c - 2 >= len(row) or not str(row[c - 2]).strip()]
+        if empty:
+            missing[r] = empty
+    return missing
+
+def _parse_day_cell(s: str) -> Optional[Tuple[int, int]]:
+    if not s:
+        return None
+    m = re.fullmatch(r"(\d{1,2})/(\d{1,2})", s.strip())
+    if not m:
+        return None
+    return int(m.group(1)), int(m.group(2))
+
+def _parse_time_cell(s: str) -> Optional[Tuple[int, int]]:
+    if not s or ":" not in s:
+        return None
+    try:
+        hh, mm = map(int, s.strip().split(":", 1))
+    except Exception:
+        return None
+    return hh, mm
+
+def _scan_best_row(col_a: List[str], col_b: List[str], dt_local: datetime) -> Optional[int]:
+    target_day_str = f"{dt_local.month}/{dt_local.day}"
+    tgt_seconds = dt_local.hour * 3600 + dt_local.minute * 60 + dt_local.second
+    n_rows = max(len(col_a), len(col_b))
+    data_start_row = 2
 
     best_row = None
     best_diff = math.inf
@@ -90,7 +175,7 @@ def write_values(spreadsheet_id: str,
     for r in range(data_start_row, n_rows + 1):
         day_cell = col_a[r-1] if r-1 < len(col_a) else ""
         time_cell = col_b[r-1] if r-1 < len(col_b) else ""
-        md = parse_day_cell(day_cell)
+        md = _parse_day_cell(day_cell)
         if md is not None:
             current_month_day = md
         if current_month_day is None:
@@ -100,12 +185,10 @@ def write_values(spreadsheet_id: str,
         if cur_day_str != target_day_str:
             continue
 
-        if not time_cell or ":" not in time_cell:
-            continue
-        try:
-            hh, mm = map(int, time_cell.strip().split(":", 1))
-        except Exception:
+        hm = _parse_time_cell(time_cell)
+        if hm is None:
             continue
+        hh, mm = hm
 
         cur_seconds = hh * 3600 + mm * 60
         diff = abs(cur_seconds - tgt_seconds)
@@ -119,30 +202,174 @@ def write_values(spreadsheet_id: str,
             if cur_minutes < best_minutes:
                 best_row = r
                 best_minutes = cur_minutes
+    return best_row
+
+def _layout_from_columns(header: List[str], col_a: List[str], col_b: List[str],
+                         dt_local: datetime) -> Optional[PtLayout]:
+    md = _parse_day_cell(col_a[1] if len(col_a) > 1 else "")
+    first = _parse_time_cell(col_b[1] if len(col_b) > 1 else "")
+    second = _parse_time_cell(col_b[2] if len(col_b) > 2 else "")
+    if md is None or first is None:
+        return None
+    year = dt_local.year
+    if md[0] > dt_local.month + 6:
+        year -= 1
+    try:
+        start = dt_local.replace(year=year, month=md[0], day=md[1], hour=first[0], minute=first[1],
+                                 second=0, microsecond=0)
+    except ValueError:
+        return None
+    interval = 60
+    if second is not None:
+        interval = ((second[0] * 60 + second[1]) - (first[0] * 60 + first[1])) % (24 * 60) or 60
+    n_rows = sum(1 for c in col_b[1:] if _parse_time_cell(c) is not None)
+    header = list(header)
+    while header and not header[-1]:
+        header.pop()
+    return PtLayout.build(start, interval, n_rows, header)
+
+def _trimmed(row: List[Any]) -> Tuple[str, ...]:
+    row = [str(c) for c in row]
+    while row and not row[-1]:
+        row.pop()
+    return tuple(row)
+
+def _cell_text(value_range) -> str:
+    cur = value_range[0] if value_range else ""
+    if isinstance(cur, list):
+        cur = cur[0] if cur else ""
+    return str(cur).strip()
 
+def _to_local(iso_timestamp: str, tz_name: str) -> datetime:
+    ts = iso_timestamp.strip()
+    if ts.endswith("Z"):
+        ts = ts[:-1] + "+00:00"
+    return datetime.fromisoformat(ts).astimezone(ZoneInfo(tz_name))
+
+def _write_values_scan(spreadsheet_id: str, ws, dt_local: datetime,
+                       values_by_header: Dict[Union[int, str], Any],
+                       layout: Optional[PtLayout], sheet_title: str) -> Dict[Union[int, str], str]:
+    # 対象行が見つからないときだけ ValueError。Sheets/通信のエラーはそのまま上げて呼び出し側で再試行させる
+    target_day_str = f"{dt_local.month}/{dt_local.day}"
+    header = ws.row_values(1)
+    header_map = {h: idx + 1 for idx, h in enumerate(header) if h}
+    col_a = ws.col_values(1)
+    col_b = ws.col_values(2)
+    best_row = _scan_best_row(col_a, col_b, dt_local)
     if best_row is None:
         raise ValueError(f"対象日 {target_day_str} の行が見つかりませんでした。")
+    rebuilt = _layout_from_columns(header, col_a, col_b, dt_local)
+    if (rebuilt is not None and rebuilt.row_for(dt_local) == best_row
+            and (layout is None or rebuilt.checksum != layout.checksum)):
+        storage.save_sheet_layout(spreadsheet_id, sheet_title, rebuilt.to_dict())
 
-    data_requests = []
-    ranges = []
-    idx_to_key: dict[int, str] = {}
+    results: Dict[Union[int, str], str] = {}
+    ranges, keys = [], []
     for k in values_by_header.keys():
         col = header_map.get(str(k))
         if col:
-            a1 = f"{_col_letter(col)}{best_row}"
-            ranges.append(a1)
-            idx_to_key[len(ranges) - 1] = str(k)
-
+            ranges.append(f"{_col_letter(col)}{best_row}")
+            keys.append(k)
+        else:
+            results[k] = "no-column"
     if not ranges:
-        return
+        return results
 
     current_vals = ws.batch_get(ranges)
+    data_requests = []
     for i, a1 in enumerate(ranges):
-        cur = current_vals[i][0] if (i < len(current_vals) and current_vals[i]) else ""
-        if not str(cur).strip():
-            key_str = idx_to_key[i]
-            data_requests.append({"range": a1, "values": [[values_by_header[key_str if key_str in values_by_header else int(key_str)]]]} )
-
-    if not data_requests:
-        raise ValueError(f"{target_day_str} の最適行 {best_row} は全対象カラムが既に埋まっています。")
-    ws.batch_update(data_requests)
\ No newline at end of file
+        cur = current_vals[i] if i < len(current_vals) else []
+        if _cell_text(cur):
+            results[keys[i]] = "filled"
+        else:
+            data_requests.append({"range": a1, "values": [[values_by_header[keys[i]]]]})
+            results[keys[i]] = "written"
+    if data_requests:
+        ws.batch_update(data_requests)
+    return results
+
+def write_values_many(spreadsheet_id: str,
+                      entries: List[Tuple[str, Dict[Union[int, str], Any]]],
+                      tz_name: str = "Asia/Tokyo",
+                      sheet_title: str = "PtLogs") -> List[Dict[Union[int, str], Any]]:
+    # entries ごとに {key: "written" | "filled" | "no-column" | ValueError} を返す。
+    # ValueError は行が無いなどの恒久的なもので、Sheets/通信のエラーは送出して sheet_writer に再試行させる
+    with gspread_manager.own_write(spreadsheet_id, sheet_title):
+        return _write_values_many(spreadsheet_id, entries, tz_name, sheet_title)
+
+def _write_values_many(spreadsheet_id: str,
+                       entries: List[Tuple[str, Dict[Union[int, str], Any]]],
+                       tz_name: str,
+                       sheet_title: str) -> List[Dict[Union[int, str], Any]]:
+    ws = gspread_manager.load_worksheet(spreadsheet_id, sheet_title)
+    results: List[Dict[Union[int, str], Any]] = [{} for _ in entries]
+    layout = _load_layout(spreadsheet_id, sheet_title)
+    legacy: List[int] = []
+    planned = []
+    rows: Dict[int, int] = {}
+
+    if layout is not None:
+        header_map = {h: idx + 1 for idx, h in enumerate(layout.header) if h}
+        for i, (ts, values) in enumerate(entries):
+            row = layout.row_for(_to_local(ts, tz_name))
+            if row is None:
+                legacy.append(i)
+                continue
+            rows[i] = row
+            for k, v in values.items():
+                col = header_map.get(str(k))
+                if not col:
+                    results[i][k] = "no-column"
+                    continue
+                planned.append((i, k, f"{_col_letter(col)}{row}", v))
+    else:
+        legacy = list(range(len(entries)))
+
+    if planned:
+        # ヘッダー・各行の時刻セル・対象セルを1回の読み取りで検証する
+        check_rows = sorted(set(rows.values()))
+        got = ws.batch_get([f"A1:{_col_letter(max(len(layout.header), 1))}1"]
+                           + [f"B{r}" for r in check_rows]
+                           + [p[2] for p in planned])
+        header_ok = bool(got) and bool(got[0]) and _trimmed(got[0][0]) == layout.header
+        times_ok = all(_cell_text(got[1 + j]) == layout.time_cell(r) for j, r in enumerate(check_rows))
+        if header_ok and times_ok:
+            current = got[1 + len(check_rows):]
+            data_requests = []
+            seen = set()
+            for (i, k, a1, v), cur in zip(planned, current):
+                if a1 in seen or _cell_text(cur):
+                    results[i][k] = "filled"
+                    continue
+                seen.add(a1)
+                data_requests.append({"range": a1, "values": [[v]]})
+                results[i][k] = "written"
+            if data_requests:
+                ws.batch_update(data_requests)
+        else:
+            legacy = sorted(set(legacy) | set(rows))
+            for i in rows:
+                results[i] = {}
+
+    for i in legacy:
+        ts, values = entries[i]
+        try:
+            results[i] = _write_values_scan(spreadsheet_id, ws, _to_local(ts, tz_name), values, layout, sheet_title)
+        except ValueError as e:
+            # 行が無いなどの恒久的なエラーだけをエントリ単位の結果にする
+            results[i] = {k: e for k in values}
+    return results
+
+def write_values(spreadsheet_id: str,
+                 iso_timestamp: str,
+                 values_by_header: Dict[Union[int, str], Any],
+                 tz_name: str = "Asia/Tokyo",
+                 sheet_title: str = "PtLogs") -> None:
+    result = write_values_many(spreadsheet_id, [(iso_timestamp, values_by_header)], tz_name, sheet_title)[0]
+    for status in result.values():
+        if isinstance(status, Exception):
+            raise status
+    statuses = set(result.values())
+    if "filled" in statuses and "written" not in statuses:
+        dt_local = _to_local(iso_timestamp, tz_name)
+        raise ValueError(f"{dt_local.month}/{dt_local.day} {dt_local:%H:%M} の行は全対象カラムが既に埋まっています。")
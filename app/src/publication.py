@@ -0,0 +1,109 @@
+# publication.py
+from __future__ import annotations
+import asyncio
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+import metrics
+import ranking_fetcher
+import storage
+from guild_config import GuildConfig
+from timeutils import ensure_aware_jst, now_jst
+
+# "adaptive": スナップショットの公開を待ってから tick を実行する / "fixed": 従来どおり m+1 分に実行する
+TICK_MODE = os.environ.get("TICK_MODE", "adaptive").lower()
+POLL_MIN_SEC = float(os.environ.get("PUBLISH_POLL_MIN_SEC", "2"))
+POLL_MAX_SEC = float(os.environ.get("PUBLISH_POLL_MAX_SEC", "15"))
+WAIT_MAX_SEC = float(os.environ.get("PUBLISH_WAIT_MAX_SEC", "180"))
+# LogMinutes は公開枠の 1 分後なので、学習前は従来と同じ 60 秒後から見に行く
+SLOT_GAP_SEC = 60.0
+LEAD_SEC = 10.0
+FRESH_TOLERANCE_SEC = 30.0
+EWMA_ALPHA = 0.3
+
+metrics.registry.describe("publication_delay_seconds", "Observed delay between a snapshot slot and its publication")
+
+Key = Tuple[int, int]
+
+def _key(cfg) -> Optional[Key]:
+    if isinstance(cfg, GuildConfig):
+        return cfg.event_key
+    event_id = cfg.get("EventID")
+    if not event_id:
+        return None
+    chara_id = cfg.get("CharaID") if cfg.get("isWorldBloom") else None
+    return int(event_id), int(chara_id or 0)
+
+def _state_key(key: Key) -> str:
+    return f"publish_offset:{key[0]}:{key[1]}"
+
+class PublicationTracker:
+    def __init__(self, mode: str = TICK_MODE) -> None:
+        self.mode = mode
+        self._offsets: Dict[Key, dict] = {}
+
+    def _estimate(self, key: Key) -> dict:
+        est = self._offsets.get(key)
+        if est is None:
+            try:
+                est = storage.load_state(_state_key(key)) or {}
+            except Exception:
+                est = {}
+            est.setdefault("offset", SLOT_GAP_SEC)
+            est.setdefault("samples", 0)
+            self._offsets[key] = est
+        return est
+
+    def start_offset(self, cfg: dict) -> float:
+        # 名目の tick 時刻からの相対秒（負なら前倒し）。ここからポーリングを始める
+        key = _key(cfg)
+        if self.mode != "adaptive" or key is None:
+            return 0.0
+        offset = self._estimate(key)["offset"]
+        return max(0.0, min(SLOT_GAP_SEC, offset - LEAD_SEC)) - SLOT_GAP_SEC
+
+    def _learn(self, key: Key, elapsed: float, saw_transition: bool) -> None:
+        est = self._estimate(key)
+        if saw_transition:
+            metrics.observe("publication_delay_seconds", elapsed)
+            est["offset"] = elapsed if not est["samples"] else (
+                (1 - EWMA_ALPHA) * est["offset"] + EWMA_ALPHA * elapsed
+            )
+            est["samples"] += 1
+        else:
+            # 最初の確認で既に公開済みだった場合は、次回もう少し早く見に行く
+            est["offset"] = max(0.0, min(est["offset"], elapsed) - LEAD_SEC / 2)
+        try:
+            storage.save_state(_state_key(key), est)
+        except Exception as e:
+            print(f"[WARN] 公開オフセットの保存に失敗しました: {e}")
+
+    async def wait_for_fresh(self, cfg: dict, nominal: datetime) -> Optional[str]:
+        # 名目 tick の直前の公開枠のスナップショットが出るまで待ち、その時刻を返す
+        key = _key(cfg)
+        if self.mode != "adaptive" or key is None:
+            return None
+        slot = nominal - timedelta(seconds=SLOT_GAP_SEC)
+        threshold = slot - timedelta(seconds=FRESH_TOLERANCE_SEC)
+        deadline = nominal + timedelta(seconds=WAIT_MAX_SEC)
+        chara_id = key[1] or None
+        delay = POLL_MIN_SEC
+        first = True
+        while True:
+            try:
+                times = await ranking_fetcher.fetch_times(key[0], chara_id, max_age_sec=POLL_MIN_SEC)
+            except Exception:
+                times = []
+            latest = times[-1] if times else None
+            now = now_jst()
+            if latest and ensure_aware_jst(latest) >= threshold:
+                await asyncio.to_thread(self._learn, key, max(0.0, (now - slot).total_seconds()), not first)
+                return latest
+            first = False
+            if now >= deadline:
+                metrics.inc("publication_wait_timeouts_total")
+                return None
+            await asyncio.sleep(min(delay, (deadline - now).total_seconds()))
+            delay = min(POLL_MAX_SEC, delay * 1.5)
+
+tracker = PublicationTracker()
@@ -0,0 +1,134 @@
+# ranking_fetcher.py
+from __future__ import annotations
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+import metrics
+import ranking_history
+import sekai_api
+from timeutils import now_jst
+
+TIMES_TTL_SEC = 20.0
+RANKINGS_TTL_SEC = 600.0
+
+class SingleFlightCache:
+    def __init__(self, max_entries: int = 512) -> None:
+        self.max_entries = max_entries
+        self._values: Dict[Hashable, Tuple[float, Any, float]] = {}
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _get_fresh(self, key: Hashable, max_age_sec: Optional[float] = None) -> Tuple[bool, Any]:
+        hit = self._values.get(key)
+        if hit is None:
+            return False, None
+        expires_at, value, stored_at = hit
+        now = time.monotonic()
+        if now >= expires_at:
+            self._values.pop(key, None)
+            return False, None
+        if max_age_sec is not None and now - stored_at > max_age_sec:
+            return False, None
+        return True, value
+
+    def _put(self, key: Hashable, value: Any, ttl_sec: float) -> None:
+        if len(self._values) >= self.max_entries:
+            now = time.monotonic()
+            for k in [k for k, (exp, _, _) in self._values.items() if exp <= now]:
+                self._values.pop(k, None)
+            while len(self._values) >= self.max_entries:
+                self._values.pop(next(iter(self._values)))
+        now = time.monotonic()
+        self._values[key] = (now + ttl_sec, value, now)
+
+    async def get(self, key: Hashable, factory: Callable[[], Awaitable[Any]], ttl_sec: float,
+                  max_age_sec: Optional[float] = None) -> Any:
+        while True:
+            ok, value = self._get_fresh(key, max_age_sec)
+            if ok:
+                self.hits += 1
+                return value
+            fut = self._inflight.get(key)
+            if fut is None:
+                break
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                # 取り消されたのがリーダー側だけなら、この待機者がリーダーになって取り直す
+                if not fut.cancelled() or asyncio.current_task().cancelling():
+                    raise
+
+        self.misses += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            value = await factory()
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as e:
+            fut.set_exception(e)
+            # 待機者がいなくても "exception was never retrieved" にならないようにする
+            fut.exception()
+            raise
+        else:
+            fut.set_result(value)
+            # 空の結果は取得失敗とみなしてキャッシュしない
+            if value:
+                self._put(key, value, ttl_sec)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+_cache = SingleFlightCache()
+
+def _minute_key() -> str:
+    return now_jst().strftime("%Y-%m-%dT%H:%M")
+
+async def fetch_times(event_id: int, chara_id: Optional[int] = None,
+                      max_age_sec: Optional[float] = None) -> list:
+    # max_age_sec を指定すると、それより古いキャッシュは使わずに取り直す（公開待ちのポーリング用）
+    key = ("times", event_id, chara_id, _minute_key())
+    if chara_id:
+        factory = lambda: sekai_api.get_chapter_time_async(event_id, chara_id)
+    else:
+        factory = lambda: sekai_api.get_event_time_async(event_id)
+    return await _cache.get(key, factory, TIMES_TTL_SEC, max_age_sec)
+
+async def fetch_time_series(event_id: int, chara_id: Optional[int] = None) -> sekai_api.TimestampSeries:
+    return sekai_api.update_time_series(event_id, chara_id, await fetch_times(event_id, chara_id))
+
+async def _fetch_and_record(event_id: int, chara_id: Optional[int], ts: str) -> list:
+    if chara_id:
+        raw = await sekai_api.get_chapter_rankings_async(event_id, chara_id, ts, fallback=False)
+    else:
+        raw = await sekai_api.get_event_rankings_async(event_id, ts, fallback=False)
+    if raw:
+        try:
+            await asyncio.to_thread(ranking_history.store.append, event_id, chara_id, ts, raw)
+        except Exception as e:
+            print(f"[WARN] ランキング履歴の保存に失敗しました: {e}")
+    return raw
+
+async def fetch_rankings(event_id: int, chara_id: Optional[int], ts: str, fallback: bool = True) -> list:
+    # 保存済みのスナップショットはローカルから返し、無いときだけ sekai.best に取りに行く
+    stored = await asyncio.to_thread(ranking_history.store.snapshot, event_id, chara_id, ts)
+    if stored:
+        return stored
+    key = ("rankings", event_id, chara_id, ts)
+    raw = await _cache.get(key, lambda: _fetch_and_record(event_id, chara_id, ts), RANKINGS_TTL_SEC)
+    if raw or not fallback:
+        return raw
+    return await fetch_fallback(chara_id)
+
+async def fetch_fallback(chara_id: Optional[int] = None) -> list:
+    metrics.inc("fallback_total", kind="chapter" if chara_id else "event")
+    key = ("sekai.run", chara_id, _minute_key())
+    return await _cache.get(key, lambda: sekai_api.get_leaderboard_sekai_run_async(chara_id), TIMES_TTL_SEC)
+
+def stats() -> Dict[str, int]:
+    return {"hits": _cache.hits, "misses": _cache.misses, "coalesced": _cache.coalesced,
+            "entries": len(_cache._values), "inflight": len(_cache._inflight)}
@@ -0,0 +1,257 @@
+# ranking_history.py
+from __future__ import annotations
+import bisect
+import json
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import numpy as np
+try:
+    import fcntl
+except ImportError:  # Windows ではプロセス間ロックなし（単一プロセス運用のみ）
+    fcntl = None
+from sekai_api import _iso_to_micros
+
+_HISTORY_DIR = Path(os.environ.get("RANKING_HISTORY_DIR", "history"))
+
+# 1 行 = 1 ランキングエントリ。同じスナップショットの行はファイル内で連続して並ぶ
+ROW_DTYPE = np.dtype([("ts", "<i8"), ("rank", "<i4"), ("user", "<i8"), ("score", "<i8")])
+
+def _user_id(value: Any) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return -1
+
+class _Series:
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.names_path = path.with_suffix(".names.json")
+        self._flock_path = path.with_suffix(".lock")
+        self._flock_file = None
+        self._flock_depth = 0
+        self._rows: np.ndarray = np.empty(0, dtype=ROW_DTYPE)
+        self._size = -1
+        # スナップショットごとの (ts, 開始行, 行数)。ts の昇順
+        self._blocks: List[Tuple[int, int, int]] = []
+        self._block_ts: List[int] = []
+        self._names: Dict[int, str] = {}
+        self._names_dirty = False
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        # 同じ履歴ディレクトリを複数レプリカで共有するので、読み込み・追記・切り詰めは flock で排他する。
+        # 呼び出し側（RankingHistory）のスレッドロックの内側で使うので、ここでは再入だけ数える
+        if fcntl is None:
+            yield
+            return
+        if self._flock_depth == 0:
+            self._flock_path.parent.mkdir(parents=True, exist_ok=True)
+            self._flock_file = open(self._flock_path, "a+")
+            fcntl.flock(self._flock_file, fcntl.LOCK_EX)
+        self._flock_depth += 1
+        try:
+            yield
+        finally:
+            self._flock_depth -= 1
+            if self._flock_depth == 0:
+                fcntl.flock(self._flock_file, fcntl.LOCK_UN)
+                self._flock_file.close()
+                self._flock_file = None
+
+    def _size_on_disk(self) -> int:
+        try:
+            return self.path.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def _load(self) -> None:
+        if self._size_on_disk() == self._size:
+            return
+        with self._locked():
+            size = self._size_on_disk()
+            if size == self._size:
+                return
+            usable = size - size % ROW_DTYPE.itemsize
+            if usable != size:
+                # 追記はロック中に行うので、ロックを取れた時点で残っている半端な行は書き込み途中で落ちたもの
+                with self.path.open("r+b") as f:
+                    f.truncate(usable)
+            self._size = usable
+            if usable:
+                self._rows = np.memmap(self.path, dtype=ROW_DTYPE, mode="r")
+            else:
+                self._rows = np.empty(0, dtype=ROW_DTYPE)
+            self._rebuild_blocks()
+            # 他のレプリカが追記した分の名前も拾う
+            try:
+                raw = json.loads(self.names_path.read_text(encoding="utf-8"))
+                self._names.update({int(k): v for k, v in raw.items()})
+            except (FileNotFoundError, ValueError):
+                pass
+
+    def _rebuild_blocks(self) -> None:
+        ts = self._rows["ts"]
+        if not len(ts):
+            self._blocks, self._block_ts = [], []
+            return
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(ts)) + 1))
+        ends = np.append(starts[1:], len(ts))
+        blocks = sorted(zip(ts[starts].tolist(), starts.tolist(), (ends - starts).tolist()))
+        self._blocks = blocks
+        self._block_ts = [b[0] for b in blocks]
+
+    def _find(self, ts: int) -> Optional[Tuple[int, int, int]]:
+        i = bisect.bisect_left(self._block_ts, ts)
+        if i < len(self._block_ts) and self._block_ts[i] == ts:
+            return self._blocks[i]
+        return None
+
+    def append(self, ts: int, rankings: List[Dict[str, Any]]) -> int:
+        if not rankings:
+            return 0
+        with self._locked():
+            # 他のレプリカが同じスナップショットを先に書いていないか、ロックの中で読み直して確かめる
+            self._load()
+            if self._find(ts) is not None:
+                return 0
+            return self._append_locked(ts, rankings)
+
+    def _append_locked(self, ts: int, rankings: List[Dict[str, Any]]) -> int:
+        users = [_user_id(entry.get("userId")) for entry in rankings]
+        rows = np.empty(len(rankings), dtype=ROW_DTYPE)
+        rows["ts"] = ts
+        rows["rank"] = [int(entry.get("rank") or 0) for entry in rankings]
+        rows["user"] = users
+        rows["score"] = [int(entry.get("score") or 0) for entry in rankings]
+        for uid, entry in zip(users, rankings):
+            name = entry.get("userName")
+            if uid >= 0 and name is not None and self._names.get(uid) != name:
+                self._names[uid] = name
+                self._names_dirty = True
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open("ab") as f:
+            f.write(rows.tobytes())
+        self._save_names()
+        # ブロック索引は全体を作り直さず、追加分だけ差し込む
+        start = len(self._rows)
+        self._size += rows.nbytes
+        self._rows = np.memmap(self.path, dtype=ROW_DTYPE, mode="r")
+        i = bisect.bisect_left(self._block_ts, ts)
+        self._blocks.insert(i, (ts, start, len(rows)))
+        self._block_ts.insert(i, ts)
+        return len(rows)
+
+    def _save_names(self) -> None:
+        if not self._names_dirty:
+            return
+        tmp = self.names_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({str(k): v for k, v in self._names.items()}, ensure_ascii=False), encoding="utf-8")
+        tmp.replace(self.names_path)
+        self._names_dirty = False
+
+    def timestamps(self) -> np.ndarray:
+        self._load()
+        return np.asarray(self._block_ts, dtype=np.int64)
+
+    def snapshot(self, ts: int) -> List[Dict[str, Any]]:
+        self._load()
+        block = self._find(ts)
+        if block is None:
+            return []
+        _, start, count = block
+        rows = self._rows[start:start + count]
+        out = []
+        for rank, user, score in zip(rows["rank"].tolist(), rows["user"].tolist(), rows["score"].tolist()):
+            entry: Dict[str, Any] = {"rank": rank, "score": score}
+            if user >= 0:
+                entry["userId"] = user
+                name = self._names.get(user)
+                if name is not None:
+                    entry["userName"] = name
+            out.append(entry)
+        return out
+
+    def between(self, since: Optional[int], until: Optional[int]) -> np.ndarray:
+        self._load()
+        lo = 0 if since is None else bisect.bisect_left(self._block_ts, since)
+        hi = len(self._block_ts) if until is None else bisect.bisect_right(self._block_ts, until)
+        if lo >= hi:
+            return np.empty(0, dtype=ROW_DTYPE)
+        parts = [self._rows[s:s + n] for _, s, n in self._blocks[lo:hi]]
+        return np.concatenate(parts) if len(parts) > 1 else np.array(parts[0])
+
+    def for_user(self, user_id: int) -> np.ndarray:
+        self._load()
+        rows = self._rows[self._rows["user"] == user_id]
+        return np.sort(rows, order="ts")
+
+    def for_rank(self, rank: int) -> np.ndarray:
+        self._load()
+        rows = self._rows[self._rows["rank"] == rank]
+        return np.sort(rows, order="ts")
+
+    def user_names(self) -> Dict[int, str]:
+        self._load()
+        return dict(self._names)
+
+class RankingHistory:
+    def __init__(self, root: Path = _HISTORY_DIR) -> None:
+        self.root = root
+        self._series: Dict[Tuple[int, int], _Series] = {}
+        self._lock = threading.RLock()
+
+    def _get(self, event_id: int, chara_id: Optional[int]) -> _Series:
+        key = (int(event_id), int(chara_id or 0))
+        s = self._series.get(key)
+        if s is None:
+            name = f"event_{key[0]}.bin" if not key[1] else f"event_{key[0]}_chara_{key[1]}.bin"
+            s = self._series[key] = _Series(self.root / name)
+        return s
+
+    def append(self, event_id: int, chara_id: Optional[int], ts: str, rankings: List[Dict[str, Any]]) -> int:
+        with self._lock:
+            return self._get(event_id, chara_id).append(_iso_to_micros(ts), rankings)
+
+    def has(self, event_id: int, chara_id: Optional[int], ts: str) -> bool:
+        with self._lock:
+            s = self._get(event_id, chara_id)
+            s._load()
+            return s._find(_iso_to_micros(ts)) is not None
+
+    def snapshot(self, event_id: int, chara_id: Optional[int], ts: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            return self._get(event_id, chara_id).snapshot(_iso_to_micros(ts))
+
+    def timestamps(self, event_id: int, chara_id: Optional[int] = None) -> np.ndarray:
+        with self._lock:
+            return self._get(event_id, chara_id).timestamps()
+
+    def between(self, event_id: int, chara_id: Optional[int],
+                since: Optional[str] = None, until: Optional[str] = None) -> np.ndarray:
+        with self._lock:
+            return self._get(event_id, chara_id).between(
+                None if since is None else _iso_to_micros(since),
+                None if until is None else _iso_to_micros(until),
+            )
+
+    def between_micros(self, event_id: int, chara_id: Optional[int],
+                       since: Optional[int], until: Optional[int]) -> np.ndarray:
+        with self._lock:
+            return self._get(event_id, chara_id).between(since, until)
+
+    def for_user(self, event_id: int, chara_id: Optional[int], user_id: Any) -> np.ndarray:
+        with self._lock:
+            return self._get(event_id, chara_id).for_user(_user_id(user_id))
+
+    def for_rank(self, event_id: int, chara_id: Optional[int], rank: int) -> np.ndarray:
+        with self._lock:
+            return self._get(event_id, chara_id).for_rank(int(rank))
+
+    def user_names(self, event_id: int, chara_id: Optional[int] = None) -> Dict[int, str]:
+        with self._lock:
+            return self._get(event_id, chara_id).user_names()
+
+store = RankingHistory()
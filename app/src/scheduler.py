@@ -1,60 +1,46 @@
 # scheduler.py
 from __future__ import annotations
 import asyncio
+import heapq
+import itertools
+from datetime import datetime, timedelta
 from typing import Awaitable, Callable, Dict, List, Any, Optional
 from dataclasses import dataclass
 import os, uuid
 INSTANCE_ID = os.environ.get("INSTANCE_ID", str(uuid.uuid4()))
 import discord
 from collections import defaultdict
-from timeutils import now_jst, ensure_aware_jst, first_tick_on_or_after, JST
+from timeutils import now_jst, first_tick_on_or_after, JST
+import metrics
 import storage
-import re
+from guild_config import GuildConfig, coerce_minutes
 Callback = Callable[[dict], Awaitable[Any]] | Callable[[dict], Any]
 
 def _cb_key(func) -> str:
     return getattr(func, "__qualname__", getattr(func, "__name__", repr(func)))
 
-def _compute_log_minutes(cfg: dict) -> list[int]:
-    interval = cfg.get("LogInterval", 60)
-    try:
-        interval = int(interval)
-        if interval <= 0 or interval > 60:
-            interval = 60
-    except (TypeError, ValueError):
-        interval = 60
-    return sorted(set((m + 1) % 60 for m in range(0, 60, interval)))
-
-def _coerce_minutes(val) -> list[int]:
-    out: list[int] = []
-    def add_one(x):
-        try:
-            m = int(x)
-            if 0 <= m <= 59:
-                out.append(m)
-        except Exception:
-            pass
-    if val is None:
-        pass
-    elif isinstance(val, (int, float)):
-        add_one(val)
-    elif isinstance(val, str):
-        for tok in re.findall(r"\d+", val):
-            add_one(tok)
-    elif isinstance(val, (list, tuple, set)):
-        for item in val:
-            if isinstance(item, (int, float)):
-                add_one(item)
-            elif isinstance(item, str):
-                for tok in re.findall(r"\d+", item):
-                    add_one(tok)
-    return sorted(set(out))
+CALLBACK_TIMEOUT_SEC = float(os.environ.get("CALLBACK_TIMEOUT_SEC", "240"))
+CALLBACK_CONCURRENCY = int(os.environ.get("CALLBACK_CONCURRENCY", "4"))
+
+@dataclass
+class CallbackFailure:
+    name: str
+    error: BaseException
+
+    def __str__(self) -> str:
+        if isinstance(self.error, asyncio.TimeoutError):
+            return f"⚠️{self.name}(timeout)"
+        return f"⚠️{self.name}: {type(self.error).__name__}: {self.error}"
 
 class MultiMinuteRegistry:
-    def __init__(self) -> None:
+    def __init__(self, timeout_sec: float = CALLBACK_TIMEOUT_SEC,
+                 concurrency: int = CALLBACK_CONCURRENCY) -> None:
         self._fixed: Dict[int, List[Callback]] = defaultdict(list)
         self._by_key: Dict[str, List[Callback]] = defaultdict(list)
         self._dedup: set[str] = set()
+        self.timeout_sec = timeout_sec
+        self.concurrency = concurrency
+        self._tables: Dict[Any, tuple[dict, Dict[int, List[Callback]]]] = {}
 
     def every_hour_at(self, minute: int):
         minute = max(0, min(59, int(minute)))
@@ -63,6 +49,7 @@ class MultiMinuteRegistry:
             if k not in self._dedup:
                 self._dedup.add(k)
                 self._fixed[minute].append(func)
+                self._tables.clear()
             return func
         return deco
 
@@ -72,22 +59,55 @@ class MultiMinuteRegistry:
             if k not in self._dedup:
                 self._dedup.add(k)
                 self._by_key[key].append(func)
+                self._tables.clear()
             return func
         return deco
 
-    async def run_for_minute(self, minute: int, ctx: dict) -> List[Any]:
-        results: List[Any] = []
-        for cb in self._fixed.get(minute, []):
-            results.append(await cb(ctx) if _is_coro(cb) else await _to_thread(cb, ctx))
+    def compile(self, cfg) -> Dict[int, List[Callback]]:
+        table: Dict[int, List[Callback]] = {m: list(cbs) for m, cbs in self._fixed.items() if cbs}
+        for key, cbs in self._by_key.items():
+            minutes = cfg.minutes(key) if isinstance(cfg, GuildConfig) else coerce_minutes(cfg.get(key))
+            for m in minutes:
+                table.setdefault(m, []).extend(cbs)
+        return table
 
+    def table_for(self, ctx: dict) -> Dict[int, List[Callback]]:
         cfg = ctx.get("config", {})
-        for key, cbs in self._by_key.items():
-            mins = _coerce_minutes(cfg.get(key))
-            if minute not in mins:
-                continue
-            for cb in cbs:
-                results.append(await cb(ctx) if _is_coro(cb) else await _to_thread(cb, ctx))
-        return results
+        owner = ctx.get("guild_id")
+        cached = self._tables.get(owner)
+        if cached is None or cached[0] is not cfg:
+            cached = (cfg, self.compile(cfg))
+            self._tables[owner] = cached
+        return cached[1]
+
+    def forget(self, guild_id: Any) -> None:
+        self._tables.pop(guild_id, None)
+
+    async def _run_one(self, cb: Callback, ctx: dict, sem: asyncio.Semaphore,
+                       done: Optional[set] = None) -> Any:
+        name = _cb_key(cb)
+        async with sem:
+            try:
+                with metrics.timer("tick_callback_seconds", callback=name):
+                    call = cb(ctx) if _is_coro(cb) else _to_thread(cb, ctx)
+                    result = await asyncio.wait_for(call, timeout=self.timeout_sec)
+            except Exception as e:
+                reason = "timeout" if isinstance(e, asyncio.TimeoutError) else "error"
+                metrics.inc("tick_callback_failures_total", callback=name, reason=reason)
+                result = CallbackFailure(name, e)
+            if done is not None:
+                done.add(name)
+            return result
+
+    async def run_for_minute(self, minute: int, ctx: dict, done: Optional[set] = None) -> List[Any]:
+        # done を渡すと、そこに含まれるコールバックを飛ばし、終わったものの名前を追加していく
+        cbs = self.table_for(ctx).get(minute, [])
+        if done:
+            cbs = [cb for cb in cbs if _cb_key(cb) not in done]
+        if not cbs:
+            return []
+        sem = asyncio.Semaphore(max(1, self.concurrency))
+        return list(await asyncio.gather(*(self._run_one(cb, ctx, sem, done) for cb in cbs)))
 
 def _is_coro(f): 
     import asyncio, inspect
@@ -97,83 +117,230 @@ async def _to_thread(fn, *a, **kw):
     import asyncio
     return await asyncio.to_thread(fn, *a, **kw)
 
+SCHEDULER_WORKERS = int(os.environ.get("SCHEDULER_WORKERS", "16"))
+# 再起動をまたいだとき、この秒数以内に取りこぼした tick は起動直後に実行する
+CATCHUP_GRACE_SEC = float(os.environ.get("SCHEDULER_CATCHUP_SEC", "900"))
+
 @dataclass
 class ManagedJob:
-    task: asyncio.Task
     guild_id: int
+    cfg: GuildConfig
+    generation: int
+    channel: Any
+    start: datetime
+    end: datetime
+    minutes: list[int]
+    running: Optional[asyncio.Task] = None
+    current: Optional[float] = None
+
+    def next_tick(self, after: datetime) -> Optional[tuple[int, datetime]]:
+        base = self.start if after < self.start else after
+        candidates = [(m, first_tick_on_or_after(base, m)) for m in self.minutes]
+        return min(candidates, key=lambda t: t[1]) if candidates else None
 
 class EventScheduler:
-    def __init__(self, bot: discord.Client, registry: MultiMinuteRegistry) -> None:
+    # 全ギルドの次回実行時刻を1つのヒープで管理し、期限の来たものをワーカープールへ渡す。
+    # 削除はヒープから取り除かず generation の不一致で読み捨てる。
+    def __init__(self, bot: discord.Client, registry: MultiMinuteRegistry,
+                 max_workers: int = SCHEDULER_WORKERS, publication: Any = None) -> None:
         self.bot = bot
         self.registry = registry
+        self.max_workers = max_workers
+        # start_offset(cfg) / wait_for_fresh(cfg, target) を持つ公開待ちトラッカー（None なら固定時刻）
+        self.publication = publication
+        # guild_id を受けてこのプロセスが担当中かを返す（sharding.ShardCoordinator が設定する）
+        self.lease_check: Optional[Callable[[int], bool]] = None
         self.jobs: Dict[int, ManagedJob] = {}
-        self._locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self._heap: list[tuple[float, int, int, int, int, float]] = []
+        self._seq = itertools.count()
+        self._generation = itertools.count(1)
+        self._wakeup: Optional[asyncio.Event] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: list[asyncio.Task] = []
+        self._resume: Dict[int, float] = {}
+        metrics.gauge_fn("scheduler_active_jobs", lambda: len(self.jobs))
+        metrics.gauge_fn("scheduler_pending_ticks", lambda: self._queue.qsize() if self._queue else 0)
 
     def is_running(self, guild_id: int) -> bool:
-        return guild_id in self.jobs and not self.jobs[guild_id].task.done()
-
-    async def start_or_restart(self, guild_id: int, cfg: dict) -> None:
-        async with self._locks[guild_id]:
-            await self.stop(guild_id)
-            loop_task = asyncio.create_task(self._event_loop(guild_id, cfg))
-            self.jobs[guild_id] = ManagedJob(task=loop_task, guild_id=guild_id)
-
-    async def stop(self, guild_id: int) -> None:
-        job = self.jobs.get(guild_id)
-        if job and not job.task.done():
-            job.task.cancel()
-            try:
-                await job.task
-            except asyncio.CancelledError:
-                pass
-        self.jobs.pop(guild_id, None)
+        return guild_id in self.jobs
 
-    async def _event_loop(self, guild_id: int, cfg: dict) -> None:
-        channel_id = cfg.get("ChannelID")
-        if not channel_id:
-            return
-        channel = self.bot.get_channel(int(channel_id)) or await self.bot.fetch_channel(int(channel_id))
+    def positions(self) -> Dict[int, float]:
+        # ギルドごとに次に実行する（または実行中の）名目 tick 時刻
+        out: Dict[int, float] = {}
+        for _, _, guild_id, generation, _, nominal in self._heap:
+            job = self.jobs.get(guild_id)
+            if job is not None and job.generation == generation:
+                out[guild_id] = min(nominal, out.get(guild_id, nominal))
+        for guild_id, job in self.jobs.items():
+            if job.current is not None:
+                out[guild_id] = min(job.current, out.get(guild_id, job.current))
+        return out
 
-        start = ensure_aware_jst(cfg["EventStart"])
-        end   = ensure_aware_jst(cfg["EventEnd"])
-        log_minutes = _compute_log_minutes(cfg)
+    def resume(self, positions: Dict[int, float]) -> None:
+        # 次の start_or_restart で、保存時点の位置から取りこぼした tick を拾い直す
+        self._resume.update(positions)
 
-        while True:
-            now = now_jst()
-            if now >= end:
-                await _safe_send(channel, f"⏹️ イベント期間が終了しました（End: {end}）。定期実行を停止します。")
-                break
+    def _ensure_started(self) -> None:
+        if self._tasks and not all(t.done() for t in self._tasks):
+            return
+        self._wakeup = asyncio.Event()
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._dispatch_loop(), name="scheduler-dispatch")]
+        self._tasks += [asyncio.create_task(self._worker(), name=f"scheduler-worker-{i}")
+                        for i in range(self.max_workers)]
 
-            minutes = log_minutes
+    async def start_or_restart(self, guild_id: int, cfg) -> None:
+        self.stop(guild_id)
+        cfg = GuildConfig.compile(cfg)
+        channel_id = cfg.channel_id
+        if not channel_id:
+            return
+        channel = self.bot.get_channel(channel_id) or await self.bot.fetch_channel(channel_id)
+        job = ManagedJob(
+            guild_id=guild_id,
+            cfg=cfg,
+            generation=next(self._generation),
+            channel=channel,
+            start=cfg.start,
+            end=cfg.end,
+            minutes=list(cfg.log_minutes),
+        )
+        self.stop(guild_id)
+        self.jobs[guild_id] = job
+        self._ensure_started()
+        now = now_jst()
+        after = now
+        resume = self._resume.pop(guild_id, None)
+        if resume is not None and now.timestamp() - CATCHUP_GRACE_SEC <= resume < now.timestamp():
+            after = datetime.fromtimestamp(resume, tz=JST)
+        self._schedule_next(job, after)
 
-            base = start if now < start else now
-            candidates = [(m, first_tick_on_or_after(base, m)) for m in minutes]
-            minute, target = min(candidates, key=lambda t: t[1])
+    def stop(self, guild_id: int) -> None:
+        job = self.jobs.pop(guild_id, None)
+        self.registry.forget(guild_id)
+        if job and job.running and not job.running.done():
+            job.running.cancel()
 
-            if target > end:
-                await _safe_send(channel, f"⏹️ 次の実行時刻がイベント終了後のため停止します（Next: {target}, End: {end}）。")
-                break
+    def _schedule_next(self, job: ManagedJob, after: datetime) -> None:
+        if self.jobs.get(job.guild_id) is not job:
+            return
+        if now_jst() >= job.end:
+            self._finish(job, f"⏹️ イベント期間が終了しました（End: {job.end}）。定期実行を停止します。")
+            return
+        nxt = job.next_tick(after)
+        if nxt is None:
+            return
+        minute, target = nxt
+        if target > job.end:
+            self._finish(job, f"⏹️ 次の実行時刻がイベント終了後のため停止します（Next: {target}, End: {job.end}）。")
+            return
+        due = target.timestamp()
+        # 公開待ちが要るのはランキングを記録する tick だけ。他の用途の tick は名目時刻どおりに動かす
+        if self.publication is not None and job.cfg.fires_at("LogMinutes", minute):
+            due += self.publication.start_offset(job.cfg)
+        heapq.heappush(self._heap, (due, next(self._seq), job.guild_id, job.generation, minute, target.timestamp()))
+        self._wakeup.set()
 
-            await asyncio.sleep(max(0.0, (target - now_jst()).total_seconds()))
+    def _finish(self, job: ManagedJob, message: str) -> None:
+        self.jobs.pop(job.guild_id, None)
+        asyncio.create_task(_safe_send(job.channel, message))
 
-            tick_iso = target.strftime("%Y-%m-%dT%H:%M:%S%z")
-            if not storage.mark_tick_if_new(guild_id, tick_iso):
+    async def _dispatch_loop(self) -> None:
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
                 continue
-
-            if start <= target <= end:
-                ctx = {"guild_id": guild_id, "config": cfg, "now": target, "channel": channel}
+            due, _, guild_id, generation, minute, nominal = self._heap[0]
+            delay = due - now_jst().timestamp()
+            if delay > 0:
+                self._wakeup.clear()
                 try:
-                    results = await self.registry.run_for_minute(minute, ctx)
-                except Exception as e:
-                    await _safe_send(channel, f"⚠️ 毎時処理でエラー: {type(e).__name__}: {e}")
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+            job = self.jobs.get(guild_id)
+            if job is None or job.generation != generation:
+                continue
+            target = datetime.fromtimestamp(nominal, tz=JST)
+            self._queue.put_nowait((job, minute, target, due))
+
+    async def _worker(self) -> None:
+        while True:
+            job, minute, target, due = await self._queue.get()
+            try:
+                if self.jobs.get(job.guild_id) is not job:
                     continue
+                job.running = asyncio.current_task()
+                job.current = target.timestamp()
+                metrics.observe("scheduler_drift_seconds", max(0.0, now_jst().timestamp() - due))
+                await self._run_tick(job, minute, target)
+            except asyncio.CancelledError:
+                if self.jobs.get(job.guild_id) is job:
+                    raise
+                # stop() による個別キャンセルはワーカーを止めずに次へ進む
+                asyncio.current_task().uncancel()
+            except Exception as e:
+                print(f"[WARN] tick failed for guild {job.guild_id}: {type(e).__name__}: {e}")
+            finally:
+                job.running = None
+                job.current = None
+                self._queue.task_done()
+                self._schedule_next(job, max(now_jst(), target + timedelta(seconds=1)))
+
+    async def _run_tick(self, job: ManagedJob, minute: int, target: datetime) -> None:
+        if not (job.start <= target <= job.end):
+            return
+        if self.lease_check is not None and not self.lease_check(job.guild_id):
+            return
+        if self.publication is not None and job.cfg.fires_at("LogMinutes", minute):
+            await self.publication.wait_for_fresh(job.cfg, target)
+            # 待っている間にリースが他のレプリカへ移っていれば実行しない
+            if self.lease_check is not None and not self.lease_check(job.guild_id):
+                return
+        tick_iso = target.strftime("%Y-%m-%dT%H:%M:%S%z")
+        if not storage.mark_tick_if_new(job.guild_id, tick_iso):
+            return
+        # 前回この tick が途中で打ち切られていれば、終わっていたコールバックは飛ばす
+        partial_key = _partial_key(job.guild_id)
+        partial = storage.load_state(partial_key) or {}
+        done: set[str] = set(partial.get("done") or []) if partial.get("tick") == tick_iso else set()
+        channel = job.channel
+        ctx = {"guild_id": job.guild_id, "config": job.cfg, "now": target, "channel": channel}
+        try:
+            results = await self.registry.run_for_minute(minute, ctx, done)
+        except asyncio.CancelledError:
+            # 停止・担当替え・終了で打ち切られた tick は、終わったコールバックを記録してから実行済みの印を外す。
+            # 次に担当するプロセスは残りのコールバックだけを実行する
+            try:
+                if done:
+                    storage.save_state(partial_key, {"tick": tick_iso, "done": sorted(done)})
+                elif partial:
+                    storage.delete_state(partial_key)
+                storage.unmark_tick(job.guild_id, tick_iso)
+            except Exception as e:
+                print(f"[WARN] tick の実行済み記録を戻せませんでした: {type(e).__name__}: {e}")
+            raise
+        except Exception as e:
+            results = None
+            await _safe_send(channel, f"⚠️ 毎時処理でエラー: {type(e).__name__}: {e}")
+        if partial:
+            storage.delete_state(partial_key)
+        if results is None:
+            return
+
+        summary = " / ".join([_shorten(str(r)) for r in results if r is not None]) or "OK"
+        await _safe_send(channel, f"⏱️ {target:%Y-%m-%d %H:%M}（毎時{minute:02d}分）定期処理完了: {summary}")
+
+def _partial_key(guild_id: int) -> str:
+    return f"tick_partial:{guild_id}"
 
-                summary = " / ".join([_shorten(str(r)) for r in results if r is not None]) or "OK"
-                await _safe_send(channel, f"⏱️ {target:%Y-%m-%d %H:%M}（毎時{minute:02d}分）定期処理完了: {summary}")
-                
 async def _safe_send(channel: discord.abc.Messageable, content: str) -> None:
     try:
-        await channel.send(content)
+        with metrics.track("discord", "send"):
+            await channel.send(content)
     except Exception:
         pass
 
@@ -1,6 +1,21 @@
+import asyncio
+import json
+import os
+import queue
+import re
+import threading
+import time
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
+from array import array
+from bisect import bisect_left
+from concurrent.futures import Future
 from datetime import datetime, timedelta, timezone
-from typing import List, Dict, Any, Union
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, List, Dict, Any, Optional, Union
+import metrics
 
 BASE_URL = "https://api.sekai.best"
 REGION = "jp"
@@ -14,13 +29,188 @@ WORLD_BLOOM_JSON_URL = (
 )
 JST = timezone(timedelta(hours=9))
 
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("SEKAI_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.environ.get("SEKAI_READ_TIMEOUT", "20"))
+HTTP_POOL_PER_HOST = int(os.environ.get("SEKAI_POOL_PER_HOST", "8"))
+
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_PER_HOST))
+_aio_session: Optional[aiohttp.ClientSession] = None
+
+def _get_aio_session() -> aiohttp.ClientSession:
+    global _aio_session
+    if _aio_session is None or _aio_session.closed:
+        connector = aiohttp.TCPConnector(limit=HTTP_POOL_PER_HOST * 4,
+                                         limit_per_host=HTTP_POOL_PER_HOST,
+                                         keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(total=HTTP_CONNECT_TIMEOUT + HTTP_READ_TIMEOUT,
+                                        sock_connect=HTTP_CONNECT_TIMEOUT,
+                                        sock_read=HTTP_READ_TIMEOUT)
+        _aio_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _aio_session
+
+async def close_async_session() -> None:
+    global _aio_session
+    if _aio_session is not None and not _aio_session.closed:
+        await _aio_session.close()
+    _aio_session = None
+
+def _endpoint(path: str) -> str:
+    # ラベルの種類が増えすぎないよう ID 部分を落とす
+    return re.sub(r"/\d+", "", path)
+
+def _get_data(path: str, params: Dict[str, Any]) -> Any:
+    with metrics.track("sekai.best", _endpoint(path)):
+        resp = _session.get(f"{BASE_URL}{path}", params=params,
+                            timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+        print("Status:", resp.status_code)
+        print("URL:", resp.url)
+        resp.raise_for_status()
+        return resp.json().get("data")
+
+async def _aget_data(path: str, params: Dict[str, Any]) -> Any:
+    with metrics.track("sekai.best", _endpoint(path)):
+        async with _get_aio_session().get(f"{BASE_URL}{path}", params=params) as resp:
+            print("Status:", resp.status)
+            print("URL:", resp.url)
+            resp.raise_for_status()
+            payload = await resp.json(content_type=None)
+    return payload.get("data")
+
+def _as_list(data: Any) -> list:
+    return data if isinstance(data, list) else []
+
+_CACHE_DIR = Path(os.environ.get("SEKAI_CACHE_DIR", "cache"))
+MASTER_TTL_SEC = int(os.environ.get("SEKAI_MASTER_TTL_SEC", "600"))
+
+class _MasterData:
+    def __init__(self, name: str, url: str, indexes: Dict[str, Callable[[dict], Any]],
+                 ttl_sec: int = MASTER_TTL_SEC) -> None:
+        self.name = name
+        self.url = url
+        self.ttl_sec = ttl_sec
+        self._index_keys = indexes
+        self._indexes: Dict[str, Dict[Any, dict]] = {k: {} for k in indexes}
+        self._items: Optional[List[dict]] = None
+        self._etag: Optional[str] = None
+        self._last_modified: Optional[str] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def _data_path(self) -> Path:
+        return _CACHE_DIR / f"{self.name}.json"
+
+    @property
+    def _meta_path(self) -> Path:
+        return _CACHE_DIR / f"{self.name}.meta.json"
+
+    def _set_items(self, items: List[dict]) -> None:
+        indexes: Dict[str, Dict[Any, dict]] = {k: {} for k in self._index_keys}
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            for k, key_fn in self._index_keys.items():
+                key = key_fn(item)
+                if key is not None:
+                    indexes[k].setdefault(key, item)
+        self._items = items
+        self._indexes = indexes
+
+    def _load_disk(self) -> bool:
+        try:
+            items = json.loads(self._data_path.read_text(encoding="utf-8"))
+            meta = json.loads(self._meta_path.read_text(encoding="utf-8"))
+        except Exception:
+            return False
+        if not isinstance(items, list):
+            return False
+        self._set_items(items)
+        self._etag = meta.get("etag")
+        self._last_modified = meta.get("last_modified")
+        self._checked_at = float(meta.get("checked_at", 0.0))
+        return True
+
+    def _save_disk(self, raw: bytes) -> None:
+        try:
+            _CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            tmp = self._data_path.with_suffix(".tmp")
+            tmp.write_bytes(raw)
+            tmp.replace(self._data_path)
+            self._save_meta()
+        except OSError as e:
+            print(f"[WARN] {self.name} のキャッシュ保存に失敗しました: {e}")
+
+    def _save_meta(self) -> None:
+        meta = {"etag": self._etag, "last_modified": self._last_modified, "checked_at": self._checked_at}
+        tmp = self._meta_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(meta), encoding="utf-8")
+        tmp.replace(self._meta_path)
+
+    def _revalidate(self) -> None:
+        headers = {}
+        if self._items is not None:
+            if self._etag:
+                headers["If-None-Match"] = self._etag
+            if self._last_modified:
+                headers["If-Modified-Since"] = self._last_modified
+        with metrics.track("sekai.best", f"master:{self.name}"):
+            resp = _session.get(self.url, headers=headers,
+                                timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+        self._checked_at = time.time()
+        if resp.status_code == 304 and self._items is not None:
+            try:
+                _CACHE_DIR.mkdir(parents=True, exist_ok=True)
+                self._save_meta()
+            except OSError:
+                pass
+            return
+        resp.raise_for_status()
+        data = resp.json()
+        if not isinstance(data, list):
+            raise ValueError(f"{self.name}.json の中身がリストではありません。")
+        self._etag = resp.headers.get("ETag")
+        self._last_modified = resp.headers.get("Last-Modified")
+        self._set_items(data)
+        self._save_disk(resp.content)
+
+    def _ensure(self, force: bool = False) -> None:
+        if self._items is None:
+            self._load_disk()
+        if not force and self._items is not None and time.time() - self._checked_at < self.ttl_sec:
+            return
+        try:
+            self._revalidate()
+        except Exception as e:
+            if self._items is None:
+                raise
+            print(f"[WARN] {self.name} の更新確認に失敗したためキャッシュを使用します: {e}")
+
+    def items(self) -> List[dict]:
+        with self._lock:
+            self._ensure()
+            return self._items
+
+    def lookup(self, index: str, key: Any) -> Optional[dict]:
+        with self._lock:
+            self._ensure()
+            hit = self._indexes[index].get(key)
+            if hit is None and time.time() - self._checked_at >= 60:
+                # 新規イベント直後はキャッシュが古い可能性があるので一度だけ再確認する
+                self._ensure(force=True)
+                hit = self._indexes[index].get(key)
+            return hit
+
+_EVENTS = _MasterData("events", EVENTS_JSON_URL, {
+    "id": lambda e: e.get("id"),
+    "name": lambda e: e.get("name"),
+})
+_WORLD_BLOOMS = _MasterData("worldBlooms", WORLD_BLOOM_JSON_URL, {
+    "chapter": lambda o: (o.get("eventId"), o.get("chapterNo")),
+})
+
 def fetch_event_list():
-    resp = requests.get(EVENTS_JSON_URL)
-    resp.raise_for_status()
-    data = resp.json()
-    if not isinstance(data, list):
-        raise ValueError("events.json の中身がリストではありません。")
-    return data
+    return _EVENTS.items()
 
 def list_event_names():
     events = fetch_event_list()
@@ -28,39 +218,30 @@ def list_event_names():
     print("\n".join(event_names))
     
 def get_event_info_by_name(event_name):
-    events = fetch_event_list()
-    for evt in events:
-        if not isinstance(evt, dict):
-            continue
-        if evt.get("name") == event_name:
-            return evt
-    raise ValueError(f"イベント名【{event_name}】が見つかりませんでした。")
+    evt = _EVENTS.lookup("name", event_name)
+    if evt is None:
+        raise ValueError(f"イベント名【{event_name}】が見つかりませんでした。")
+    return evt
 
 def get_event_info_by_id(event_id: int):
-    events = fetch_event_list()
-    for evt in events:
-        if not isinstance(evt, dict):
-            continue
-        if evt.get("id") == event_id:
-            return evt
-    raise ValueError(f"EventID [{event_id}] が見つかりませんでした。")
+    evt = _EVENTS.lookup("id", event_id)
+    if evt is None:
+        raise ValueError(f"EventID [{event_id}] が見つかりませんでした。")
+    return evt
 
 def filter_event_info(evt):
     return evt.get("id"), datetime.fromtimestamp(evt.get("startAt") / 1000, tz=JST), datetime.fromtimestamp(evt.get("aggregateAt") / 1000, tz=JST)
 
 def get_event_time(event_id):
-    url = f"{BASE_URL}/event/{event_id}/rankings/time"
-    params = {
-        "region": REGION
-    }
     try:
-        resp = requests.get(url, params=params, timeout=100)
-        print("Status:", resp.status_code)
-        print("URL:", resp.url)
-        resp.raise_for_status()
-        payload = resp.json()
-        data = payload.get("data", [])
-        return data if isinstance(data, list) else []
+        return _as_list(_get_data(f"/event/{event_id}/rankings/time", {"region": REGION}))
+    except Exception as e:
+        print("Error:", e)
+        return []
+
+async def get_event_time_async(event_id):
+    try:
+        return _as_list(await _aget_data(f"/event/{event_id}/rankings/time", {"region": REGION}))
     except Exception as e:
         print("Error:", e)
         return []
@@ -75,48 +256,164 @@ _CHARA_ID_TO_NAME = {
     25: "MEIKO", 26: "KAITO",
 }
 
-def _get_leaderboard_sekai_run(chara_id: int = None) -> list:
-    card_title = _CHARA_ID_TO_NAME.get(chara_id) if chara_id else "Overall"
-    js = f"""() => {{
-        const title = {repr(card_title)};
-        const card = [...document.querySelectorAll('.card')].find(
-            c => c.querySelector('h3')?.innerText.trim() === title
-        );
-        if (!card) return [];
+SEKAI_RUN_URL = "https://sekai.run/"
+SEKAI_RUN_TTL_SEC = float(os.environ.get("SEKAI_RUN_TTL_SEC", "45"))
+SEKAI_RUN_IDLE_CLOSE_SEC = float(os.environ.get("SEKAI_RUN_IDLE_CLOSE_SEC", "1800"))
+SEKAI_RUN_TIMEOUT_SEC = 90
+
+_SEKAI_RUN_JS = """() => {
+    const out = {};
+    for (const card of document.querySelectorAll('.card')) {
+        const title = card.querySelector('h3')?.innerText.trim();
+        if (!title) continue;
         const results = [];
-        for (const tr of card.querySelectorAll('tr:has(th.rank)')) {{
+        for (const tr of card.querySelectorAll('tr:has(th.rank)')) {
             const rank = parseInt(tr.querySelector('th.rank').innerText.trim());
             const tds = tr.querySelectorAll('td');
             const name = tds[1] ? tds[1].innerText.trim() : '';
             const scoreRaw = tds[2] ? tds[2].innerText.trim() : '';
             const score = parseInt(scoreRaw.replace(/,/g, ''));
-            if (!isNaN(rank) && name && !isNaN(score)) results.push({{rank, name, score}});
-        }}
-        return results;
-    }}"""
-    from playwright.sync_api import sync_playwright
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page()
-        page.goto('https://sekai.run/', wait_until='domcontentloaded', timeout=30000)
-        page.wait_for_timeout(8000)
-        rankings = page.evaluate(js)
+            if (!isNaN(rank) && name && !isNaN(score)) results.push({rank, name, score});
+        }
+        out[title] = results;
+    }
+    return out;
+}"""
+
+# Playwright の sync API はスレッドに紐づくため、ブラウザは専用スレッドが所有し
+# 呼び出し側はキュー経由で結果を待つ。1回の遷移で全カードを取得して短期キャッシュする。
+class _SekaiRunPool:
+    def __init__(self, ttl_sec: float = SEKAI_RUN_TTL_SEC,
+                 idle_close_sec: float = SEKAI_RUN_IDLE_CLOSE_SEC) -> None:
+        self.ttl_sec = ttl_sec
+        self.idle_close_sec = idle_close_sec
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._cards: Dict[str, list] = {}
+        self._fetched_at = 0.0
+
+    def _fresh(self) -> bool:
+        return bool(self._cards) and time.time() - self._fetched_at < self.ttl_sec
+
+    def submit(self, card_title: str) -> Future:
+        fut: Future = Future()
+        with self._lock:
+            if self._fresh():
+                fut.set_result(list(self._cards.get(card_title, [])))
+                return fut
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="sekai-run", daemon=True)
+                self._thread.start()
+            # スレッドの終了処理（_drain）とロックで順序付けし、取り残される依頼を作らない
+            self._queue.put((fut, card_title))
+        return fut
+
+    def close(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+
+    def _scrape(self, page) -> Dict[str, list]:
+        with metrics.track("sekai.run", "leaderboard"):
+            if page.url.startswith(SEKAI_RUN_URL):
+                page.reload(wait_until="domcontentloaded", timeout=30000)
+            else:
+                page.goto(SEKAI_RUN_URL, wait_until="domcontentloaded", timeout=30000)
+            page.wait_for_selector(".card tr th.rank", timeout=20000)
+            cards = page.evaluate(_SEKAI_RUN_JS)
+        return cards if isinstance(cards, dict) else {}
+
+    def _drain(self, error: BaseException) -> None:
+        # スレッドが止まるときにキューに残っている依頼はすべて失敗で返す
+        with self._lock:
+            if self._thread is threading.current_thread():
+                self._thread = None
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    return
+                if item is not None and item[0].set_running_or_notify_cancel():
+                    item[0].set_exception(error)
+
+    def _run(self) -> None:
+        error: BaseException = RuntimeError("sekai.run worker stopped")
+        try:
+            from playwright.sync_api import sync_playwright
+            with sync_playwright() as p:
+                browser = page = None
+                try:
+                    while True:
+                        try:
+                            item = self._queue.get(timeout=self.idle_close_sec)
+                        except queue.Empty:
+                            _close_quietly(browser)
+                            browser = page = None
+                            continue
+                        if item is None:
+                            break
+                        fut, card_title = item
+                        if not fut.set_running_or_notify_cancel():
+                            continue
+                        try:
+                            if not self._fresh():
+                                if browser is None or not browser.is_connected():
+                                    browser = p.chromium.launch(headless=True)
+                                    page = browser.new_page()
+                                cards = self._scrape(page)
+                                with self._lock:
+                                    self._cards = cards
+                                    self._fetched_at = time.time()
+                            fut.set_result(list(self._cards.get(card_title, [])))
+                        except Exception as e:
+                            _close_quietly(browser)
+                            browser = page = None
+                            fut.set_exception(e)
+                finally:
+                    _close_quietly(browser)
+        except Exception as e:
+            # Playwright の起動失敗などでスレッドが落ちても、待っている依頼は解放する
+            print(f"[WARN] sekai.run のワーカーが停止しました: {type(e).__name__}: {e}")
+            error = e
+        finally:
+            self._drain(error)
+
+def _close_quietly(browser) -> None:
+    if browser is None:
+        return
+    try:
         browser.close()
+    except Exception:
+        pass
+
+_SEKAI_RUN = _SekaiRunPool()
+
+def _sekai_run_card_title(chara_id: Optional[int]) -> str:
+    return _CHARA_ID_TO_NAME.get(chara_id) if chara_id else "Overall"
+
+def _to_ranking_entries(rows: list) -> list:
     return [
         {"rank": e["rank"], "score": e["score"], "userName": e["name"], "userId": None}
-        for e in rankings
+        for e in rows
     ]
 
+def _get_leaderboard_sekai_run(chara_id: int = None) -> list:
+    rows = _SEKAI_RUN.submit(_sekai_run_card_title(chara_id)).result(timeout=SEKAI_RUN_TIMEOUT_SEC)
+    return _to_ranking_entries(rows)
+
+async def get_leaderboard_sekai_run_async(chara_id: int = None) -> list:
+    rows = await asyncio.wait_for(
+        asyncio.wrap_future(_SEKAI_RUN.submit(_sekai_run_card_title(chara_id))),
+        timeout=SEKAI_RUN_TIMEOUT_SEC,
+    )
+    return _to_ranking_entries(rows)
+
+def close_sekai_run_pool() -> None:
+    _SEKAI_RUN.close()
+
 def get_event_rankings(event_id, ts):
-    url = f"{BASE_URL}/event/{event_id}/rankings"
-    params = {"timestamp": ts, "region": REGION}
     try:
-        resp = requests.get(url, params=params, timeout=100)
-        print("Status:", resp.status_code)
-        print("URL:", resp.url)
-        resp.raise_for_status()
-        payload = resp.json()
-        data = payload.get("data")
+        data = _get_data(f"/event/{event_id}/rankings", {"timestamp": ts, "region": REGION})
         return data.get("eventRankings")
     except Exception as e:
         print("Error:", e)
@@ -126,49 +423,49 @@ def get_event_rankings(event_id, ts):
         print("Fallback Error:", e)
         return []
 
+async def get_event_rankings_async(event_id, ts, fallback: bool = True):
+    try:
+        data = await _aget_data(f"/event/{event_id}/rankings", {"timestamp": ts, "region": REGION})
+        return data.get("eventRankings")
+    except Exception as e:
+        print("Error:", e)
+    if not fallback:
+        return []
+    try:
+        return await get_leaderboard_sekai_run_async(None)
+    except Exception as e:
+        print("Fallback Error:", e)
+        return []
+
 def fetch_world_bloom():
-    resp = requests.get(WORLD_BLOOM_JSON_URL)
-    resp.raise_for_status()
-    data = resp.json()
-    if not isinstance(data, list):
-        raise ValueError("events.json の中身がリストではありません。")
-    return data
+    return _WORLD_BLOOMS.items()
 
 def get_chapter_info(event_id, chapter_no):
-    items = fetch_world_bloom()
-    return next(
-        (o for o in items if o.get("eventId") == event_id and o.get("chapterNo") == chapter_no),
-        None
-    )
+    return _WORLD_BLOOMS.lookup("chapter", (event_id, chapter_no))
     
 def filter_chapter_info(evt):
     return evt.get("gameCharacterId"), datetime.fromtimestamp(evt.get("chapterStartAt") / 1000, tz=JST), datetime.fromtimestamp(evt.get("aggregateAt") / 1000, tz=JST)
     
 def get_chapter_time(event_id, chara_id):
-    url = f"{BASE_URL}/event/{event_id}/chapter_rankings/time"
     params = {"charaId": chara_id, "region": REGION}
     try:
-        resp = requests.get(url, params=params, timeout=100)
-        print("Status:", resp.status_code)
-        print("URL:", resp.url)
-        resp.raise_for_status()
-        payload = resp.json()
-        data = payload.get("data", [])
-        return data if isinstance(data, list) else []
+        return _as_list(_get_data(f"/event/{event_id}/chapter_rankings/time", params))
+    except Exception as e:
+        print("Error:", e)
+        return []
+
+async def get_chapter_time_async(event_id, chara_id):
+    params = {"charaId": chara_id, "region": REGION}
+    try:
+        return _as_list(await _aget_data(f"/event/{event_id}/chapter_rankings/time", params))
     except Exception as e:
         print("Error:", e)
         return []
     
 def get_chapter_rankings(event_id, chara_id, ts):
-    url = f"{BASE_URL}/event/{event_id}/chapter_rankings"
     params = {"charaId": chara_id, "timestamp": ts, "region": REGION}
     try:
-        resp = requests.get(url, params=params, timeout=100)
-        print("Status:", resp.status_code)
-        print("URL:", resp.url)
-        resp.raise_for_status()
-        payload = resp.json()
-        data = payload.get("data")
+        data = _get_data(f"/event/{event_id}/chapter_rankings", params)
         return data.get("eventRankings")
     except Exception as e:
         print("Error:", e)
@@ -178,44 +475,185 @@ def get_chapter_rankings(event_id, chara_id, ts):
         print("Fallback Error:", e)
         return []
 
-def extract_scores(rankings: List[Dict[str, Any]],
-                   targets: List[Union[int, str]]) -> Dict[Union[int, str], Any]:
-    result: Dict[Union[int, str], Any] = {}
-    def is_userid_like(x: Any) -> bool:
-        return isinstance(x, int) and len(str(abs(x))) >= 15
-    for entry in rankings:
-        rank_val = entry.get("rank")
-        user_name = entry.get("userName")
-        user_id   = entry.get("userId")
-        user_id_str = str(user_id) if user_id is not None else None
-        score_val = entry.get("score")
-        for t in targets:
-            if is_userid_like(t):
-                if user_id_str is not None and user_id_str == str(t):
-                    result[t] = score_val
+async def get_chapter_rankings_async(event_id, chara_id, ts, fallback: bool = True):
+    params = {"charaId": chara_id, "timestamp": ts, "region": REGION}
+    try:
+        data = await _aget_data(f"/event/{event_id}/chapter_rankings", params)
+        return data.get("eventRankings")
+    except Exception as e:
+        print("Error:", e)
+    if not fallback:
+        return []
+    try:
+        return await get_leaderboard_sekai_run_async(chara_id)
+    except Exception as e:
+        print("Fallback Error:", e)
+        return []
+
+def _is_userid_like(x: Any) -> bool:
+    return isinstance(x, int) and len(str(abs(x))) >= 15
+
+class TargetSet:
+    __slots__ = ("targets", "ranks", "user_ids", "names")
+
+    def __init__(self, targets) -> None:
+        self.targets = tuple(targets)
+        ranks, user_ids, names = [], [], []
+        for t in self.targets:
+            if _is_userid_like(t):
+                user_ids.append((t, str(t)))
             elif isinstance(t, int):
-                if rank_val == t:
-                    result[t] = score_val
+                ranks.append((t, t))
             elif isinstance(t, str):
-                if user_name == t:
-                    result[t] = score_val
+                names.append((t, t))
+        self.ranks = tuple(ranks)
+        self.user_ids = tuple(user_ids)
+        self.names = tuple(names)
 
-    return result
-def pick_hourly(times: List[str]) -> List[str]:
-    dt_list = [datetime.fromisoformat(t.replace("Z", "+00:00")) for t in times]
-    dt_list.sort()
+@lru_cache(maxsize=256)
+def classify_targets(targets: tuple) -> TargetSet:
+    return TargetSet(targets)
+
+class RankingIndex:
+    __slots__ = ("by_rank", "by_user_id", "by_name")
+
+    def __init__(self, rankings: List[Dict[str, Any]]) -> None:
+        by_rank: Dict[Any, tuple] = {}
+        by_user_id: Dict[str, tuple] = {}
+        by_name: Dict[str, tuple] = {}
+        for pos, entry in enumerate(rankings or []):
+            item = (pos, entry.get("score"))
+            by_rank[entry.get("rank")] = item
+            user_id = entry.get("userId")
+            if user_id is not None:
+                by_user_id[str(user_id)] = item
+            user_name = entry.get("userName")
+            if user_name is not None:
+                by_name[user_name] = item
+        self.by_rank = by_rank
+        self.by_user_id = by_user_id
+        self.by_name = by_name
+
+    def extract(self, targets: TargetSet) -> Dict[Union[int, str], Any]:
+        found = []
+        for groups, index in ((targets.user_ids, self.by_user_id),
+                              (targets.ranks, self.by_rank),
+                              (targets.names, self.by_name)):
+            for t, key in groups:
+                hit = index.get(key)
+                if hit is not None:
+                    found.append((hit[0], t, hit[1]))
+        # 旧実装と同じくランキング順で返す
+        found.sort(key=lambda x: x[0])
+        return {t: score for _, t, score in found}
+
+def extract_scores(rankings: Union[List[Dict[str, Any]], RankingIndex],
+                   targets: Union[List[Union[int, str]], TargetSet]) -> Dict[Union[int, str], Any]:
+    index = rankings if isinstance(rankings, RankingIndex) else RankingIndex(rankings)
+    target_set = targets if isinstance(targets, TargetSet) else classify_targets(tuple(targets))
+    return index.extract(target_set)
 
-    result = []
-    if not dt_list:
-        return result
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
-    start = dt_list[0].replace(minute=0, second=0, microsecond=0)
-    end = dt_list[-1]
-    target = start
+def _iso_to_micros(t: str) -> int:
+    dt = datetime.fromisoformat(t.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return (dt - _EPOCH) // timedelta(microseconds=1)
 
-    while target <= end:
-        nearest = min(dt_list, key=lambda d: abs((d - target).total_seconds()))
-        result.append(nearest.isoformat().replace("+00:00", "Z"))
-        target += timedelta(hours=1)
+def _micros_to_iso(us: int) -> str:
+    return (_EPOCH + timedelta(microseconds=us)).isoformat().replace("+00:00", "Z")
 
-    return sorted(set(result), key=lambda x: x)
\ No newline at end of file
+class TimestampSeries:
+    __slots__ = ("_raw", "_micros", "_aligned")
+
+    def __init__(self, times: List[str] = ()) -> None:
+        self._raw: List[str] = []
+        self._micros = array("q")
+        self._aligned: List[str] = []
+        self.extend(times)
+
+    def __len__(self) -> int:
+        return len(self._micros)
+
+    def extend(self, times: List[str]) -> int:
+        n = len(self._raw)
+        if n and (len(times) < n or times[n - 1] != self._raw[-1]):
+            # 先頭側が変わっていたら追記できないので作り直す
+            self._raw = []
+            self._micros = array("q")
+            self._aligned = []
+            n = 0
+        tail = list(times[n:])
+        if not tail:
+            return 0
+        parsed = [_iso_to_micros(t) for t in tail]
+        self._raw.extend(tail)
+        if (self._micros and parsed[0] < self._micros[-1]) or parsed != sorted(parsed):
+            pairs = sorted(zip(list(self._micros) + parsed, self._aligned + tail))
+            self._micros = array("q", (us for us, _ in pairs))
+            self._aligned = [raw for _, raw in pairs]
+        else:
+            self._micros.extend(parsed)
+            self._aligned.extend(tail)
+        return len(tail)
+
+    def latest(self) -> Optional[str]:
+        return self._raw[-1] if self._raw else None
+
+    def _nearest_index(self, target_us: int) -> int:
+        arr = self._micros
+        i = bisect_left(arr, target_us)
+        if i == 0:
+            return 0
+        if i == len(arr):
+            return len(arr) - 1
+        return i - 1 if target_us - arr[i - 1] <= arr[i] - target_us else i
+
+    def _nearest_micros(self, target_us: int) -> int:
+        return self._micros[self._nearest_index(target_us)]
+
+    def nearest_raw(self, target: datetime, tolerance: Optional[timedelta] = None) -> Optional[str]:
+        # API にそのまま渡せる元の文字列を返す。tolerance を超えて離れていれば None
+        if not self._micros:
+            return None
+        target_us = (target - _EPOCH) // timedelta(microseconds=1)
+        i = self._nearest_index(target_us)
+        if tolerance is not None and abs(self._micros[i] - target_us) > tolerance // timedelta(microseconds=1):
+            return None
+        return self._aligned[i]
+
+    def nearest(self, target: datetime) -> Optional[str]:
+        if not self._micros:
+            return None
+        return _micros_to_iso(self._nearest_micros((target - _EPOCH) // timedelta(microseconds=1)))
+
+    def pick_grid(self, interval_minutes: int = 60) -> List[str]:
+        if not self._micros:
+            return []
+        step = max(1, int(interval_minutes)) * 60_000_000
+        hour = 3600 * 1_000_000
+        target = self._micros[0] - self._micros[0] % hour
+        end = self._micros[-1]
+        picked = []
+        while target <= end:
+            picked.append(self._nearest_micros(target))
+            target += step
+        return sorted({_micros_to_iso(us) for us in picked})
+
+_time_series: Dict[tuple, TimestampSeries] = {}
+
+def update_time_series(event_id, chara_id, times: List[str]) -> TimestampSeries:
+    key = (event_id, chara_id or None)
+    series = _time_series.get(key)
+    if series is None:
+        series = _time_series[key] = TimestampSeries()
+    series.extend(times)
+    return series
+
+def get_time_series(event_id, chara_id=None) -> TimestampSeries:
+    times = get_chapter_time(event_id, chara_id) if chara_id else get_event_time(event_id)
+    return update_time_series(event_id, chara_id, times)
+
+def pick_hourly(times: List[str]) -> List[str]:
+    return TimestampSeries(times).pick_grid(60)
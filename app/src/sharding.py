@@ -0,0 +1,175 @@
+# sharding.py
+from __future__ import annotations
+import asyncio
+import hashlib
+import os
+from time import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+import metrics
+import storage
+from guild_config import GuildConfig
+from scheduler import INSTANCE_ID
+
+# 同じストレージ（STORAGE_DB / config_store.json）を共有するレプリカ間でギルドを分担する。
+# SHARDING=0 なら従来どおり全ギルドをこのプロセスで実行する。
+SHARDING = os.environ.get("SHARDING", "1") == "1"
+LEASE_TTL_SEC = float(os.environ.get("LEASE_TTL_SEC", "90"))
+HEARTBEAT_SEC = float(os.environ.get("LEASE_HEARTBEAT_SEC", "30"))
+
+metrics.registry.describe("shard_owned_guilds", "Guilds whose lease is held by this replica")
+metrics.registry.describe("shard_live_replicas", "Replicas with a live heartbeat")
+metrics.registry.describe("shard_handoffs_total", "Guild leases acquired or released by this replica")
+
+def _weight(instance_id: str, guild_id: int) -> int:
+    digest = hashlib.blake2b(f"{instance_id}:{guild_id}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+def assign(guild_ids: Iterable[int], instances: List[str]) -> Dict[int, str]:
+    # rendezvous hashing: レプリカの増減で動くのはそのレプリカに関係するギルドだけ
+    if not instances:
+        return {}
+    return {gid: max(instances, key=lambda iid: _weight(iid, gid)) for gid in guild_ids}
+
+class ShardCoordinator:
+    # heartbeat ごとに生存レプリカと保存済み設定から担当ギルドを決め、
+    # リースを取得・更新・解放して EventScheduler のジョブを担当分だけに揃える。
+    def __init__(self, scheduler: Any, instance_id: str = INSTANCE_ID, enabled: bool = SHARDING,
+                 ttl_sec: float = LEASE_TTL_SEC, interval_sec: float = HEARTBEAT_SEC) -> None:
+        self.scheduler = scheduler
+        self.instance_id = instance_id
+        self.enabled = enabled
+        self.ttl_sec = ttl_sec
+        self.interval_sec = min(interval_sec, ttl_sec / 3)
+        self._expires: Dict[int, float] = {}
+        self._configs: Dict[int, Optional[dict]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self._forget_hooks: List[Callable[[int], None]] = []
+        self.live: List[str] = []
+        metrics.gauge_fn("shard_owned_guilds", lambda: len(self._expires))
+        metrics.gauge_fn("shard_live_replicas", lambda: len(self.live))
+        if enabled:
+            scheduler.lease_check = self.owns
+
+    @property
+    def owned(self) -> Set[int]:
+        return set(self._expires)
+
+    def on_forget(self, hook: Callable[[int], None]) -> None:
+        # 設定が削除されたギルドについて、各モジュールがギルド単位の状態を捨てるためのフック
+        self._forget_hooks.append(hook)
+
+    def _forget(self, guild_id: int) -> None:
+        for hook in self._forget_hooks:
+            try:
+                hook(guild_id)
+            except Exception as e:
+                print(f"[WARN] guild {guild_id} の状態を破棄できませんでした: {type(e).__name__}: {e}")
+
+    def owns(self, guild_id: int) -> bool:
+        # リース期限を過ぎていれば（heartbeat が止まっていれば）他のレプリカに渡ったものとみなす
+        return not self.enabled or self._expires.get(guild_id, 0.0) > time()
+
+    def _claim(self, configs: Dict[int, dict]) -> tuple[Set[int], Set[int]]:
+        storage.heartbeat(self.instance_id, self.ttl_sec)
+        self.live = storage.live_instances()
+        if self.instance_id not in self.live:
+            self.live = sorted(self.live + [self.instance_id])
+        wanted = {gid for gid, iid in assign(configs, self.live).items() if iid == self.instance_id}
+        held: Set[int] = set()
+        for gid in wanted:
+            expires = time() + self.ttl_sec
+            if storage.try_acquire_lease(gid, self.instance_id, int(self.ttl_sec)):
+                self._expires[gid] = expires
+                held.add(gid)
+        released = set(self._expires) - held
+        for gid in released:
+            storage.release_lease(gid, self.instance_id)
+            self._expires.pop(gid, None)
+        return held, released
+
+    async def rebalance(self) -> Set[int]:
+        async with self._lock:
+            configs = await asyncio.to_thread(storage.load_all_configs)
+            if not self.enabled:
+                held, released = set(configs), set(self._configs) - set(configs)
+            else:
+                try:
+                    held, released = await asyncio.to_thread(self._claim, configs)
+                except Exception as e:
+                    print(f"[WARN] リースの更新に失敗しました: {type(e).__name__}: {e}")
+                    held = {gid for gid in self._expires if self.owns(gid)}
+                    released = set(self._expires) - held
+                    for gid in released:
+                        self._expires.pop(gid, None)
+            for gid in released:
+                self.scheduler.stop(gid)
+                if self._configs.pop(gid, None) is not None:
+                    metrics.inc("shard_handoffs_total", direction="released")
+                    print(f"[INFO] guild {gid} の担当を外れました（{self.instance_id}）")
+                # 他のレプリカで /clear_setup された場合もここで状態を捨てる
+                if gid not in configs:
+                    self._forget(gid)
+            for gid in held:
+                cfg = configs.get(gid)
+                # 他のレプリカで /setup された場合も設定の変化で再起動する。
+                # 終了済みイベントのジョブは止まったままなので is_running では判定しない
+                if cfg is None or self._configs.get(gid) == cfg:
+                    continue
+                if gid not in self._configs:
+                    metrics.inc("shard_handoffs_total", direction="acquired")
+                self._configs[gid] = cfg
+                try:
+                    await self.scheduler.start_or_restart(gid, GuildConfig.compile(cfg))
+                except Exception as e:
+                    print(f"[WARN] restore failed for guild {gid}: {e}")
+            return held
+
+    async def apply(self, guild_id: int, cfg: GuildConfig) -> bool:
+        # /setup 直後に呼ぶ。担当ならその場で再起動し、担当外なら担当レプリカの次回 heartbeat に任せる
+        if not self.enabled:
+            await self.scheduler.start_or_restart(guild_id, cfg)
+            self._configs[guild_id] = cfg.to_dict()
+            return True
+        if guild_id in self._configs:
+            self._configs[guild_id] = None
+        return guild_id in await self.rebalance()
+
+    async def clear(self, guild_id: int) -> None:
+        # /clear_setup から呼ぶ。設定を消し、担当中ならその場で止めてリースを手放す。
+        # 他のレプリカが担当している場合は、そのレプリカの次回 heartbeat で止まる
+        async with self._lock:
+            await asyncio.to_thread(storage.delete_guild_config, guild_id)
+            self.scheduler.stop(guild_id)
+            self._configs.pop(guild_id, None)
+            if self._expires.pop(guild_id, None) is not None:
+                try:
+                    await asyncio.to_thread(storage.release_lease, guild_id, self.instance_id)
+                except Exception as e:
+                    print(f"[WARN] リースの解放に失敗しました: {e}")
+            self._forget(guild_id)
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval_sec)
+            await self.rebalance()
+
+    async def start(self) -> Set[int]:
+        held = await self.rebalance()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop(), name="shard-heartbeat")
+        return held
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for gid in set(self._expires) | set(self._configs):
+            self.scheduler.stop(gid)
+        self._expires.clear()
+        self._configs.clear()
+        if self.enabled:
+            try:
+                await asyncio.to_thread(storage.leave, self.instance_id)
+            except Exception as e:
+                print(f"[WARN] リースの解放に失敗しました: {e}")
@@ -0,0 +1,133 @@
+# sheet_provisioner.py
+from __future__ import annotations
+import random
+from dataclasses import dataclass
+from datetime import date, datetime
+from typing import Any, Callable, Dict, List, Optional
+import gspread_manager
+import ptlogger
+import shift_manager
+from timeutils import ensure_aware_jst
+
+@dataclass
+class _SheetPlan:
+    title: str
+    rows: List[List[Any]]
+    n_rows: int
+    n_cols: int
+    frozen_rows: int = 0
+    # True なら日付・時刻の文字列を USER_ENTERED と同じく日付/時刻型のセルとして書く
+    typed: bool = False
+
+_SERIAL_EPOCH = date(1899, 12, 30)
+
+def _cell(v: Any) -> Dict[str, Any]:
+    # 空文字は {} にして既存の値を消す（従来の values.update と同じ挙動）
+    if v is None or v == "":
+        return {}
+    if isinstance(v, bool):
+        return {"userEnteredValue": {"boolValue": v}}
+    if isinstance(v, (int, float)):
+        return {"userEnteredValue": {"numberValue": v}}
+    return {"userEnteredValue": {"stringValue": str(v)}}
+
+def _typed_cell(v: Any) -> Dict[str, Any]:
+    # Shift は従来 USER_ENTERED で書いていたので、"YYYY-MM-DD" / "HH:MM" はシリアル値と表示形式で書く。
+    # 表示形式を入力と同じ形にしておき、get_all_values で読む文字列も変わらないようにする
+    if isinstance(v, str):
+        for fmt, kind, pattern in (("%Y-%m-%d", "DATE", "yyyy-mm-dd"), ("%H:%M", "TIME", "hh:mm")):
+            try:
+                parsed = datetime.strptime(v, fmt)
+            except ValueError:
+                continue
+            if kind == "DATE":
+                serial = float((parsed.date() - _SERIAL_EPOCH).days)
+            else:
+                serial = (parsed.hour * 60 + parsed.minute) / 1440
+            return {"userEnteredValue": {"numberValue": serial},
+                    "userEnteredFormat": {"numberFormat": {"type": kind, "pattern": pattern}}}
+    return _cell(v)
+
+def _new_sheet_id(used: set) -> int:
+    while True:
+        sid = random.randint(1, 2**31 - 1)
+        if sid not in used:
+            used.add(sid)
+            return sid
+
+def _sheet_requests(plan: _SheetPlan, props: Optional[dict], used_ids: set) -> List[dict]:
+    requests: List[dict] = []
+    if props is None:
+        sheet_id = _new_sheet_id(used_ids)
+        grid = {"rowCount": plan.n_rows, "columnCount": plan.n_cols}
+        if plan.frozen_rows:
+            grid["frozenRowCount"] = plan.frozen_rows
+        requests.append({"addSheet": {"properties": {"sheetId": sheet_id, "title": plan.title, "gridProperties": grid}}})
+    else:
+        sheet_id = props["sheetId"]
+        current = props.get("gridProperties") or {}
+        grid, fields = {}, []
+        if current.get("rowCount", 0) < plan.n_rows:
+            grid["rowCount"] = plan.n_rows
+            fields.append("gridProperties.rowCount")
+        if current.get("columnCount", 0) < plan.n_cols:
+            grid["columnCount"] = plan.n_cols
+            fields.append("gridProperties.columnCount")
+        if plan.frozen_rows and current.get("frozenRowCount", 0) != plan.frozen_rows:
+            grid["frozenRowCount"] = plan.frozen_rows
+            fields.append("gridProperties.frozenRowCount")
+        if fields:
+            requests.append({"updateSheetProperties": {
+                "properties": {"sheetId": sheet_id, "gridProperties": grid},
+                "fields": ",".join(fields),
+            }})
+    cell = _typed_cell if plan.typed else _cell
+    requests.append({"updateCells": {
+        "start": {"sheetId": sheet_id, "rowIndex": 0, "columnIndex": 0},
+        "rows": [{"values": [cell(v) for v in row]} for row in plan.rows],
+        "fields": "userEnteredValue,userEnteredFormat.numberFormat" if plan.typed else "userEnteredValue",
+    }})
+    return requests
+
+def build_requests(metadata: dict, plans: List[_SheetPlan]) -> List[dict]:
+    existing = {s["properties"]["title"]: s["properties"] for s in metadata.get("sheets", [])}
+    used_ids = {p["sheetId"] for p in existing.values()}
+    requests: List[dict] = []
+    for plan in plans:
+        requests.extend(_sheet_requests(plan, existing.get(plan.title), used_ids))
+    return requests
+
+def provision(spreadsheet_id: str,
+              start: datetime,
+              end: datetime,
+              trackings: List[int],
+              interval_minutes: int = 60,
+              gap_cols: int = 4,
+              progress: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+    # PtLogs と Shift の作成・リサイズ・固定・書き込みを 1 回の spreadsheets.batchUpdate にまとめる
+    report = progress or (lambda _msg: None)
+    start, end = ensure_aware_jst(start), ensure_aware_jst(end)
+
+    report("シートの内容を作成しています…")
+    header, pt_rows, times = ptlogger.build_pt_table(start, end, trackings, interval_minutes)
+    shift_rows = shift_manager.build_shift_table(start, end, gap_cols)
+    plans = [
+        _SheetPlan("PtLogs", pt_rows, 1 + len(times), max(len(header), 2)),
+        _SheetPlan("Shift", shift_rows, len(shift_rows), len(shift_rows[0]), frozen_rows=1, typed=True),
+    ]
+
+    report("スプレッドシートの情報を取得しています…")
+    sh = gspread_manager.load_sheet(spreadsheet_id)
+    metadata = sh.fetch_sheet_metadata(params={"fields": "sheets.properties"})
+    requests = build_requests(metadata, plans)
+
+    report("シートを書き込んでいます…")
+    try:
+        sh.batch_update({"requests": requests})
+    finally:
+        for plan in plans:
+            gspread_manager.invalidate_sheet(spreadsheet_id, plan.title)
+            gspread_manager.invalidate_snapshot(spreadsheet_id, plan.title)
+
+    ptlogger.save_pt_layout(spreadsheet_id, start, interval_minutes, len(times), header)
+    return {"requests": len(requests), "sheets": [p.title for p in plans]}
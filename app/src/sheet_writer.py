@@ -0,0 +1,211 @@
+# sheet_writer.py
+from __future__ import annotations
+import asyncio
+import json
+import os
+import random
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+import metrics
+import ptlogger
+import sheets_quota
+
+FLUSH_WINDOW_SEC = float(os.environ.get("SHEET_FLUSH_WINDOW_SEC", "3"))
+RETRY_MAX_DELAY_SEC = 300.0
+# 未反映の書き込みを再起動後に再送するためのファイル。レプリカ同士で共有すると他の分まで送り直すので、
+# INSTANCE_ID を固定して運用しているならその名前を付ける（未設定なら従来どおり 1 ファイル）
+_INSTANCE_ID = os.environ.get("INSTANCE_ID")
+_JOURNAL_PATH = Path(os.environ.get(
+    "SHEET_WRITE_JOURNAL",
+    f"sheet_write_journal.{_INSTANCE_ID}.json" if _INSTANCE_ID else "sheet_write_journal.json",
+))
+
+class _Ticket:
+    __slots__ = ("future", "keys", "results")
+
+    def __init__(self, future: asyncio.Future, keys: set) -> None:
+        self.future = future
+        self.keys = keys
+        self.results: Dict[Union[int, str], Any] = {}
+
+@dataclass
+class _PendingWrite:
+    sheet_title: str
+    timestamp: str
+    key: Union[int, str]
+    value: Any
+    attempts: int = 0
+    priority: str = "logging"
+    ticket: Optional[_Ticket] = field(default=None, compare=False)
+
+    def to_json(self) -> list:
+        return [self.sheet_title, self.timestamp, self.key, self.value, self.attempts, self.priority]
+
+class SheetWriteQueue:
+    def __init__(self, flush_window_sec: float = FLUSH_WINDOW_SEC, journal_path: Path = _JOURNAL_PATH) -> None:
+        self.flush_window_sec = flush_window_sec
+        self.journal_path = journal_path
+        self._pending: Dict[str, List[_PendingWrite]] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._flushing: Dict[str, asyncio.Task] = {}
+        self._retry_delay: Dict[str, float] = {}
+        self.flushes = 0
+        self.failures = 0
+
+    def enqueue(self, spreadsheet_id: str, timestamp: str,
+                values_by_header: Dict[Union[int, str], Any],
+                sheet_title: str = "PtLogs", priority: str = "logging") -> asyncio.Future:
+        # 戻り値の Future は初回 flush の結果 {key: "written" | "filled" | ...} で解決される
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        items = [_PendingWrite(sheet_title, timestamp, k, v, priority=priority)
+                 for k, v in values_by_header.items()]
+        if not items:
+            fut.set_result({})
+            return fut
+        ticket = _Ticket(fut, {item.key for item in items})
+        for item in items:
+            item.ticket = ticket
+        self._pending.setdefault(spreadsheet_id, []).extend(items)
+        self._persist()
+        self._schedule(spreadsheet_id, self.flush_window_sec)
+        return fut
+
+    def pending_count(self) -> int:
+        return sum(len(v) for v in self._pending.values())
+
+    def _schedule(self, spreadsheet_id: str, delay: float) -> None:
+        if spreadsheet_id in self._timers or spreadsheet_id in self._flushing:
+            return
+        loop = asyncio.get_running_loop()
+        self._timers[spreadsheet_id] = loop.call_later(delay, self._start_flush, spreadsheet_id)
+
+    def _start_flush(self, spreadsheet_id: str) -> None:
+        self._timers.pop(spreadsheet_id, None)
+        self._flushing[spreadsheet_id] = asyncio.create_task(self._flush(spreadsheet_id))
+
+    async def _flush(self, spreadsheet_id: str) -> None:
+        try:
+            batch = self._pending.pop(spreadsheet_id, [])
+            if not batch:
+                return
+            by_entry: Dict[tuple, List[_PendingWrite]] = {}
+            for item in batch:
+                by_entry.setdefault((item.sheet_title, item.timestamp), []).append(item)
+
+            retry: List[_PendingWrite] = []
+            for sheet_title in {t for t, _ in by_entry}:
+                groups = [(ts, items) for (t, ts), items in by_entry.items() if t == sheet_title]
+                entries = []
+                shadowed = set()
+                for ts, items in groups:
+                    values: Dict[Union[int, str], Any] = {}
+                    for item in items:
+                        # 同じセルへの重複は先に積まれた値を優先する（空セルのみ埋める仕様に合わせる）
+                        if item.key in values:
+                            shadowed.add(id(item))
+                        else:
+                            values[item.key] = item.value
+                    entries.append((ts, values))
+                prio = min((item.priority for _, items in groups for item in items),
+                           key=lambda p: sheets_quota.PRIORITIES.get(p, len(sheets_quota.PRIORITIES)))
+                try:
+                    with sheets_quota.priority(prio):
+                        results = await asyncio.to_thread(
+                            ptlogger.write_values_many, spreadsheet_id, entries, sheet_title=sheet_title
+                        )
+                except Exception as e:
+                    self.failures += 1
+                    print(f"[WARN] Sheets 書き込みに失敗しました（{spreadsheet_id}/{sheet_title}）: {e}")
+                    for _, items in groups:
+                        for item in items:
+                            item.attempts += 1
+                            metrics.inc("retries_total", component="sheet_writer")
+                            _resolve(item, e)
+                            retry.append(item)
+                    continue
+                for (_, items), result in zip(groups, results):
+                    for item in items:
+                        status = result.get(item.key, "filled")
+                        if id(item) in shadowed and status == "written":
+                            status = "filled"
+                        _resolve(item, status)
+
+            self.flushes += 1
+            if retry:
+                self._pending.setdefault(spreadsheet_id, [])[:0] = retry
+                delay = min(RETRY_MAX_DELAY_SEC, self._retry_delay.get(spreadsheet_id, 5.0) * 2)
+                self._retry_delay[spreadsheet_id] = delay
+            else:
+                self._retry_delay.pop(spreadsheet_id, None)
+                delay = self.flush_window_sec
+            self._persist()
+        finally:
+            self._flushing.pop(spreadsheet_id, None)
+        if self._pending.get(spreadsheet_id):
+            self._schedule(spreadsheet_id, delay * (1 + random.random() * 0.1))
+
+    def _cancel_timers(self) -> None:
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+
+    async def flush_all(self) -> None:
+        self._cancel_timers()
+        if self._flushing:
+            await asyncio.gather(*self._flushing.values(), return_exceptions=True)
+        for sid in list(self._pending):
+            await self._flush(sid)
+        # 失敗分はジャーナルに残し、次回起動時の restore で再送する
+        self._cancel_timers()
+
+    async def close(self) -> None:
+        try:
+            await self.flush_all()
+        finally:
+            self._persist()
+
+    def restore(self) -> int:
+        try:
+            data = json.loads(self.journal_path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return 0
+        except Exception as e:
+            print(f"[WARN] 書き込みジャーナルを読めませんでした: {e}")
+            return 0
+        n = 0
+        for sid, rows in (data or {}).items():
+            for row in rows:
+                self._pending.setdefault(sid, []).append(_PendingWrite(*row))
+                n += 1
+            self._schedule(sid, self.flush_window_sec)
+        return n
+
+    def _persist(self) -> None:
+        data = {sid: [item.to_json() for item in items] for sid, items in self._pending.items() if items}
+        try:
+            if not data:
+                self.journal_path.unlink(missing_ok=True)
+                return
+            tmp = self.journal_path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+            tmp.replace(self.journal_path)
+        except OSError as e:
+            print(f"[WARN] 書き込みジャーナルの保存に失敗しました: {e}")
+
+def _resolve(item: _PendingWrite, status: Any) -> None:
+    ticket = item.ticket
+    if ticket is None or ticket.future.done():
+        return
+    ticket.results[item.key] = status
+    if ticket.keys <= set(ticket.results):
+        ticket.future.set_result(dict(ticket.results))
+
+queue = SheetWriteQueue()
+metrics.gauge_fn("sheet_writer_pending", queue.pending_count)
+
+def enqueue(spreadsheet_id: str, timestamp: str,
+            values_by_header: Dict[Union[int, str], Any],
+            sheet_title: str = "PtLogs", priority: str = "logging") -> asyncio.Future:
+    return queue.enqueue(spreadsheet_id, timestamp, values_by_header, sheet_title, priority)
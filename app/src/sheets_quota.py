@@ -0,0 +1,144 @@
+# sheets_quota.py
+from __future__ import annotations
+import contextvars
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional
+import metrics
+
+PRIORITIES: Dict[str, int] = {"interactive": 0, "logging": 1, "notices": 2, "polling": 3}
+REQUESTS_PER_MINUTE = float(os.environ.get("SHEETS_REQUESTS_PER_MIN", "55"))
+BURST = float(os.environ.get("SHEETS_BURST", "10"))
+MAX_RETRIES = 5
+
+_priority: contextvars.ContextVar[str] = contextvars.ContextVar("sheets_priority", default="polling")
+
+@contextmanager
+def priority(name: str):
+    if name not in PRIORITIES:
+        raise ValueError(f"unknown priority: {name}")
+    token = _priority.set(name)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+def current_priority() -> str:
+    return _priority.get()
+
+def _status_of(e: Exception) -> Optional[int]:
+    code = getattr(e, "code", None)
+    if isinstance(code, int):
+        return code
+    resp = getattr(e, "response", None)
+    return getattr(resp, "status_code", None)
+
+def _retry_after(e: Exception) -> Optional[float]:
+    resp = getattr(e, "response", None)
+    headers = getattr(resp, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+def _is_quota_error(e: Exception) -> bool:
+    if _status_of(e) == 429:
+        return True
+    text = str(e)
+    return "RESOURCE_EXHAUSTED" in text or "Quota exceeded" in text
+
+class QuotaScheduler:
+    def __init__(self, per_minute: float = REQUESTS_PER_MINUTE, burst: float = BURST) -> None:
+        self.rate = per_minute / 60.0
+        self.capacity = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._backoff = 0.0
+        self._cond = threading.Condition()
+        self._waiters: list = []
+        self._seq = itertools.count()
+        self.stats: Dict[str, Any] = {"granted": 0, "throttled": 0, "retries": 0, "max_queue_depth": 0,
+                                      "granted_by_priority": {k: 0 for k in PRIORITIES}}
+
+    def queue_depth(self) -> int:
+        with self._cond:
+            return len(self._waiters)
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, prio: Optional[str] = None) -> None:
+        name = prio or current_priority()
+        entry = (PRIORITIES.get(name, len(PRIORITIES)), next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiters, entry)
+            self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], len(self._waiters))
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self._waiters[0] == entry and now >= self._blocked_until and self._tokens >= 1:
+                        self._tokens -= 1
+                        heapq.heappop(self._waiters)
+                        self.stats["granted"] += 1
+                        self.stats["granted_by_priority"][name] = self.stats["granted_by_priority"].get(name, 0) + 1
+                        self._cond.notify_all()
+                        return
+                    wait = max(self._blocked_until - now, (1 - self._tokens) / self.rate, 0.05)
+                    self._cond.wait(timeout=wait)
+            except BaseException:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                    self._cond.notify_all()
+                raise
+
+    def _on_quota_error(self, e: Exception) -> float:
+        with self._cond:
+            self.stats["throttled"] += 1
+            self._backoff = min(64.0, self._backoff * 2 if self._backoff else 2.0)
+            delay = _retry_after(e) or self._backoff * (1 + random.random() * 0.25)
+            # クォータは共有なので、待っている全リクエストをまとめて止める
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+            self._tokens = 0
+            self._cond.notify_all()
+            return delay
+
+    def _on_success(self) -> None:
+        if self._backoff:
+            with self._cond:
+                self._backoff = 0.0
+
+    def call(self, fn: Callable, *args, **kwargs):
+        for attempt in range(MAX_RETRIES + 1):
+            self.acquire()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if not _is_quota_error(e) or attempt == MAX_RETRIES:
+                    raise
+                delay = self._on_quota_error(e)
+                self.stats["retries"] += 1
+                metrics.inc("retries_total", component="sheets_quota")
+                print(f"[WARN] Sheets クォータ超過のため {delay:.1f} 秒待機して再試行します（{current_priority()}）")
+                continue
+            self._on_success()
+            return result
+
+scheduler = QuotaScheduler()
+metrics.gauge_fn("sheets_quota_queue_depth", scheduler.queue_depth)
+
+def call(fn: Callable, *args, **kwargs):
+    return scheduler.call(fn, *args, **kwargs)
+
+def stats() -> Dict[str, Any]:
+    out = dict(scheduler.stats)
+    out["queue_depth"] = scheduler.queue_depth()
+    return out
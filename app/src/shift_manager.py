@@ -1,5 +1,4 @@
 from zoneinfo import ZoneInfo
-from gspread.utils import rowcol_to_a1
 import gspread_manager
 from datetime import datetime, timedelta, time
 import re
@@ -7,18 +6,11 @@ import re
 DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
 TIME_RE = re.compile(r"^\d{2}:\d{2}$")
 
-def format_shift_table(
-    spreadsheet_id: str,
-    start: datetime,
-    end: datetime,
-    gap_cols: int = 4,
-    sheet_title: str = "Shift",
-) -> str:
+def build_shift_table(start: datetime, end: datetime, gap_cols: int = 4) -> list:
     if start > end:
         raise ValueError("start must be <= end")
     if gap_cols < 0:
         raise ValueError("gap_cols must be >= 0")
-    sh = gspread_manager.load_sheet(spreadsheet_id)
     start_h = start.replace(minute=0, second=0, microsecond=0)
     end_h   = end.replace(minute=0, second=0, microsecond=0)
 
@@ -30,7 +22,6 @@ def format_shift_table(
         d += timedelta(days=1)
     total_rows = 25
     total_cols = 1 + (len(days) - 1) * (1 + gap_cols) + gap_cols if days else 1 + gap_cols
-    ws = gspread_manager.create_sheet(sh, sheet_title, total_rows, total_cols)
     table = [[""] * total_cols for _ in range(total_rows)]
     
     for i, day in enumerate(days):
@@ -44,20 +35,7 @@ def format_shift_table(
         for j in range(gap_cols):
             col = base_col + 1 + j
             table[0][col] = "アンコ" if j == gap_cols - 1 else f"支援者{j+1}"
-
-    cell_range = f"{rowcol_to_a1(1,1)}:{rowcol_to_a1(total_rows, total_cols)}"
-    sh.values_update(
-        f"{ws.title}!{cell_range}",
-        params={"valueInputOption": "USER_ENTERED"},
-        body={"values": table},
-    )
-
-    try:
-        ws.freeze(rows=1)
-    except Exception:
-        pass
-
-    return ws.title
+    return table
 
 def find_date_columns(header_row):
     return [c for c, v in enumerate(header_row) if DATE_RE.match(v.strip())]
@@ -152,7 +130,7 @@ def extract_nearest_shift(
     tz_str: str = "Asia/Tokyo",
 ):
     tz = ZoneInfo(tz_str)
-    data = gspread_manager.load_table(spreadsheet_id, sheet_title)
+    data = gspread_manager.load_table_snapshot(spreadsheet_id, sheet_title)
     if not data:
         raise ValueError("sheet is empty")
 
@@ -175,7 +153,7 @@ def is_auto_period(
 ) -> bool:
     tz = dt.tzinfo or ZoneInfo("Asia/Tokyo")
     try:
-        data = gspread_manager.load_table(spreadsheet_id, sheet_title)
+        data = gspread_manager.load_table_snapshot(spreadsheet_id, sheet_title)
     except Exception:
         return False
     if not data or len(data) < 2:
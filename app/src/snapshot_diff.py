@@ -0,0 +1,175 @@
+# snapshot_diff.py
+from __future__ import annotations
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, FrozenSet, Hashable, List, Optional, Set, Tuple, Union
+import checkpoint
+import metrics
+import ranking_history
+import sekai_api
+
+metrics.registry.describe("snapshot_unchanged_total", "Ticks that found the same ranking snapshot as last time")
+metrics.registry.describe("snapshot_fetch_skipped_total", "Ranking fetches skipped because the snapshot was already loaded")
+
+Key = Tuple[int, int]
+Entry = Tuple[int, Any]   # (rank, score)
+
+class Snapshot:
+    __slots__ = ("ts", "index", "by_user", "by_rank", "user_by_name")
+
+    def __init__(self, ts: str, rankings: List[Dict[str, Any]]) -> None:
+        self.ts = ts
+        self.index = sekai_api.RankingIndex(rankings)
+        by_user: Dict[int, Entry] = {}
+        by_rank: Dict[int, Tuple[Optional[int], Any]] = {}
+        user_by_name: Dict[str, int] = {}
+        for entry in rankings or []:
+            rank, score = entry.get("rank"), entry.get("score")
+            try:
+                uid: Optional[int] = int(entry.get("userId"))
+            except (TypeError, ValueError):
+                uid = None
+            if uid is not None:
+                by_user[uid] = (rank, score)
+                name = entry.get("userName")
+                if name is not None:
+                    user_by_name[name] = uid
+            by_rank[rank] = (uid, score)
+        self.by_user = by_user
+        self.by_rank = by_rank
+        self.user_by_name = user_by_name
+
+@dataclass(frozen=True)
+class RankingDelta:
+    ts: str
+    prev_ts: Optional[str]
+    rank_moves: Dict[int, Tuple[int, int]] = field(default_factory=dict)
+    score_changes: Dict[int, Tuple[Any, Any]] = field(default_factory=dict)
+    entered: Dict[int, Entry] = field(default_factory=dict)
+    exited: Dict[int, Entry] = field(default_factory=dict)
+    ranks_changed: FrozenSet[int] = frozenset()
+    current: Optional[Snapshot] = field(default=None, repr=False, compare=False)
+
+    @property
+    def unchanged(self) -> bool:
+        return self.prev_ts == self.ts
+
+    @property
+    def initial(self) -> bool:
+        return self.prev_ts is None
+
+    def changed_users(self, scores_only: bool = False) -> Set[int]:
+        users = set(self.score_changes) | set(self.entered) | set(self.exited)
+        return users if scores_only else users | set(self.rank_moves)
+
+    def changed_targets(self, targets: sekai_api.TargetSet, scores_only: bool = False) -> Set[Union[int, str]]:
+        # Trackings / Focus の指定（順位・userId・名前）のうち、今回の差分に関係するもの
+        if self.unchanged:
+            return set()
+        if self.initial or self.current is None:
+            return set(targets.targets)
+        users = self.changed_users(scores_only)
+        out: Set[Union[int, str]] = set()
+        for t, key in targets.user_ids:
+            if int(key) in users:
+                out.add(t)
+        for t, key in targets.names:
+            uid = self.current.user_by_name.get(key)
+            if uid is None or uid in users:
+                out.add(t)
+        for t, key in targets.ranks:
+            if key in self.ranks_changed:
+                out.add(t)
+        return out
+
+    def summary(self) -> str:
+        return (f"moves={len(self.rank_moves)} scores={len(self.score_changes)} "
+                f"in={len(self.entered)} out={len(self.exited)}")
+
+def diff(prev: Optional[Snapshot], cur: Snapshot) -> RankingDelta:
+    if prev is None:
+        return RankingDelta(cur.ts, None, entered=dict(cur.by_user),
+                            ranks_changed=frozenset(cur.by_rank), current=cur)
+    if prev.ts == cur.ts:
+        return RankingDelta(cur.ts, prev.ts, current=cur)
+    rank_moves, score_changes, entered = {}, {}, {}
+    for uid, (rank, score) in cur.by_user.items():
+        old = prev.by_user.get(uid)
+        if old is None:
+            entered[uid] = (rank, score)
+            continue
+        if old[0] != rank:
+            rank_moves[uid] = (old[0], rank)
+        if old[1] != score:
+            score_changes[uid] = (old[1], score)
+    exited = {uid: e for uid, e in prev.by_user.items() if uid not in cur.by_user}
+    ranks_changed = frozenset(r for r in set(prev.by_rank) | set(cur.by_rank)
+                              if prev.by_rank.get(r) != cur.by_rank.get(r))
+    return RankingDelta(cur.ts, prev.ts, rank_moves, score_changes, entered, exited, ranks_changed, cur)
+
+class SnapshotDiffer:
+    # (event, chara) ごとに直近のスナップショットを保持し、利用者（ギルド×用途）ごとに
+    # 前回処理を終えた時刻からの差分を返す。同じ時刻なら取得も再計算もしない。
+    def __init__(self, keep: int = 8, max_deltas: int = 128) -> None:
+        self.keep = keep
+        self.max_deltas = max_deltas
+        self._snapshots: Dict[Key, "OrderedDict[str, Snapshot]"] = {}
+        self._seen: Dict[Hashable, Tuple[Key, str]] = {}
+        self._deltas: "OrderedDict[Tuple[Key, Optional[str], str], RankingDelta]" = OrderedDict()
+
+    def get(self, key: Key, ts: str) -> Optional[Snapshot]:
+        snaps = self._snapshots.get(key)
+        return snaps.get(ts) if snaps else None
+
+    def put(self, key: Key, ts: str, rankings: List[Dict[str, Any]]) -> Snapshot:
+        snaps = self._snapshots.setdefault(key, OrderedDict())
+        snap = snaps.get(ts)
+        if snap is None:
+            snap = snaps[ts] = Snapshot(ts, rankings)
+            while len(snaps) > self.keep:
+                snaps.popitem(last=False)
+        return snap
+
+    def delta(self, consumer: Hashable, key: Key, ts: str) -> RankingDelta:
+        # 既読位置は動かさない。利用者が処理を終えたら commit() で進める
+        cur = self.get(key, ts)
+        if cur is None:
+            raise KeyError(f"snapshot {key}@{ts} is not loaded")
+        seen = self._seen.get(consumer)
+        prev_ts = seen[1] if seen and seen[0] == key else None
+        if prev_ts == ts:
+            metrics.inc("snapshot_unchanged_total")
+            return RankingDelta(ts, prev_ts, current=cur)
+        dkey = (key, prev_ts, ts)
+        delta = self._deltas.get(dkey)
+        if delta is None:
+            # 前回分が手元から落ちていれば初回扱い（全件が entered）になる
+            delta = diff(self.get(key, prev_ts) if prev_ts else None, cur)
+            self._deltas[dkey] = delta
+            while len(self._deltas) > self.max_deltas:
+                self._deltas.popitem(last=False)
+        return delta
+
+    def commit(self, consumer: Hashable, key: Key, ts: str) -> None:
+        self._seen[consumer] = (key, ts)
+
+    def forget(self, consumer: Hashable) -> None:
+        self._seen.pop(consumer, None)
+
+    def dump_state(self) -> Dict[str, Any]:
+        # スナップショット本体はランキング履歴にあるので、利用者ごとの既読位置だけを書き出す
+        return {"seen": [[list(consumer), list(key), ts] for consumer, (key, ts) in self._seen.items()
+                         if isinstance(consumer, tuple)]}
+
+    def load_state(self, data: Dict[str, Any]) -> None:
+        for consumer, key, ts in data.get("seen") or []:
+            key = (int(key[0]), int(key[1]))
+            if self.get(key, ts) is None:
+                rows = ranking_history.store.snapshot(key[0], key[1] or None, ts)
+                if not rows:
+                    continue
+                self.put(key, ts, rows)
+            self._seen[tuple(consumer)] = (key, ts)
+
+differ = SnapshotDiffer()
+checkpoint.register("snapshot_diff", differ.dump_state, differ.load_state)
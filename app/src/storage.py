@@ -1,77 +1,439 @@
 # storage.py
 from __future__ import annotations
 import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Dict, Optional
-
-_STORE_PATH = Path("config_store.json")
-
-def _read_all() -> Dict[str, Any]:
-    if not _STORE_PATH.exists():
-        return {}
-    try:
-        return json.loads(_STORE_PATH.read_text(encoding="utf-8"))
-    except Exception:
-        return {}
-    
+from time import time
+from typing import Any, Dict, Iterator, List, Optional
+try:
+    import fcntl
+except ImportError:  # Windows ではプロセス間ロックなし（単一プロセス運用のみ）
+    fcntl = None
+
+_STORE_PATH = Path(os.environ.get("STORAGE_JSON", "config_store.json"))
+_DB_PATH = Path(os.environ.get("STORAGE_DB", "config_store.sqlite3"))
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sqlite").lower()
+
+class _JsonBackend:
+    def __init__(self, path: Path = _STORE_PATH) -> None:
+        self.path = path
+        self._lock = threading.RLock()
+        self._flock_path = path.with_suffix(".lock")
+        self._flock_file = None
+        self._flock_depth = 0
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        # 複数プロセスで同じファイルを共有するので、読み書きの間は flock で排他する（同一スレッドからの再入可）
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            if self._flock_depth == 0:
+                self._flock_file = open(self._flock_path, "a+")
+                fcntl.flock(self._flock_file, fcntl.LOCK_EX)
+            self._flock_depth += 1
+            try:
+                yield
+            finally:
+                self._flock_depth -= 1
+                if self._flock_depth == 0:
+                    fcntl.flock(self._flock_file, fcntl.LOCK_UN)
+                    self._flock_file.close()
+                    self._flock_file = None
+
+    def _read_all(self) -> Dict[str, Any]:
+        if not self.path.exists():
+            return {}
+        try:
+            return json.loads(self.path.read_text(encoding="utf-8"))
+        except Exception:
+            return {}
+
+    def _write_all(self, data: Dict[str, Any]) -> None:
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+        tmp.replace(self.path)
+
+    @staticmethod
+    def _get_guilds_view(data: Dict[str, Any]) -> Dict[str, Any]:
+        if isinstance(data.get("guilds"), dict):
+            return data["guilds"]
+        return {k: v for k, v in data.items() if isinstance(k, str) and k.isdigit()}
+
+    def try_acquire_lease(self, guild_id: int, instance_id: str, ttl_sec: int) -> bool:
+        with self._locked():
+            data = self._read_all()
+            leases = data.setdefault("_leases", {})
+            now = time()
+            info = leases.get(str(guild_id))
+            if info and now < info.get("expires_at", 0) and info.get("instance_id") != instance_id:
+                return False
+            leases[str(guild_id)] = {"instance_id": instance_id, "expires_at": now + ttl_sec}
+            self._write_all(data)
+            return True
+
+    def release_lease(self, guild_id: int, instance_id: str) -> None:
+        with self._locked():
+            data = self._read_all()
+            leases = data.get("_leases", {})
+            if leases.get(str(guild_id), {}).get("instance_id") == instance_id:
+                leases.pop(str(guild_id), None)
+                self._write_all(data)
+
+    def heartbeat(self, instance_id: str, ttl_sec: float) -> None:
+        with self._locked():
+            data = self._read_all()
+            now = time()
+            members = {k: v for k, v in (data.get("_instances") or {}).items() if v > now}
+            members[instance_id] = now + ttl_sec
+            data["_instances"] = members
+            self._write_all(data)
+
+    def live_instances(self) -> List[str]:
+        now = time()
+        return sorted(k for k, v in (self._read_all().get("_instances") or {}).items() if v > now)
+
+    def lease_owners(self) -> Dict[int, str]:
+        now = time()
+        leases = self._read_all().get("_leases") or {}
+        return {int(gid): info["instance_id"] for gid, info in leases.items()
+                if info.get("expires_at", 0) > now and info.get("instance_id")}
+
+    def leave(self, instance_id: str) -> None:
+        with self._locked():
+            data = self._read_all()
+            (data.get("_instances") or {}).pop(instance_id, None)
+            leases = data.get("_leases") or {}
+            for gid in [g for g, info in leases.items() if info.get("instance_id") == instance_id]:
+                leases.pop(gid)
+            self._write_all(data)
+
+    def mark_tick_if_new(self, guild_id: int, tick_iso: str) -> bool:
+        with self._locked():
+            data = self._read_all()
+            g = data.setdefault("guilds", {}).setdefault(str(guild_id), {})
+            if g.get("_last_tick") == tick_iso:
+                return False
+            g["_last_tick"] = tick_iso
+            self._write_all(data)
+            return True
+
+    def unmark_tick(self, guild_id: int, tick_iso: str) -> None:
+        with self._locked():
+            data = self._read_all()
+            g = (data.get("guilds") or {}).get(str(guild_id))
+            if g is None or g.get("_last_tick") != tick_iso:
+                return
+            g.pop("_last_tick")
+            self._write_all(data)
+
+    def save_guild_config(self, guild_id: int, cfg: Dict[str, Any]) -> None:
+        with self._locked():
+            data = self._read_all()
+            data.setdefault("guilds", {})[str(guild_id)] = cfg
+            self._write_all(data)
+
+    def save_sheet_layout(self, spreadsheet_id: str, sheet_title: str, layout: Dict[str, Any]) -> None:
+        with self._locked():
+            data = self._read_all()
+            data.setdefault("_layouts", {})[f"{spreadsheet_id}/{sheet_title}"] = layout
+            self._write_all(data)
+
+    def load_sheet_layout(self, spreadsheet_id: str, sheet_title: str) -> Optional[Dict[str, Any]]:
+        return (self._read_all().get("_layouts") or {}).get(f"{spreadsheet_id}/{sheet_title}")
+
+    def save_state(self, key: str, value: Any) -> None:
+        with self._locked():
+            data = self._read_all()
+            data.setdefault("_state", {})[key] = value
+            self._write_all(data)
+
+    def load_state(self, key: str) -> Any:
+        return (self._read_all().get("_state") or {}).get(key)
+
+    def delete_state(self, key: str) -> None:
+        with self._locked():
+            data = self._read_all()
+            if key in (data.get("_state") or {}):
+                data["_state"].pop(key)
+                self._write_all(data)
+
+    def load_guild_config(self, guild_id: int) -> Optional[Dict[str, Any]]:
+        return self._get_guilds_view(self._read_all()).get(str(guild_id))
+
+    def load_all_configs(self) -> Dict[int, Dict[str, Any]]:
+        guilds = self._get_guilds_view(self._read_all())
+        return {int(k): v for k, v in guilds.items() if isinstance(v, dict)}
+
+    def delete_guild_config(self, guild_id: int) -> None:
+        with self._locked():
+            data = self._read_all()
+            if isinstance(data.get("guilds"), dict):
+                data["guilds"].pop(str(guild_id), None)
+            else:
+                data.pop(str(guild_id), None)
+            self._write_all(data)
+
+class _SqliteBackend:
+    _SCHEMA = """
+    CREATE TABLE IF NOT EXISTS guilds (
+        guild_id INTEGER PRIMARY KEY,
+        config   TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS ticks (
+        guild_id  INTEGER PRIMARY KEY,
+        last_tick TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS leases (
+        guild_id    INTEGER PRIMARY KEY,
+        instance_id TEXT NOT NULL,
+        expires_at  REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS instances (
+        instance_id TEXT PRIMARY KEY,
+        expires_at  REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS layouts (
+        spreadsheet_id TEXT NOT NULL,
+        sheet_title    TEXT NOT NULL,
+        layout         TEXT NOT NULL,
+        PRIMARY KEY (spreadsheet_id, sheet_title)
+    );
+    CREATE TABLE IF NOT EXISTS state (
+        key   TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS meta (
+        key   TEXT PRIMARY KEY,
+        value TEXT
+    );
+    """
+
+    def __init__(self, path: Path = _DB_PATH, json_path: Path = _STORE_PATH) -> None:
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(str(path), timeout=10, isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self._SCHEMA)
+        self._configs: Optional[Dict[int, Dict[str, Any]]] = None
+        self._data_version: Optional[int] = None
+        self._migrate_json(json_path)
+
+    def _execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._conn.execute(sql, params)
+
+    def _migrate_json(self, json_path: Path) -> None:
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM meta WHERE key='json_migrated'").fetchone():
+                return
+            if json_path.exists():
+                self._conn.execute("BEGIN IMMEDIATE")
+                # 同時に起動した別レプリカが先に移行していれば、書き込みロックを取った後の確認で分かる
+                if self._conn.execute("SELECT 1 FROM meta WHERE key='json_migrated'").fetchone():
+                    self._conn.execute("ROLLBACK")
+                    return
+                try:
+                    legacy = _JsonBackend(json_path)
+                    data = legacy._read_all()
+                    configs = legacy.load_all_configs()
+                    for gid, cfg in configs.items():
+                        cfg = dict(cfg)
+                        last_tick = cfg.pop("_last_tick", None)
+                        self._conn.execute("INSERT OR REPLACE INTO guilds VALUES (?, ?)",
+                                           (gid, json.dumps(cfg, ensure_ascii=False)))
+                        if last_tick:
+                            self._conn.execute("INSERT OR REPLACE INTO ticks VALUES (?, ?)", (gid, last_tick))
+                    for gid, info in (data.get("_leases") or {}).items():
+                        self._conn.execute("INSERT OR REPLACE INTO leases VALUES (?, ?, ?)",
+                                           (int(gid), info.get("instance_id", ""), float(info.get("expires_at", 0))))
+                    for key, value in (data.get("_state") or {}).items():
+                        self._conn.execute("INSERT OR REPLACE INTO state VALUES (?, ?)",
+                                           (key, json.dumps(value, ensure_ascii=False)))
+                    for key, layout in (data.get("_layouts") or {}).items():
+                        sid, _, title = key.partition("/")
+                        self._conn.execute("INSERT OR REPLACE INTO layouts VALUES (?, ?, ?)",
+                                           (sid, title, json.dumps(layout, ensure_ascii=False)))
+                    self._conn.execute("INSERT OR IGNORE INTO meta VALUES ('json_migrated', ?)", (str(time()),))
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+                try:
+                    json_path.replace(json_path.with_suffix(".json.migrated"))
+                except FileNotFoundError:
+                    pass
+                print(f"[INFO] {json_path} を {self.path} に移行しました（{len(configs)} guilds）")
+            else:
+                self._conn.execute("INSERT OR IGNORE INTO meta VALUES ('json_migrated', ?)", (str(time()),))
+
+    def _cached_configs(self) -> Dict[int, Dict[str, Any]]:
+        with self._lock:
+            # 他プロセスが書き込んだ場合は data_version が変わるのでキャッシュを捨てる
+            version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            if self._configs is None or version != self._data_version:
+                rows = self._conn.execute("SELECT guild_id, config FROM guilds").fetchall()
+                self._configs = {gid: json.loads(cfg) for gid, cfg in rows}
+                self._data_version = version
+            return self._configs
+
+    def try_acquire_lease(self, guild_id: int, instance_id: str, ttl_sec: int) -> bool:
+        now = time()
+        cur = self._execute(
+            "INSERT INTO leases VALUES (?, ?, ?) "
+            "ON CONFLICT(guild_id) DO UPDATE SET instance_id=excluded.instance_id, expires_at=excluded.expires_at "
+            "WHERE leases.instance_id = excluded.instance_id OR leases.expires_at <= ?",
+            (guild_id, instance_id, now + ttl_sec, now),
+        )
+        return cur.rowcount == 1
+
+    def release_lease(self, guild_id: int, instance_id: str) -> None:
+        self._execute("DELETE FROM leases WHERE guild_id=? AND instance_id=?", (guild_id, instance_id))
+
+    def heartbeat(self, instance_id: str, ttl_sec: float) -> None:
+        now = time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM instances WHERE expires_at <= ?", (now,))
+                self._conn.execute("INSERT OR REPLACE INTO instances VALUES (?, ?)", (instance_id, now + ttl_sec))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def live_instances(self) -> List[str]:
+        rows = self._execute("SELECT instance_id FROM instances WHERE expires_at > ? ORDER BY instance_id",
+                             (time(),)).fetchall()
+        return [r[0] for r in rows]
+
+    def lease_owners(self) -> Dict[int, str]:
+        rows = self._execute("SELECT guild_id, instance_id FROM leases WHERE expires_at > ?", (time(),)).fetchall()
+        return {gid: iid for gid, iid in rows}
+
+    def leave(self, instance_id: str) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute("DELETE FROM instances WHERE instance_id=?", (instance_id,))
+            self._conn.execute("DELETE FROM leases WHERE instance_id=?", (instance_id,))
+            self._conn.execute("COMMIT")
+
+    def mark_tick_if_new(self, guild_id: int, tick_iso: str) -> bool:
+        cur = self._execute(
+            "INSERT INTO ticks VALUES (?, ?) "
+            "ON CONFLICT(guild_id) DO UPDATE SET last_tick=excluded.last_tick "
+            "WHERE ticks.last_tick != excluded.last_tick",
+            (guild_id, tick_iso),
+        )
+        return cur.rowcount == 1
+
+    def unmark_tick(self, guild_id: int, tick_iso: str) -> None:
+        self._execute("DELETE FROM ticks WHERE guild_id=? AND last_tick=?", (guild_id, tick_iso))
+
+    def save_guild_config(self, guild_id: int, cfg: Dict[str, Any]) -> None:
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO guilds VALUES (?, ?)",
+                               (guild_id, json.dumps(cfg, ensure_ascii=False)))
+            self._configs = None
+
+    def load_guild_config(self, guild_id: int) -> Optional[Dict[str, Any]]:
+        return self._cached_configs().get(int(guild_id))
+
+    def save_sheet_layout(self, spreadsheet_id: str, sheet_title: str, layout: Dict[str, Any]) -> None:
+        self._execute("INSERT OR REPLACE INTO layouts VALUES (?, ?, ?)",
+                      (spreadsheet_id, sheet_title, json.dumps(layout, ensure_ascii=False)))
+
+    def load_sheet_layout(self, spreadsheet_id: str, sheet_title: str) -> Optional[Dict[str, Any]]:
+        row = self._execute("SELECT layout FROM layouts WHERE spreadsheet_id=? AND sheet_title=?",
+                            (spreadsheet_id, sheet_title)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_state(self, key: str, value: Any) -> None:
+        self._execute("INSERT OR REPLACE INTO state VALUES (?, ?)", (key, json.dumps(value, ensure_ascii=False)))
+
+    def load_state(self, key: str) -> Any:
+        row = self._execute("SELECT value FROM state WHERE key=?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def delete_state(self, key: str) -> None:
+        self._execute("DELETE FROM state WHERE key=?", (key,))
+
+    def load_all_configs(self) -> Dict[int, Dict[str, Any]]:
+        return dict(self._cached_configs())
+
+    def delete_guild_config(self, guild_id: int) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute("DELETE FROM guilds WHERE guild_id=?", (guild_id,))
+            self._conn.execute("DELETE FROM ticks WHERE guild_id=?", (guild_id,))
+            self._conn.execute("COMMIT")
+            self._configs = None
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def _get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = _JsonBackend() if STORAGE_BACKEND == "json" else _SqliteBackend()
+    return _backend
+
 def try_acquire_lease(guild_id: int, instance_id: str, ttl_sec: int = 3600) -> bool:
-    data = _read_all()
-    leases = data.setdefault("_leases", {})
-    from time import time
-    now = time()
-    info = leases.get(str(guild_id))
-    if info and now < info.get("expires_at", 0) and info.get("instance_id") != instance_id:
-        return False
-    leases[str(guild_id)] = {"instance_id": instance_id, "expires_at": now + ttl_sec}
-    _write_all(data)
-    return True
+    return _get_backend().try_acquire_lease(guild_id, instance_id, ttl_sec)
 
 def mark_tick_if_new(guild_id: int, tick_iso: str) -> bool:
-    data = _read_all()
-    g = data.setdefault("guilds", {}).setdefault(str(guild_id), {})
-    if g.get("_last_tick") == tick_iso:
-        return False
-    g["_last_tick"] = tick_iso
-    _write_all(data)
-    return True
+    return _get_backend().mark_tick_if_new(guild_id, tick_iso)
+
+def unmark_tick(guild_id: int, tick_iso: str) -> None:
+    # 途中で打ち切られた tick を、次に担当するプロセスが実行し直せるようにする
+    _get_backend().unmark_tick(guild_id, tick_iso)
 
 def release_lease(guild_id: int, instance_id: str):
-    data = _read_all()
-    leases = data.get("_leases", {})
-    if leases.get(str(guild_id), {}).get("instance_id") == instance_id:
-        leases.pop(str(guild_id), None)
-        _write_all(data)
-
-def _write_all(data: Dict[str, Any]) -> None:
-    tmp = _STORE_PATH.with_suffix(".tmp")
-    tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
-    tmp.replace(_STORE_PATH)
-
-def _get_guilds_view(data: Dict[str, Any]) -> Dict[str, Any]:
-    if isinstance(data.get("guilds"), dict):
-        return data["guilds"]
-    return {k: v for k, v in data.items() if isinstance(k, str) and k.isdigit()}
+    _get_backend().release_lease(guild_id, instance_id)
+
+def heartbeat(instance_id: str, ttl_sec: float) -> None:
+    _get_backend().heartbeat(instance_id, ttl_sec)
+
+def live_instances() -> List[str]:
+    return _get_backend().live_instances()
+
+def lease_owners() -> Dict[int, str]:
+    return _get_backend().lease_owners()
+
+def leave(instance_id: str) -> None:
+    _get_backend().leave(instance_id)
 
 def save_guild_config(guild_id: int, cfg: Dict[str, Any]) -> None:
-    data = _read_all()
-    guilds = data.setdefault("guilds", {})
-    guilds[str(guild_id)] = cfg
-    _write_all(data)
+    _get_backend().save_guild_config(guild_id, cfg)
 
 def load_guild_config(guild_id: int) -> Optional[Dict[str, Any]]:
-    data = _read_all()
-    guilds = _get_guilds_view(data)
-    return guilds.get(str(guild_id))
+    return _get_backend().load_guild_config(guild_id)
 
 def load_all_configs() -> Dict[int, Dict[str, Any]]:
-    data = _read_all()
-    guilds = _get_guilds_view(data)
-    return {int(k): v for k, v in guilds.items() if isinstance(v, dict)}
+    return _get_backend().load_all_configs()
 
 def delete_guild_config(guild_id: int) -> None:
-    data = _read_all()
-    if isinstance(data.get("guilds"), dict):
-        data["guilds"].pop(str(guild_id), None)
-    else:
-        data.pop(str(guild_id), None)
-    _write_all(data)
\ No newline at end of file
+    _get_backend().delete_guild_config(guild_id)
+
+def save_sheet_layout(spreadsheet_id: str, sheet_title: str, layout: Dict[str, Any]) -> None:
+    _get_backend().save_sheet_layout(spreadsheet_id, sheet_title, layout)
+
+def load_sheet_layout(spreadsheet_id: str, sheet_title: str) -> Optional[Dict[str, Any]]:
+    return _get_backend().load_sheet_layout(spreadsheet_id, sheet_title)
+
+def save_state(key: str, value: Any) -> None:
+    _get_backend().save_state(key, value)
+
+def load_state(key: str) -> Any:
+    return _get_backend().load_state(key)
+
+def delete_state(key: str) -> None:
+    _get_backend().delete_state(key)